@@ -0,0 +1,112 @@
+"""
+Benchmark comparing the .plots (JSON text) format against the binary container format (see kodak.container) for write
+time, read time, file size, and peak RSS. Every .plots file passed in is converted to each format, along with a
+synthetic file holding large traces.
+
+Run from the root of the repository via:
+    python benchmarks/bench_container.py Examples/test_outputs/*.plots --synthetic-points 1000000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+# Put the working tree first on the path, so that running this file as a script runs the kodak next to it rather than
+# failing to import kodak (or benchmarking an installed copy of it):
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from kodak.kodak_creator import KodakPlots
+
+FORMATS = {
+    '.plots (indent=2)': dict(container=False, indent=2),
+    '.plots': dict(container=False, indent=None),
+    'container': dict(container=True, compression=None),
+    'container (gzip)': dict(container=True, compression='gzip'),
+    'container (zstd)': dict(container=True, compression='zstd'),
+}
+
+# Reads a file (and builds its first figure) in a fresh interpreter so that the peak RSS belongs to the read alone:
+# Note: ru_maxrss survives the fork / exec on Linux (it would report the RSS of this process), so VmHWM is used there.
+_READ_SCRIPT = '''
+import sys, time, json, resource
+import plotly.graph_objs
+from kodak.kodak_creator import KodakPlots
+kodak_plots = KodakPlots()
+start = time.perf_counter()
+if sys.argv[1].endswith('.plots'):
+    kodak_plots.read_json_input(sys.argv[1])
+else:
+    kodak_plots.read_container_input(sys.argv[1])
+read = time.perf_counter()
+kodak_plots.get_figure(next(iter(kodak_plots.all_plots)))
+end = time.perf_counter()
+try:
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+except OSError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'read': read - start, 'first_figure': end - read, 'peak_rss_mb': peak / 1024}))
+'''
+
+
+def synthetic_plots(write_directory: str, n_points: int, n_plots: int) -> str:
+    rng = np.random.default_rng(8)
+    kodak_plots = KodakPlots()
+    x = np.linspace(0, 1, n_points)
+    for i in range(n_plots):
+        trace = kodak_plots.scatter_plot(x=x, y=rng.standard_normal(n_points), lines_markers_both='markers')
+        kodak_plots.add_new_plot(traces=[trace], window_title=f'Synthetic {i}')
+    kodak_plots.write_json_output(write_directory, 'synthetic')
+    return os.path.join(write_directory, 'synthetic.plots')
+
+
+def measure(source: str, write_directory: str, options: dict) -> dict:
+    kodak_plots = KodakPlots()
+    kodak_plots.read_json_input(source)
+    start = time.perf_counter()
+    if options['container']:
+        path = kodak_plots.write_container_output(write_directory, 'bench', compression=options['compression'])
+    else:
+        kodak_plots.write_json_output(write_directory, 'bench', indent=options['indent'])
+        path = os.path.join(write_directory, 'bench.plots')
+    write_time = time.perf_counter() - start
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, '-c', _READ_SCRIPT, path], capture_output=True, text=True, check=True,
+                            env=env)
+    result = json.loads(output.stdout)
+    result.update(write=write_time, size_mb=os.path.getsize(path) / 1e6)
+    os.remove(path)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='.plots files to benchmark')
+    parser.add_argument('--synthetic-points', type=int, default=1000000, help='Points per trace of the synthetic file '
+                                                                              '(0 to skip it)')
+    parser.add_argument('--synthetic-plots', type=int, default=10, help='Number of plots in the synthetic file')
+    args = parser.parse_args()
+
+    try:
+        import zstandard
+    except ImportError:
+        FORMATS.pop('container (zstd)')
+
+    with tempfile.TemporaryDirectory() as write_directory:
+        files = list(args.files)
+        if args.synthetic_points > 0:
+            files.append(synthetic_plots(write_directory, args.synthetic_points, args.synthetic_plots))
+        print(f'{"file":<26} | {"format":<18} | {"size [MB]":>9} | {"write [ms]":>10} | {"read [ms]":>9} | '
+              f'{"1st figure [ms]":>15} | {"peak RSS [MB]":>13}')
+        for source in files:
+            for name, options in FORMATS.items():
+                r = measure(source, write_directory, options)
+                print(f'{os.path.basename(source):<26} | {name:<18} | {r["size_mb"]:>9.2f} | {r["write"] * 1e3:>10.1f} | '
+                      f'{r["read"] * 1e3:>9.1f} | {r["first_figure"] * 1e3:>15.1f} | {r["peak_rss_mb"]:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark of the style assignment (KodakPlots.read_traces) and of add_new_plot for figures with many traces.
+
+Run from the root of the repository via:
+    python benchmarks/bench_read_traces.py --traces 10 100 1000
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+# Put the working tree first on the path, so that running this file as a script runs the kodak next to it rather than
+# failing to import kodak (or benchmarking an installed copy of it):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kodak.kodak_creator import KodakPlots
+
+MODES = ('markers', 'lines', 'both')
+
+
+def make_traces(kodak_plots: KodakPlots, n_traces: int, n_points: int) -> list:
+    x = np.linspace(0, 1, n_points)
+    return [kodak_plots.scatter_plot(x=x, y=x * i, lines_markers_both=MODES[i % len(MODES)]) for i in range(n_traces)]
+
+
+def time_figure(n_traces: int, n_points: int, repeats: int, fast_traces: bool) -> tuple:
+    """
+    Returns the best time (in seconds) of read_traces, and of add_new_plot (which includes read_traces).
+    """
+    best_read, best_add = np.inf, np.inf
+    for _ in range(repeats):
+        kodak_plots = KodakPlots(fast_traces=fast_traces)
+        traces = make_traces(kodak_plots, n_traces, n_points)
+        start = time.perf_counter()
+        kodak_plots.read_traces(traces)
+        best_read = min(best_read, time.perf_counter() - start)
+
+        traces = make_traces(kodak_plots, n_traces, n_points)
+        start = time.perf_counter()
+        kodak_plots.add_new_plot(traces=traces, window_title='Many traces')
+        best_add = min(best_add, time.perf_counter() - start)
+    return best_read, best_add
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--traces', type=int, nargs='+', default=[10, 100, 1000], help='Number of traces per figure')
+    parser.add_argument('--points', type=int, default=100, help='Number of points per trace')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of repeats (the best time is reported)')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')  # The "many traces" warning is expected here
+
+    print(f'{"traces":>7} | {"traces type":<11} | {"read_traces [ms]":>16} | {"add_new_plot [ms]":>17}')
+    for n_traces in args.traces:
+        for fast_traces in (False, True):
+            read, add = time_figure(n_traces, args.points, args.repeats, fast_traces)
+            print(f'{n_traces:>7} | {"fast" if fast_traces else "standard":<11} | {read * 1e3:>16.2f} | '
+                  f'{add * 1e3:>17.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Benchmark suite (and regression check) for the hot paths of KodakPlots: building traces, validate_traces + read_traces,
+add_new_plot, write_json_output, and read_json_input, across point counts, trace counts, and plot counts. For every
+case, the best wall time over the repeats, the peak memory allocated while it runs (through tracemalloc, which numpy
+reports its arrays to), and the number of bytes written out are recorded.
+
+Run from the root of the repository via:
+    python benchmarks/bench_suite.py --save results.json --compare benchmarks/baseline.json
+    python benchmarks/bench_suite.py --points 1e3 1e4 1e5 1e6 1e7 --filter write_json_output
+
+The results are saved as JSON (see --save). With --compare, every case is checked against the same case of a stored
+baseline, and the script exits with status 1 if any case got slower (or used more memory / wrote more bytes) than the
+tolerances allow. Wall times depend on the machine, so a baseline should be recorded on the machine it is compared on
+(e.g. python benchmarks/bench_suite.py --save benchmarks/baseline.json before making a change).
+"""
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+import numpy as np
+import plotly
+# Put the working tree first on the path, so that running this file as a script runs the kodak next to it rather than
+# failing to import kodak (or benchmarking an installed copy of it):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kodak.kodak_creator import KodakPlots
+
+MODES = ('markers', 'lines', 'both')
+
+
+class Case(object):
+    """
+    One benchmark case: setup() builds whatever the case needs (not measured), and run(state) is what gets measured.
+    If run returns an integer, it is recorded as the number of bytes the case wrote out.
+    """
+    def __init__(self, group: str, params: dict, setup: Callable[[], object], run: Callable[[object], Optional[int]]):
+        self.group = group
+        self.params = params
+        self.setup = setup
+        self.run = run
+
+    @property
+    def name(self) -> str:
+        return self.group + '[' + ','.join(f'{k}={v}' for k, v in self.params.items()) + ']'
+
+
+def _data(n_points: int, seed: int = 8) -> tuple:
+    rng = np.random.default_rng(seed)
+    return np.linspace(0, 1, n_points), rng.standard_normal(n_points), rng.standard_normal(n_points)
+
+
+def _traces(kodak_plots: KodakPlots, n_traces: int, n_points: int) -> list:
+    x, y, _ = _data(n_points)
+    return [kodak_plots.scatter_plot(x=x, y=y + i, lines_markers_both=MODES[i % len(MODES)]) for i in range(n_traces)]
+
+
+def _with_traces(n_traces: int, n_points: int, fast_traces: bool) -> tuple:
+    kodak_plots = KodakPlots(fast_traces=fast_traces)
+    return kodak_plots, _traces(kodak_plots, n_traces, n_points)
+
+
+def _validate_and_read(state: tuple) -> None:
+    kodak_plots, traces = state
+    kodak_plots.validate_traces(traces)
+    kodak_plots.read_traces(traces)
+
+
+def _plots_file(directory: str, n_plots: int, n_points: int, fast_traces: bool) -> KodakPlots:
+    kodak_plots = KodakPlots(fast_traces=fast_traces)
+    for i in range(n_plots):
+        kodak_plots.add_new_plot(traces=_traces(kodak_plots, 2, n_points), window_title=f'Plot {i}')
+    kodak_plots.write_json_output(directory, 'bench')
+    return kodak_plots
+
+
+def _write(kodak_plots: KodakPlots, directory: str) -> int:
+    kodak_plots.write_json_output(directory, 'bench')
+    return os.path.getsize(os.path.join(directory, 'bench.plots'))
+
+
+def build_cases(points: list, traces: list, plots: list, directory: str) -> Iterator[Case]:
+    """
+    Yields every case of the suite. Point counts are swept with a single trace / plot, trace and plot counts are swept
+    with 1,000 points per trace so that the per-trace / per-plot overheads show up.
+    """
+    path = os.path.join(directory, 'bench.plots')
+    for n_points in points:
+        for fast in (False, True):
+            p = dict(points=n_points, fast=fast)
+            yield Case('scatter_plot', p, lambda n=n_points, f=fast: (KodakPlots(fast_traces=f), _data(n)),
+                       lambda s: s[0].scatter_plot(x=s[1][0], y=s[1][1], lines_markers_both='markers'))
+            yield Case('scatter3d_plot', p, lambda n=n_points, f=fast: (KodakPlots(fast_traces=f), _data(n)),
+                       lambda s: s[0].scatter3d_plot(x=s[1][0], y=s[1][1], z=s[1][2]))
+            yield Case('add_new_plot', p, lambda n=n_points, f=fast: _with_traces(1, n, f),
+                       lambda s: s[0].add_new_plot(traces=s[1], window_title='Plot'))
+            yield Case('write_json_output', p, lambda n=n_points, f=fast: _plots_file(directory, 1, n, f),
+                       lambda k: _write(k, directory))
+        yield Case('read_json_input', dict(points=n_points, lazy=False),
+                   lambda n=n_points: _plots_file(directory, 1, n, False), lambda s: KodakPlots().read_json_input(path))
+
+    for n_traces in traces:
+        for fast in (False, True):
+            p = dict(traces=n_traces, fast=fast)
+            yield Case('validate_read_traces', p, lambda t=n_traces, f=fast: _with_traces(t, 1000, f),
+                       _validate_and_read)
+            yield Case('add_new_plot', p, lambda t=n_traces, f=fast: _with_traces(t, 1000, f),
+                       lambda s: s[0].add_new_plot(traces=s[1], window_title='Plot'))
+
+    for n_plots in plots:
+        p = dict(plots=n_plots)
+        yield Case('write_json_output', p, lambda n=n_plots: _plots_file(directory, n, 1000, False),
+                   lambda k: _write(k, directory))
+        for lazy in (False, True):
+            yield Case('read_json_input', dict(plots=n_plots, lazy=lazy),
+                       lambda n=n_plots: _plots_file(directory, n, 1000, False),
+                       lambda s, lazy=lazy: KodakPlots().read_json_input(path, lazy=lazy))
+
+
+def time_case(case: Case, repeats: int) -> tuple:
+    """
+    Returns the best wall time over repeats runs, and the number of bytes written out. As with timeit, the garbage
+    collector is turned off while a run is timed so that collections of earlier garbage do not land in the measurement.
+    """
+    best, output_bytes = np.inf, None
+    for _ in range(repeats):
+        state = case.setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = case.run(state)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+        output_bytes = result if isinstance(result, int) else None
+        del state, result
+    return best, output_bytes
+
+
+def peak_memory(case: Case) -> int:
+    # tracemalloc slows the run down, so the peak memory is measured on a separate run:
+    state = case.setup()
+    tracemalloc.start()
+    try:
+        case.run(state)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(case: Case, repeats: int) -> dict:
+    best, output_bytes = time_case(case, repeats)
+    return {'group': case.group, 'params': case.params, 'time_s': best, 'peak_memory_bytes': peak_memory(case),
+            'output_bytes': output_bytes}
+
+
+def metadata() -> dict:
+    return {'date': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'plotly': plotly.__version__, 'machine': platform.machine(),
+            'platform': platform.platform()}
+
+
+def slower(new: dict, old: dict, time_tolerance: float, min_time: float) -> bool:
+    return new['time_s'] > old['time_s'] * (1 + time_tolerance) and new['time_s'] - old['time_s'] > min_time
+
+
+def compare(results: dict, baseline: dict, time_tolerance: float, memory_tolerance: float, min_time: float,
+            min_memory: float) -> list:
+    """
+    Returns the list of regressions of results against baseline (cases missing from either one are skipped). A case
+    regresses if it is slower by more than time_tolerance, if its peak memory grew by more than memory_tolerance, or if
+    it writes out more bytes. Differences below min_time seconds / min_memory bytes are ignored as noise.
+    """
+    regressions = []
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if slower(new, old, time_tolerance, min_time):
+            regressions.append(f'{name}: time {old["time_s"] * 1e3:.2f} ms -> {new["time_s"] * 1e3:.2f} ms')
+        if new['peak_memory_bytes'] > old['peak_memory_bytes'] * (1 + memory_tolerance) and \
+                new['peak_memory_bytes'] - old['peak_memory_bytes'] > min_memory:
+            regressions.append(f'{name}: peak memory {old["peak_memory_bytes"] / 1e6:.2f} MB -> '
+                               f'{new["peak_memory_bytes"] / 1e6:.2f} MB')
+        if old['output_bytes'] is not None and (new['output_bytes'] or 0) > old['output_bytes']:
+            regressions.append(f'{name}: output {old["output_bytes"]} bytes -> {new["output_bytes"]} bytes')
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=float, nargs='+', default=[1e3, 1e4, 1e5, 1e6],
+                        help='Points per trace to sweep (e.g. 1e3 1e4 1e5 1e6 1e7)')
+    parser.add_argument('--traces', type=int, nargs='+', default=[1, 10, 100], help='Traces per plot to sweep')
+    parser.add_argument('--plots', type=int, nargs='+', default=[1, 10, 100], help='Plots per file to sweep')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of repeats (the best time is reported)')
+    parser.add_argument('--filter', default=None, help='Only run the cases whose name contains this string')
+    parser.add_argument('--save', default=None, help='Path of the JSON file to save the results to')
+    parser.add_argument('--compare', default=None, help='Path of a saved JSON file to compare the results against')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='Allowed relative slow down')
+    parser.add_argument('--memory-tolerance', type=float, default=0.10, help='Allowed relative growth of peak memory')
+    parser.add_argument('--min-time', type=float, default=1e-3, help='Slow downs below this (in seconds) are ignored')
+    parser.add_argument('--retries', type=int, default=3, help='Times a case that looks slower than the baseline is '
+                                                                'timed again before it is reported')
+    parser.add_argument('--min-memory', type=float, default=1., help='Memory growth below this (in MB) is ignored')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')  # e.g. the "many traces" warning is expected here
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f'{"case":<58} | {"time [ms]":>10} | {"peak mem [MB]":>13} | {"output [MB]":>11} | {"vs baseline":>11}')
+    with tempfile.TemporaryDirectory() as directory:
+        for case in build_cases([int(p) for p in args.points], args.traces, args.plots, directory):
+            if args.filter is not None and args.filter not in case.name:
+                continue
+            r = results[case.name] = measure(case, args.repeats)
+            old = baseline.get(case.name) if baseline is not None else None
+            # A case that looks slower is timed again (keeping its best time) so that a noisy moment is not reported:
+            for _ in range(args.retries):
+                if old is None or not slower(r, old, args.time_tolerance, args.min_time):
+                    break
+                r['time_s'] = min(r['time_s'], time_case(case, args.repeats)[0])
+            output = '' if r['output_bytes'] is None else f'{r["output_bytes"] / 1e6:.2f}'
+            ratio = f'{r["time_s"] / old["time_s"]:.2f}x' if old else ''
+            print(f'{case.name:<58} | {r["time_s"] * 1e3:>10.2f} | {r["peak_memory_bytes"] / 1e6:>13.2f} | '
+                  f'{output:>11} | {ratio:>11}')
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_time,
+                              args.min_memory * 1e6)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) against {args.compare}:')
+            for regression in regressions:
+                print('    ' + regression)
+            sys.exit(1)
+        print(f'\nNo regressions against {args.compare}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Microbenchmark comparing the standard (plotly validated) trace builders against the "fast" dict-backed trace builders.
+
+Run from the root of the repository via:
+    python benchmarks/bench_trace_builders.py --max-exponent 7
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+# Put the working tree first on the path, so that running this file as a script runs the kodak next to it rather than
+# failing to import kodak (or benchmarking an installed copy of it):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kodak.kodak_creator import KodakPlots
+
+MODES = {
+    'standard': dict(fast_traces=False),
+    'fast (validated once)': dict(fast_traces=True, validate_fast_traces=True),
+    'fast (not validated)': dict(fast_traces=True, validate_fast_traces=False),
+}
+
+
+def time_mode(n_points: int, repeats: int, **kodak_kwargs) -> tuple:
+    """
+    Returns the best time (in seconds) to build the traces, and to build the traces and add them as a plot.
+    """
+    x = np.linspace(0, 1, n_points)
+    y = np.random.default_rng(8).standard_normal(n_points)
+    z = np.random.default_rng(9).standard_normal(n_points)
+    best_build, best_total = np.inf, np.inf
+    for _ in range(repeats):
+        kodak_plots = KodakPlots(**kodak_kwargs)
+        start = time.perf_counter()
+        traces = [kodak_plots.scatter_plot(x=x, y=y, lines_markers_both='markers'),
+                  kodak_plots.scatter_plot(x=x, y=z, lines_markers_both='lines')]
+        trace_3d = kodak_plots.scatter3d_plot(x=x, y=y, z=z)
+        built = time.perf_counter()
+        kodak_plots.add_new_plot(traces=traces, window_title='2D')
+        kodak_plots.add_new_plot(traces=[trace_3d], window_title='3D')
+        end = time.perf_counter()
+        best_build, best_total = min(best_build, built - start), min(best_total, end - start)
+    return best_build, best_total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--min-exponent', type=int, default=3, help='Smallest number of points as a power of 10')
+    parser.add_argument('--max-exponent', type=int, default=7, help='Largest number of points as a power of 10')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of repeats (the best time is reported)')
+    args = parser.parse_args()
+
+    print(f'{"points":>10} | {"mode":<22} | {"build traces [ms]":>17} | {"build + add_new_plot [ms]":>25}')
+    for exponent in range(args.min_exponent, args.max_exponent + 1):
+        n_points = 10 ** exponent
+        repeats = args.repeats if exponent < 6 else 1
+        for name, kodak_kwargs in MODES.items():
+            build, total = time_mode(n_points, repeats, **kodak_kwargs)
+            print(f'{n_points:>10} | {name:<22} | {build * 1e3:>17.2f} | {total * 1e3:>25.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+This script holds the background exporter of KodakPlots. While it is running, add_new_plot (and the other methods that
+store a plot) only hand the call over to a bounded queue, and a worker thread does the validation, serialization, and
+file I/O so that the calling loop (e.g. an optimizer) is not blocked by it.
+"""
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+
+class BackgroundExporter(object):
+    """
+    Runs the calls handed to it (in order) on a worker thread, and checkpoints the plots to a .plots file through
+    KodakPlots.append_json_output. A file that was not read in (or written) by the KodakPlots (e.g. the output of an
+    earlier run) is written over on the first checkpoint, as write_json_output would. Use
+    KodakPlots.start_background_export to create one:
+
+        with kodak_plots.start_background_export('outputs', 'my_run') as exporter:
+            for i in range(n_iterations):
+                kodak_plots.add_new_plot(traces=[trace], window_title=f'Iteration {i}')  # Returns right away
+                if i % 10 == 0:
+                    exporter.checkpoint()
+
+    If the queue holds max_queued calls, handing over a new call blocks until the worker catches up (backpressure).
+    Note that the trace data is handed over by reference, so arrays should not be modified once they are passed in, and
+    all_plots should only be read in after flush (or close) was called.
+
+    If a call fails on the worker, the remaining calls are skipped and the error is raised by the next call to submit,
+    checkpoint, flush, or close.
+    """
+    def __init__(self, kodak_plots, write_directory: str, savename_no_extension: str, max_queued: int = 32,
+                 compact_threshold: Optional[float] = 1.) -> None:
+        self.kodak_plots = kodak_plots
+        self.write_directory = write_directory
+        self.savename_no_extension = savename_no_extension
+        self.compact_threshold = compact_threshold
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='kodak-background-export', daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> 'BackgroundExporter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        # If the body raised, the plots handed over so far are still processed but not checkpointed:
+        self.close(checkpoint=exc_type is None)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def pending(self) -> int:
+        # Number of calls waiting in the queue:
+        return self._queue.qsize()
+
+    def is_worker_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, function: Callable, *args, **kwargs) -> None:
+        """
+        Hands a call over to the worker thread, blocking while the queue is full.
+        """
+        self._raise_error()
+        if self._closed:
+            raise Exception('This BackgroundExporter is closed.')
+        self._queue.put((function, args, kwargs))
+
+    def checkpoint(self) -> None:
+        """
+        Queues a write of the plots added so far (see KodakPlots.append_json_output).
+        """
+        self.submit(self._checkpoint)
+
+    def flush(self) -> None:
+        """
+        Blocks until every call handed over so far was processed.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    async def flush_async(self) -> None:
+        """
+        Awaitable version of flush for use inside of an asyncio event loop.
+        """
+        import asyncio  # Only imported here, as it takes longer to import than the rest of kodak
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def close(self, checkpoint: bool = True) -> None:
+        """
+        Processes every remaining call, writes a final checkpoint (if checkpoint is True), and stops the worker thread.
+        """
+        if self._closed:
+            return
+        try:
+            if checkpoint and self._error is None:
+                self.checkpoint()
+        finally:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self.kodak_plots._exporter = None
+        self._raise_error()
+
+    def _checkpoint(self) -> None:
+        # append_json_output refuses to append to a file which all_plots does not match, so that file is written out
+        # fresh (after which all_plots matches it and the next checkpoints append):
+        filepath = os.path.join(self.write_directory, self.savename_no_extension + '.plots')
+        if self.kodak_plots._saved_path != os.path.abspath(filepath):
+            self.kodak_plots.write_json_output(self.write_directory, self.savename_no_extension)
+        else:
+            self.kodak_plots.append_json_output(self.write_directory, self.savename_no_extension,
+                                                compact_threshold=self.compact_threshold)
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    function, args, kwargs = job
+                    function(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,173 @@
+"""
+This script holds the vectorized binning behind the histogram, 2D histogram, and density contour trace builders (see
+trace_types). Raw samples are reduced to bin counts so that a .plots file only holds the bin edges and counts, i.e. its
+size depends on the number of bins rather than the number of samples.
+
+The samples are binned in chunks of chunk_size, so arrays that do not fit in memory can be binned as well: a np.memmap
+is only read in one chunk at a time, and the samples may also be passed in as an iterable (e.g. a generator) of chunks
+(in which case x, y, and the weights must all be passed in as chunks of the same lengths).
+The bins follow np.histogram: every bin is half-open [left, right) except for the last one, which includes its right
+edge, and samples outside of the range (or that are not finite) are dropped.
+"""
+from itertools import zip_longest
+from typing import Iterable, Iterator, Optional, Sequence, Union
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 1 << 16  # Samples binned at a time (as np.histogram does, the temporaries stay in cache)
+HISTNORMS = ('', 'percent', 'probability', 'density', 'probability density')  # As supported by plotly histograms
+
+Samples = Union[np.ndarray, list, tuple, Iterable[np.ndarray]]
+Bins = Union[int, Sequence[float], np.ndarray]
+
+
+def _is_chunked(values: Samples) -> bool:
+    # Arrays, lists, and tuples hold the samples themselves, anything else is taken to be an iterable of chunks:
+    return not isinstance(values, (np.ndarray, list, tuple))
+
+
+def _chunks(values: Samples, chunk_size: int) -> Iterator[np.ndarray]:
+    if _is_chunked(values):
+        for chunk in values:
+            yield np.asarray(chunk, dtype=np.float64).ravel()
+        return
+    values = values if isinstance(values, np.ndarray) else np.asarray(values)
+    values = values.reshape(-1)  # A view, so a np.memmap is still only read in one chunk at a time
+    for start in range(0, len(values), chunk_size):
+        yield np.asarray(values[start:start + chunk_size], dtype=np.float64)
+
+
+def _zip_chunks(*samples: Optional[Samples], chunk_size: int) -> Iterator[tuple]:
+    # Steps through the chunks of x, y (and weights) together. None (e.g. no weights) yields None for every chunk:
+    iterators = [None if s is None else _chunks(s, chunk_size) for s in samples]
+    missing = object()  # zip would silently stop at the shortest samples, so we step through all of them
+    for chunks in zip_longest(*(it for it in iterators if it is not None), fillvalue=missing):
+        if any(c is missing for c in chunks) or len({len(c) for c in chunks}) > 1:
+            raise Exception('The samples (and weights) passed in must all have the same length.')
+        chunks = iter(chunks)
+        yield tuple(None if it is None else next(chunks) for it in iterators)
+
+
+def data_range(values: Samples, chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple:
+    """
+    Returns the (min, max) of the finite samples, reading them one chunk at a time.
+    """
+    if _is_chunked(values):
+        raise Exception('The range of the bins (or the bin edges) must be given when the samples are passed in as an '
+                        'iterable of chunks, as they can only be read once.')
+    lo, hi = np.inf, -np.inf
+    for chunk in _chunks(values, chunk_size):
+        chunk = chunk[np.isfinite(chunk)]
+        if len(chunk):
+            lo, hi = min(lo, chunk.min()), max(hi, chunk.max())
+    if lo > hi:  # No (finite) samples, np.histogram uses a range of (0, 1) here
+        return 0., 1.
+    return float(lo), float(hi)
+
+
+def bin_edges(bins: Bins, values: Samples, bin_range: Optional[tuple] = None,
+              chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """
+    Returns the bin edges for bins (a number of equal-width bins spanning bin_range, which defaults to the range of the
+    samples, or the bin edges themselves).
+    """
+    if not np.isscalar(bins):
+        edges = np.asarray(bins, dtype=np.float64)
+        if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) < 0):
+            raise Exception('The bin edges must be a 1D, monotonically increasing sequence of at least two values.')
+        return edges
+    if int(bins) < 1:
+        raise Exception(f'The number of bins must be a positive integer, {bins} was passed in.')
+    lo, hi = bin_range if bin_range is not None else data_range(values, chunk_size)
+    if lo > hi:
+        raise Exception(f'Invalid bin range {bin_range}, the max must be larger than the min.')
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5  # Same as np.histogram
+    return np.linspace(lo, hi, int(bins) + 1)
+
+
+def _uniform(edges: np.ndarray) -> bool:
+    widths = np.diff(edges)
+    return bool(np.allclose(widths, widths[0], rtol=1e-12, atol=0))
+
+
+def bin_index(values: np.ndarray, edges: np.ndarray) -> tuple:
+    """
+    Returns the bin index of every sample along with the mask of the samples that fall inside of the bins.
+    """
+    n = len(edges) - 1
+    valid = (values >= edges[0]) & (values <= edges[-1])
+    inside = values[valid]
+    if _uniform(edges):
+        # Equal-width bins are indexed directly, with the same rounding fix-ups as np.histogram:
+        idx = ((inside - edges[0]) * (n / (edges[-1] - edges[0]))).astype(np.intp)
+        idx[idx == n] -= 1
+        idx[inside < edges[idx]] -= 1
+        idx[(inside >= edges[idx + 1]) & (idx != n - 1)] += 1
+    else:
+        idx = np.searchsorted(edges, inside, side='right') - 1
+        idx[idx == n] -= 1  # Samples on the last edge belong to the last bin
+    return idx, valid
+
+
+def histogram_counts(x: Samples, bins: Bins = 10, bin_range: Optional[tuple] = None,
+                     weights: Optional[Samples] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple:
+    """
+    Chunked equivalent of np.histogram(x, bins, bin_range, weights=weights).
+
+    :return: The counts (float64 if weights are given, int64 otherwise) and the bin edges
+    """
+    edges = bin_edges(bins, x, bin_range, chunk_size)
+    n = len(edges) - 1
+    counts = np.zeros(n, dtype=np.float64 if weights is not None else np.int64)
+    for x_chunk, w_chunk in _zip_chunks(x, weights, chunk_size=chunk_size):
+        idx, valid = bin_index(x_chunk, edges)
+        w = None if w_chunk is None else w_chunk[valid]
+        counts += np.bincount(idx, weights=w, minlength=n).astype(counts.dtype, copy=False)
+    return counts, edges
+
+
+def histogram2d_counts(x: Samples, y: Samples, bins: Union[Bins, tuple] = 10, bin_range: Optional[tuple] = None,
+                       weights: Optional[Samples] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple:
+    """
+    Chunked equivalent of np.histogram2d(x, y, bins, bin_range, weights=weights).
+
+    :param bins: The bins of both axes, or the (x bins, y bins) of each axis as a sequence of two (each either a number
+                 of bins or the bin edges). As with np.histogram2d, any sequence of two is taken to be per axis
+    :param bin_range: ((x min, x max), (y min, y max))
+    :return: The counts (indexed as counts[x bin, y bin], like np.histogram2d), the x bin edges, and the y bin edges
+    """
+    x_bins, y_bins = bins if not np.isscalar(bins) and len(bins) == 2 else (bins, bins)
+    x_range, y_range = bin_range if bin_range is not None else (None, None)
+    x_edges = bin_edges(x_bins, x, x_range, chunk_size)
+    y_edges = bin_edges(y_bins, y, y_range, chunk_size)
+    nx, ny = len(x_edges) - 1, len(y_edges) - 1
+    counts = np.zeros(nx * ny, dtype=np.float64 if weights is not None else np.int64)
+    for x_chunk, y_chunk, w_chunk in _zip_chunks(x, y, weights, chunk_size=chunk_size):
+        ix, x_valid = bin_index(x_chunk, x_edges)
+        iy, y_valid = bin_index(y_chunk, y_edges)
+        # Only the samples inside of both axes are counted, with one flat index per (x bin, y bin):
+        in_y = y_valid[x_valid]
+        in_x = x_valid[y_valid]
+        flat = ix[in_y] * ny + iy[in_x]
+        w = None if w_chunk is None else w_chunk[x_valid & y_valid]
+        counts += np.bincount(flat, weights=w, minlength=nx * ny).astype(counts.dtype, copy=False)
+    return counts.reshape(nx, ny), x_edges, y_edges
+
+
+def normalize(counts: np.ndarray, widths: np.ndarray, histnorm: str = '') -> np.ndarray:
+    """
+    Normalizes bin counts the way plotly's histnorm does. For 2D counts, widths holds the area of every bin.
+    """
+    if histnorm not in HISTNORMS:
+        raise Exception(f'Invalid histnorm {histnorm}, only options are: {HISTNORMS}')
+    if not histnorm:
+        return counts
+    total = counts.sum()
+    total = total if total != 0 else 1
+    if histnorm == 'percent':
+        return counts * (100. / total)
+    elif histnorm == 'probability':
+        return counts / total
+    elif histnorm == 'density':
+        return counts / widths
+    return counts / (total * widths)
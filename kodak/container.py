@@ -0,0 +1,216 @@
+"""
+This script holds the binary container alternative to the (JSON text) ".plots" file. A container holds:
+    - A small header (magic bytes, container version, and the length of the manifest)
+    - A JSON manifest with every plot (titles, descriptions, layouts, ...) where each numeric array is replaced by a
+      reference into the shared arrays table (see plots_format.ArrayTable), along with the shared layouts table and the
+      columnar design maps (see kodak.design_store)
+    - The arrays themselves as raw little-endian blocks, each aligned to 64 bytes
+
+An uncompressed container (".kplots") is read through np.memmap so the arrays are never copied (or even read) until they
+are used. The whole container can also be streamed through gzip (".kplots.gz") or zstd (".kplots.zst", requires the
+zstandard package), in which case it is decompressed into memory on read.
+"""
+import gzip
+import json
+import struct
+import base64
+from collections.abc import Mapping
+from typing import Iterator, Optional
+import numpy as np
+from kodak.plots_format import (ARRAYS_KEY, ARRAY_REF, DESIGNS_KEY, LAYOUTS_KEY, PLOTS_FORMAT_VERSION, VERSION_KEY,
+                                ArrayTable, decode_array, dumps, encode_value, file_version, is_array_block,
+                                plot_keys, referenced_arrays, referenced_layouts)
+
+MAGIC = b'KODAKPLT'
+CONTAINER_VERSION = 1
+ALIGNMENT = 64
+_HEADER = struct.Struct('<8sIQ')  # magic, container version, manifest length
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSIONS = (None, 'gzip', 'zstd')
+
+
+def _padding(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('The zstandard package is required for zstd compressed containers, please pip install it or use '
+                        'compression="gzip" instead.')
+    return zstandard
+
+
+def _with_refs(value, arrays: ArrayTable):
+    # Swaps every inline typed-array block for a reference into the shared arrays table:
+    if is_array_block(value):
+        return {ARRAY_REF: arrays.add(value['dtype'], value.get('shape', ''), base64.b64decode(value['bdata']))}
+    elif isinstance(value, dict):
+        return {k: _with_refs(v, arrays) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_with_refs(v, arrays) for v in value]
+    return value
+
+
+def _manifest_entry(entry, arrays: ArrayTable):
+    # Version 1 plots hold the figure as a JSON string, which is parsed (and its arrays packed) here:
+    if isinstance(entry, dict) and isinstance(entry.get('_data'), str):
+        entry = dict(entry, _data=encode_value(json.loads(entry['_data']), arrays=arrays))
+    return _with_refs(entry, arrays)
+
+
+def _as_array(value) -> np.ndarray:
+    return value if isinstance(value, np.ndarray) else decode_array(value)
+
+
+class ContainerArrays(Mapping):
+    """
+    Read-only mapping of the arrays held by a container. Each array is a view into the (memory-mapped) container file.
+    """
+    def __init__(self, buffer: np.ndarray, table: dict, data_start: int) -> None:
+        self._buffer = buffer
+        self._table = table
+        self._data_start = data_start
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        info = self._table[key]
+        start = self._data_start + info['offset']
+        raw = self._buffer[start:start + info['nbytes']]
+        return raw.view(np.dtype(info['dtype']).newbyteorder('<')).reshape(info['shape'])
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._table
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(info['nbytes'] for info in self._table.values())
+
+
+def write_container(filepath: str, plots: Mapping, arrays: Optional[Mapping] = None,
+                    version: int = PLOTS_FORMAT_VERSION, compression: Optional[str] = None,
+                    layouts: Optional[Mapping] = None, designs: Optional[dict] = None) -> None:
+    """
+    Writes plots out to a container file.
+
+    :param filepath: Full path of the file to write
+    :param plots: Mapping of the plots to write (e.g. KodakPlots.all_plots)
+    :param arrays: The shared arrays referenced by the plots (e.g. KodakPlots.array_table)
+    :param version: The .plots format version of the plots
+    :param compression: None, 'gzip', or 'zstd'
+    :param layouts: The shared layouts referenced by the plots (e.g. KodakPlots.layout_table)
+    :param designs: The '_designs' block of the plots (e.g. KodakPlots.designs.encode())
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception(f'Invalid compression {compression}, only options are: {COMPRESSIONS}')
+    table = ArrayTable(base=arrays)
+    # A lazily read file (see plots_reader.LazyPlots) is walked without holding on to every parsed plot:
+    items = plots.parsed_items() if hasattr(plots, 'parsed_items') else plots.items()
+    manifest_plots = {key: _manifest_entry(plot, table) for key, plot in items}
+    layouts = layouts or {}
+    manifest_layouts = {k: _with_refs(layouts[k], table) for k in sorted(referenced_layouts(manifest_plots))}
+    manifest_designs = _with_refs(designs, table) if designs else None
+    used = referenced_arrays([manifest_plots, manifest_layouts, manifest_designs])
+    order = [k for k in table if k in used] + sorted(k for k in used if k not in table)
+
+    # Lay out the array blocks before writing anything so that the manifest holds their offsets:
+    blocks, offset, array_table = [], 0, {}
+    for key in order:
+        arr = np.ascontiguousarray(_as_array(table[key]))
+        arr = arr.astype(arr.dtype.newbyteorder('<'), copy=False)
+        offset += _padding(offset)
+        array_table[key] = {'dtype': arr.dtype.str[1:], 'shape': list(arr.shape), 'offset': offset,
+                            'nbytes': arr.nbytes}
+        blocks.append((offset, arr))
+        offset += arr.nbytes
+    manifest = {'version': version, 'plots': manifest_plots, 'layouts': manifest_layouts, 'arrays': array_table}
+    if manifest_designs:
+        manifest['designs'] = manifest_designs
+    manifest = dumps(manifest, separators=(',', ':')).encode()
+
+    raw_file = open(filepath, 'wb')
+    if compression == 'gzip':
+        f = gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6)
+    elif compression == 'zstd':
+        f = _zstandard().ZstdCompressor().stream_writer(raw_file)
+    else:
+        f = raw_file
+    try:
+        header_length = _HEADER.size + len(manifest)
+        f.write(_HEADER.pack(MAGIC, CONTAINER_VERSION, len(manifest)))
+        f.write(manifest)
+        f.write(b'\0' * _padding(header_length))
+        written = 0
+        for start, arr in blocks:
+            f.write(b'\0' * (start - written))
+            f.write(memoryview(arr.reshape(-1)).cast('B'))
+            written = start + arr.nbytes
+    finally:
+        f.close()
+        if f is not raw_file:
+            raw_file.close()
+
+
+def read_container(filepath: str) -> tuple:
+    """
+    Reads a container file.
+
+    :return: The .plots format version, a dictionary of the plots (referencing shared arrays), the ContainerArrays, the
+             dictionary of shared layouts, and the '_designs' block (None if the container has no columnar designs)
+    """
+    with open(filepath, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        with gzip.open(filepath, 'rb') as f:
+            buffer = np.frombuffer(f.read(), dtype=np.uint8)
+    elif magic == _ZSTD_MAGIC:
+        with open(filepath, 'rb') as f:
+            buffer = np.frombuffer(_zstandard().ZstdDecompressor().stream_reader(f).read(), dtype=np.uint8)
+    else:
+        buffer = np.memmap(filepath, dtype=np.uint8, mode='r')
+
+    magic, container_version, manifest_length = _HEADER.unpack(bytes(buffer[:_HEADER.size]))
+    if magic != MAGIC:
+        raise Exception(f'{filepath} is not a kodak container file.')
+    if container_version > CONTAINER_VERSION:
+        raise Exception(f'{filepath} was written by a newer version of kodak (container version {container_version}).')
+    header_length = _HEADER.size + manifest_length
+    manifest = json.loads(bytes(buffer[_HEADER.size:header_length]))
+    data_start = header_length + _padding(header_length)
+    return (manifest['version'], manifest['plots'], ContainerArrays(buffer, manifest['arrays'], data_start),
+            manifest.get('layouts', {}), manifest.get('designs'))
+
+
+def plots_to_container(plots_path: str, container_path: str, compression: Optional[str] = None) -> None:
+    """
+    Converts a .plots file (any version) into a container file.
+    """
+    with open(plots_path, 'r') as f:
+        contents = json.load(f)
+    plots = {k: contents[k] for k in plot_keys(contents)}
+    version = max(file_version(contents), PLOTS_FORMAT_VERSION)
+    write_container(container_path, plots, contents.get(ARRAYS_KEY) or {}, version, compression,
+                    contents.get(LAYOUTS_KEY), contents.get(DESIGNS_KEY))
+
+
+def container_to_plots(container_path: str, plots_path: str, indent: Optional[int] = None) -> None:
+    """
+    Converts a container file back into a (version 2) .plots file, where every array ends up in the '_arrays' table.
+    """
+    version, plots, arrays, layouts, designs = read_container(container_path)
+    table = ArrayTable(base=arrays)
+    output = {VERSION_KEY: version, **plots}
+    if designs:
+        output[DESIGNS_KEY] = designs  # Its arrays are referenced from the '_arrays' table as well
+    if layouts:
+        output[LAYOUTS_KEY] = layouts
+    output[ARRAYS_KEY] = {k: table.block(k) for k in arrays}
+    with open(plots_path, 'w') as f:
+        f.write(dumps(output, indent=indent, separators=(',', ':') if indent is None else None))
@@ -0,0 +1,447 @@
+"""
+This script holds the columnar store used for the design maps passed to KodakPlots.store_interactive_points (when
+KodakPlots.columnar_designs is True). Rather than keeping one dictionary (of lists of lists, ...) per design, every
+field of the design maps becomes a column:
+    - Numeric fields (scalars, or rectangular arrays such as a list of vertices) are concatenated into one numpy array
+      per field, with an offsets table marking where each design starts (i.e. a ragged array)
+    - Anything else (strings, nested dictionaries, ragged lists, ...) is kept as a list of Python objects
+
+The store is written to a .plots file as one block under the '_designs' key:
+    {'chunks': [{'ids': ..., 'fields': {name: {...}, ...}}, ...], 'removed': [...]}
+where each chunk holds the columns of a run of designs as typed-array blocks, and removed lists the ids of designs which
+were removed after their chunk was written (only used by the append-only log).
+"""
+import sys
+from collections.abc import Mapping
+from typing import Any, Iterator, Optional, Union
+import numpy as np
+from kodak.plots_format import decode_value, encode_value
+
+DESIGN_PREFIX = 'INTERACTIVE_DESIGN_'
+_MISSING = object()  # Marks a design that does not hold a field
+
+
+def design_key(design_id: Union[int, str]) -> str:
+    return f'{DESIGN_PREFIX}{design_id}'
+
+
+def design_id(key: str) -> Optional[int]:
+    # Returns the id of an INTERACTIVE_DESIGN key (or None if key is not one):
+    if not key.startswith(DESIGN_PREFIX):
+        return None
+    try:
+        return int(key[len(DESIGN_PREFIX):])
+    except ValueError:
+        return None
+
+
+def _as_array(value: Any) -> Optional[np.ndarray]:
+    # Returns value as a numeric (or boolean) array, or None if it has to be stored as a Python object:
+    if value is None or isinstance(value, (str, bytes, dict)):
+        return None
+    try:
+        arr = np.asarray(value)
+    except (ValueError, TypeError):  # e.g. a ragged list of lists
+        return None
+    return arr if arr.dtype.kind in 'biuf' else None
+
+
+def _row_shape(arr: np.ndarray) -> tuple:
+    # Scalars have the shape (), and arrays (-1, ...) since the length along the first axis may differ between designs:
+    return () if arr.ndim == 0 else (-1,) + arr.shape[1:]
+
+
+def _encode(arr: np.ndarray) -> Any:
+    return encode_value(arr.astype(np.uint8) if arr.dtype.kind == 'b' else arr, threshold=0)
+
+
+def _decode(value: Any, dtype: Union[str, np.dtype], row_shape: tuple = (), arrays: Optional[Mapping] = None):
+    arr = np.asarray(decode_value(value, arrays=arrays), dtype=dtype)
+    return arr.reshape((-1,) + tuple(row_shape[1:]))
+
+
+def _as_list(value: Any) -> Any:
+    # Swaps the numpy arrays inside of value for plain lists:
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    elif isinstance(value, dict):
+        return {k: _as_list(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_as_list(v) for v in value]
+    return value
+
+
+class _Growable(object):
+    """
+    Numpy array with amortized O(1) appends along its first axis.
+    """
+    def __init__(self, dtype: Union[str, np.dtype], inner_shape: tuple = ()) -> None:
+        self._data = np.empty((16,) + tuple(inner_shape), dtype=dtype)
+        self.size = 0
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._data[:self.size]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    def extend(self, values: np.ndarray) -> None:
+        end = self.size + len(values)
+        if end > len(self._data):
+            data = np.empty((max(end, 2 * len(self._data)),) + self._data.shape[1:], dtype=self._data.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:end] = values
+        self.size = end
+
+    def append(self, value: Any) -> None:
+        if self.size == len(self._data):
+            self.extend(np.asarray([value], dtype=self._data.dtype))
+        else:
+            self._data[self.size] = value
+            self.size += 1
+
+    def astype(self, dtype: np.dtype) -> None:
+        self._data = self._data.astype(dtype)
+
+
+class _ArrayColumn(object):
+    """
+    A numeric field stored as a ragged array: the values of row i are values[offsets[i]:offsets[i + 1]]. Rows which were
+    added as integers are flagged in ints, so that they still come back as integers once the column has been promoted to
+    floats by a later row.
+    """
+    def __init__(self, dtype: Union[str, np.dtype], row_shape: tuple, n_rows: int = 0) -> None:
+        self.row_shape = tuple(row_shape)
+        self.values = _Growable(dtype, self.row_shape[1:])
+        self.offsets = _Growable(np.int64)
+        self.offsets.extend(np.zeros(n_rows + 1, dtype=np.int64))
+        self.present = _Growable(np.bool_)
+        self.present.extend(np.zeros(n_rows, dtype=np.bool_))
+        self.ints = _Growable(np.bool_)
+        self.ints.extend(np.zeros(n_rows, dtype=np.bool_))
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.offsets.nbytes + self.present.nbytes + self.ints.nbytes
+
+    def accepts(self, dtype: np.dtype, row_shape: tuple) -> bool:
+        # Integers and floats may be mixed (the column is promoted), booleans are kept apart so they stay booleans:
+        return tuple(row_shape) == self.row_shape and (dtype.kind == 'b') == (self.values.dtype.kind == 'b')
+
+    def _promote(self, dtype: np.dtype) -> None:
+        if dtype == self.values.dtype:
+            return
+        promoted = np.result_type(self.values.dtype, dtype)
+        if promoted != self.values.dtype:
+            self.values.astype(promoted)
+
+    def append(self, arr: np.ndarray) -> None:
+        self._promote(arr.dtype)
+        self.values.extend(arr.reshape((-1,) + self.row_shape[1:]))
+        self.offsets.append(self.values.size)
+        self.present.append(True)
+        self.ints.append(arr.dtype.kind in 'iu')
+
+    def append_missing(self, n: int = 1) -> None:
+        self.offsets.extend(np.full(n, self.values.size, dtype=np.int64))
+        self.present.extend(np.zeros(n, dtype=np.bool_))
+        self.ints.extend(np.zeros(n, dtype=np.bool_))
+
+    def extend(self, values: np.ndarray, offsets: np.ndarray, present: np.ndarray,
+               ints: Optional[np.ndarray] = None) -> None:
+        # Without the ints flags (e.g. the column was written as integers), every row is as integer as the values are:
+        ints = np.full(len(present), values.dtype.kind in 'iu', dtype=np.bool_) if ints is None else ints
+        self._promote(values.dtype)
+        self.offsets.extend(offsets[1:] + self.values.size)
+        self.values.extend(values)
+        self.present.extend(present)
+        self.ints.extend(ints & present)
+
+    def _as_int(self, row: int) -> bool:
+        return self.values.dtype.kind == 'f' and bool(self.ints.view[row])
+
+    def get(self, row: int) -> Any:
+        if not self.present.view[row]:
+            return _MISSING
+        offsets = self.offsets.view
+        if not self.row_shape:
+            value = self.values.view[offsets[row]]
+            return int(value) if self._as_int(row) else value.item()
+        value = self.values.view[offsets[row]:offsets[row + 1]]
+        if self._as_int(row):
+            value = value.astype(np.int64)
+        value.flags.writeable = False  # A view into the column, so it should not be edited in-place
+        return value
+
+    def encode(self, rows: np.ndarray) -> dict:
+        offsets = self.offsets.view
+        starts, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+        new_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # Gathers the values of every row in one go, e.g. starts [4, 10] and lengths [2, 3] select 4, 5, 10, 11, 12:
+        index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+        field = {'dtype': self.values.dtype.name, 'shape': list(self.row_shape),
+                 'values': _encode(self.values.view[index]), 'offsets': _encode(new_offsets),
+                 'present': _encode(self.present.view[rows])}
+        ints = self.ints.view[rows]
+        if self.values.dtype.kind == 'f' and ints.any():
+            field['ints'] = _encode(ints)  # Only needed once integers were promoted to floats
+        return field
+
+    def to_objects(self) -> '_ObjectColumn':
+        return _ObjectColumn([self.get(row) for row in range(self.present.size)])
+
+
+class _ObjectColumn(object):
+    """
+    A field which can not be stored as a ragged numeric array, stored as one Python object per row.
+    """
+    def __init__(self, objects: list) -> None:
+        self.objects = objects
+
+    @property
+    def nbytes(self) -> int:
+        # Shallow size only, so this underestimates nested objects:
+        return sys.getsizeof(self.objects) + sum(sys.getsizeof(v) for v in self.objects if v is not _MISSING)
+
+    def append(self, value: Any) -> None:
+        self.objects.append(value)
+
+    def append_missing(self, n: int = 1) -> None:
+        self.objects.extend([_MISSING] * n)
+
+    def get(self, row: int) -> Any:
+        return self.objects[row]
+
+    def encode(self, rows: np.ndarray) -> dict:
+        objects = [self.objects[row] for row in rows.tolist()]
+        return {'objects': [None if v is _MISSING else encode_value(v) for v in objects],
+                'present': _encode(np.array([v is not _MISSING for v in objects], dtype=np.bool_))}
+
+
+class DesignStore(Mapping):
+    """
+    Columnar store of design maps keyed by their (integer) id, i.e. the n of INTERACTIVE_DESIGN_n:
+
+        store = DesignStore()
+        store.add(0, {'vertices': [[0, 0, 0], [1, 0, 0], [0, 1, 0]], 'edges': [[0, 1], [1, 2]], 'score': 0.5})
+        store[0]['vertices']  # -> 3x3 numpy array (a read-only view into the 'vertices' column)
+
+    Looking up a design is O(1) (the row of every id is held in an array indexed by id). Numeric fields come back as
+    numpy arrays (or Python scalars), use design(design_id, as_lists=True) to get plain lists back. The maps property is
+    a read-only view of the designs keyed by 'INTERACTIVE_DESIGN_n', i.e. how they are stored inside of all_plots when
+    KodakPlots.columnar_designs is False.
+
+    Note: Removed designs keep their row until the store is written out (only the remaining designs are written). A
+          numeric field mixing integers and floats across designs is stored as floats, but the designs added with
+          integers get them back as integers (exact up to 2**53).
+    """
+    def __init__(self) -> None:
+        self._columns = {}
+        self._ids = _Growable(np.int64)  # Id of the design held by each row
+        self._rows = _Growable(np.int64)  # Row of each id (-1 if there is no design with that id)
+        self._count = 0
+
+    def _row(self, design_id: int) -> int:
+        if not isinstance(design_id, (int, np.integer)) or not 0 <= design_id < self._rows.size:
+            return -1
+        return int(self._rows.view[design_id])
+
+    def _assign_rows(self, ids: np.ndarray, first_row: int) -> None:
+        if len(ids) and ids.min() < 0:
+            raise Exception('The ids of a DesignStore can not be negative.')
+        end = int(ids.max()) + 1 if len(ids) else 0
+        if end > self._rows.size:
+            self._rows.extend(np.full(end - self._rows.size, -1, dtype=np.int64))
+        rows = self._rows.view
+        self._count += len(ids) - int(np.count_nonzero(rows[ids] >= 0))
+        rows[ids] = np.arange(first_row, first_row + len(ids))
+
+    def add(self, design_id: int, design_map: dict) -> None:
+        """
+        Stores design_map under design_id (replacing the design currently held under design_id, if any).
+        """
+        row = self._ids.size
+        for name, column in self._columns.items():
+            if name not in design_map:
+                column.append_missing()
+        for name, value in design_map.items():
+            column = self._columns.get(name)
+            arr = _as_array(value) if not isinstance(column, _ObjectColumn) else None
+            if column is None:
+                column = _ArrayColumn(arr.dtype, _row_shape(arr), row) if arr is not None else \
+                    _ObjectColumn([_MISSING] * row)
+                self._columns[name] = column
+            elif isinstance(column, _ArrayColumn) and (arr is None or not column.accepts(arr.dtype, _row_shape(arr))):
+                column = self._columns[name] = column.to_objects()
+            column.append(arr if isinstance(column, _ArrayColumn) else value)
+        self._ids.append(design_id)
+        if 0 <= design_id < self._rows.size:
+            self._count += int(self._rows.view[design_id] < 0)
+            self._rows.view[design_id] = row
+        else:
+            self._assign_rows(np.array([design_id], dtype=np.int64), row)
+
+    def remove(self, design_id: int) -> None:
+        row = self._row(design_id)
+        if row < 0:
+            raise KeyError(design_id)
+        self._rows.view[design_id] = -1
+        self._count -= 1
+
+    def design(self, design_id: int, as_lists: bool = False) -> dict:
+        row = self._row(design_id)
+        if row < 0:
+            raise KeyError(design_id)
+        values = ((name, column.get(row)) for name, column in self._columns.items())
+        return {name: _as_list(v) if as_lists else v for name, v in values if v is not _MISSING}
+
+    def __getitem__(self, design_id: int) -> dict:
+        return self.design(design_id)
+
+    def __contains__(self, design_id: object) -> bool:
+        return self._row(design_id) >= 0
+
+    def _live_rows(self) -> np.ndarray:
+        ids = self._ids.view
+        return np.flatnonzero(self._rows.view[ids] == np.arange(len(ids)))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids.view[self._live_rows()].tolist())
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def n_rows(self) -> int:
+        # Number of rows held, including those of designs which were removed / replaced since:
+        return self._ids.size
+
+    @property
+    def max_id(self) -> int:
+        return int(self._ids.view.max()) if self._ids.size else -1
+
+    @property
+    def maps(self) -> 'DesignMaps':
+        return DesignMaps(self)
+
+    def memory_usage(self) -> dict:
+        """
+        Returns the number of bytes allocated by the store, in total and per field (object fields are estimated).
+        """
+        columns = {name: column.nbytes for name, column in self._columns.items()}
+        index = self._ids.nbytes + self._rows.nbytes
+        return {'designs': len(self), 'rows': self.n_rows, 'total_bytes': index + sum(columns.values()),
+                'index_bytes': index, 'columns': columns}
+
+    def encode_chunk(self, start_row: int = 0) -> dict:
+        """
+        Returns the columns of the designs held from start_row onwards (e.g. those added since the store was last
+        written out) as one chunk of typed-array blocks.
+        """
+        rows = self._live_rows()
+        rows = rows[rows >= start_row]
+        return {'ids': _encode(self._ids.view[rows]),
+                'fields': {name: column.encode(rows) for name, column in self._columns.items()}}
+
+    def encode(self) -> dict:
+        """
+        Returns the '_designs' entry of a .plots file holding every design.
+        """
+        return {'chunks': [self.encode_chunk()], 'removed': []}
+
+    def add_chunk(self, chunk: dict, arrays: Optional[Mapping] = None) -> None:
+        """
+        Appends the designs of a chunk written by encode_chunk. The arrays are the shared '_arrays' table used to
+        resolve references in the chunk (see kodak.container).
+        """
+        ids = _decode(chunk['ids'], np.int64, arrays=arrays)
+        first_row = self._ids.size
+        for name, column in self._columns.items():
+            if name not in chunk['fields']:
+                column.append_missing(len(ids))
+        for name, field in chunk['fields'].items():
+            column = self._columns.get(name)
+            present = _decode(field['present'], np.bool_, arrays=arrays)
+            if 'objects' in field:
+                new = _ObjectColumn([decode_value(v, arrays=arrays) if p else _MISSING
+                                     for v, p in zip(field['objects'], present.tolist())])
+            else:
+                dtype, row_shape = np.dtype(field['dtype']), tuple(field['shape'])
+                values = _decode(field['values'], dtype, row_shape, arrays)
+                offsets = _decode(field['offsets'], np.int64, arrays=arrays)
+                ints = _decode(field['ints'], np.bool_, arrays=arrays) if 'ints' in field else None
+                if column is None or (isinstance(column, _ArrayColumn) and column.accepts(dtype, row_shape)):
+                    column = column if column is not None else _ArrayColumn(dtype, row_shape, first_row)
+                    column.extend(values, offsets, present, ints)
+                    self._columns[name] = column
+                    continue
+                new = _ArrayColumn(dtype, row_shape)
+                new.extend(values, offsets, present, ints)
+                new = new.to_objects()
+            if column is None:
+                column = _ObjectColumn([_MISSING] * first_row)
+            elif isinstance(column, _ArrayColumn):
+                column = column.to_objects()
+            column.objects.extend(new.objects)
+            self._columns[name] = column
+        self._ids.extend(ids)
+        self._assign_rows(ids, first_row)
+
+    @classmethod
+    def decode(cls, entry: dict, arrays: Optional[Mapping] = None) -> 'DesignStore':
+        """
+        Builds a store from the '_designs' entry of a .plots file (the inverse of encode).
+        """
+        store = cls()
+        for chunk in entry.get('chunks', []):
+            store.add_chunk(chunk, arrays)
+        for removed in entry.get('removed', []):
+            if removed in store:
+                store.remove(removed)
+        return store
+
+
+def design_ids(entry: dict, arrays: Optional[Mapping] = None) -> np.ndarray:
+    """
+    Returns the id of every design written to a '_designs' entry (including removed ones) without decoding the designs.
+    """
+    ids = [_decode(chunk['ids'], np.int64, arrays=arrays) for chunk in entry.get('chunks', [])]
+    return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+
+def offset_design_ids(entry: dict, offset: int, arrays: Optional[Mapping] = None) -> dict:
+    """
+    Returns a copy of a '_designs' entry with offset added to every design id (e.g. when merging the designs of many
+    files, see kodak.merge). The columns are copied over as they are.
+    """
+    chunks = [dict(chunk, ids=_encode(_decode(chunk['ids'], np.int64, arrays=arrays) + offset))
+              for chunk in entry.get('chunks', [])]
+    return {'chunks': chunks, 'removed': [design + offset for design in entry.get('removed', [])]}
+
+
+class DesignMaps(Mapping):
+    """
+    Read-only view of a DesignStore keyed by 'INTERACTIVE_DESIGN_n', with the numeric fields as plain lists. This is the
+    same mapping store_interactive_points creates inside of all_plots when KodakPlots.columnar_designs is False.
+    """
+    def __init__(self, store: DesignStore) -> None:
+        self.store = store
+
+    def __getitem__(self, key: str) -> dict:
+        design = design_id(key) if isinstance(key, str) else None
+        if design is None or design not in self.store:
+            raise KeyError(key)
+        return self.store.design(design, as_lists=True)
+
+    def __iter__(self) -> Iterator[str]:
+        return (design_key(i) for i in self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
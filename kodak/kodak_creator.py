@@ -3,15 +3,118 @@ This script will allow users to create / edit JSON files for the kodak visualiza
 
 Note: Not all plot types are yet supported and this is actively being developed (thus why this project is not on PyPi
       yet).
+
+Note: Plotly is only imported once a trace, layout, or figure is actually built, so reading / editing / writing out
+      .plots files (and creating a KodakPlots) does not pay for importing it.
 """
+from __future__ import annotations
 import os
 import json
 import warnings
-from typing import Optional, Union
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, Optional, Union
 import numpy as np
 from dataclasses import dataclass
-from kodak.trace_types import PlotTrace, scatter, scatter3d
-import plotly.graph_objs as go
+from kodak.trace_types import (PlotTrace, TraceRecord, density_contour, heatmap, histogram, histogram2d, scatter,
+                               scatter3d, set_trace_property)
+from kodak.plots_writer import PlotsStreamWriter, compact_plots_file
+from kodak.plots_reader import LazyPlots
+from kodak.background import BackgroundExporter
+from kodak.design_store import DesignStore, design_id, design_key
+from kodak.lod import LODSettings, downsample_trace
+from kodak.container import read_container, write_container
+from kodak.layout_templates import layout_dict, serialized_layout
+from kodak.plots_format import (ARRAYS_KEY, DESIGNS_KEY, LAYOUTS_KEY, LAYOUT_REF, PLOTS_FORMAT_VERSION, VERSION_KEY,
+                                ArrayTable, TrackedPlots, append_segment, apply_segments, dumps, encode_value,
+                                figure_dict, file_version, log_path, plot_keys, read_segments, referenced_arrays,
+                                referenced_layouts, sync_directory, sync_file)
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+    import plotly.graph_objs as go
+
+# Color-blind safe color map from: https://personal.sron.nl/~pault/ (Cyan, Teal, Green, Olive, Sand, Rose, Wine, Purple)
+TOL_COLORS = ('rgb(136, 204, 238)', 'rgb(68, 170, 153)', 'rgb(17, 119, 51)', 'rgb(153, 153, 51)', 'rgb(221, 204, 119)',
+              'rgb(204, 102, 119)', 'rgb(136, 34, 85)', 'rgb(170, 68, 153)')
+MARKER_SYMBOLS = ('circle', 'square', 'diamond', 'x', 'cross')
+LINE_DASHES = ('solid', 'dash', 'dot', 'dashdot')
+COLORSCALE = 'Viridis'  # Perceptually uniform (and color-blind safe) default for heatmaps / contours
+_BINNED_TYPES = ('histogram', 'histogram2d', 'heatmap', 'histogram2dcontour')  # Pre-aggregated (so skipped by the lod)
+_MANY_TRACES_WARNING = 'Note: You have many traces in one figure so re-using colors. Reminder that this is an ' \
+                       'academic-minded package, do you want more than 8 traces on one plot?'
+
+
+def serialize_figure(fig: go.Figure, plots_version: int = PLOTS_FORMAT_VERSION,
+                     arrays: Optional[ArrayTable] = None) -> Union[str, dict]:
+    # Version 1 files hold the figure as a JSON string, whereas version 2 embeds the figure as a nested object with
+    # the large numeric arrays packed into typed-array blocks (or stored in the shared arrays table, if given):
+    if plots_version < 2:
+        return fig.to_json()
+    return encode_value(fig.to_plotly_json(), arrays=arrays)
+
+
+def _trace_style(plotly_trace: Union[go.Scatter, go.Scatter3d, go.Bar, go.Heatmap, go.Contour, TraceRecord]) -> tuple:
+    # Returns the mode, marker color, line color, and colorscale of a trace. Plotly traces are read through their
+    # (already validated) properties dictionary, as going through plotly's property machinery creates the marker / line
+    # objects:
+    props = plotly_trace if isinstance(plotly_trace, TraceRecord) else plotly_trace._props or {}
+    return props.get('mode'), (props.get('marker') or {}).get('color'), (props.get('line') or {}).get('color'), \
+        props.get('colorscale')
+
+
+def _default_style(trace_type: str, mode: Optional[str], marker_color, line_color, colorscale) -> Optional[str]:
+    # Returns which property ('marker', 'line', 'bar', or 'colorscale') of a trace gets the default style, if any:
+    if trace_type == 'histogram':
+        return 'bar' if marker_color is None else None
+    elif trace_type in _BINNED_TYPES:
+        return 'colorscale' if colorscale is None else None
+    if marker_color is None and line_color is None:
+        if mode in ('markers', 'markers+lines', 'lines+markers'):
+            return 'marker'
+        elif mode == 'lines':
+            return 'line'
+        return None
+    elif marker_color is None:
+        return 'marker'
+    elif line_color is None:
+        return 'line'
+    return None
+
+
+def _marker_style(trace_idx: int) -> dict:
+    # Note: The keys are in the order plotly writes them out
+    return dict(color=TOL_COLORS[trace_idx % len(TOL_COLORS)], line=dict(color='DarkSlateGrey', width=2), size=8,
+                symbol=MARKER_SYMBOLS[trace_idx % len(MARKER_SYMBOLS)])
+
+
+def _line_style(trace_idx: int) -> dict:
+    return dict(color=TOL_COLORS[trace_idx % len(TOL_COLORS)], dash=LINE_DASHES[trace_idx % len(LINE_DASHES)], width=2)
+
+
+def _bar_style(trace_idx: int) -> dict:
+    return dict(color=TOL_COLORS[trace_idx % len(TOL_COLORS)], line=dict(color='DarkSlateGrey', width=1))
+
+
+def _trace_json(plotly_trace: Union[go.Scatter, go.Scatter3d, TraceRecord, dict]) -> dict:
+    # Returns the plotly json of a trace (what go.Figure(data=[plotly_trace]) holds). Fast traces are validated by plotly
+    # here, whereas plain dictionaries are taken to already be the plotly json of a (validated) trace:
+    if isinstance(plotly_trace, TraceRecord):
+        return plotly_trace.validate().to_plotly_json()
+    elif isinstance(plotly_trace, dict):
+        return plotly_trace
+    return plotly_trace.to_plotly_json()
+
+
+def _serialize_figure_job(job: tuple) -> tuple:
+    # Runs inside of a worker process for add_new_plots, so everything is passed in as plain (picklable) dictionaries.
+    # Shared arrays go into a local table which gets merged into the table of the KodakPlots afterward:
+    data, layout, plots_version, share_arrays = job
+    arrays = ArrayTable() if share_arrays else None
+    if plots_version >= 2:
+        # The (cached) layout is added back in by the main process:
+        return encode_value({'data': [_trace_json(t) for t in data]}, arrays=arrays), arrays
+    import plotly.graph_objs as go
+    return serialize_figure(go.Figure(data=data, layout=layout), plots_version, arrays), arrays
 
 
 @dataclass
@@ -19,16 +122,27 @@ class KodakPlots(object):
     # Default parameters a user can change:
     font_style = 'Helvetica'  # Options include: Open Sans, veerdana, arial, sans-serif (probably others, check plotly)
     default_font_color = 'black'
+    plots_version: int = PLOTS_FORMAT_VERSION  # Version of the .plots file written out (1 = legacy JSON string _data)
+    fast_traces: bool = False  # If True, the trace methods (e.g. scatter_plot) create dict-backed traces (TraceRecord)
+    validate_fast_traces: bool = True  # If False, fast traces skip plotly validation altogether when a plot is added
+    lod: Optional[LODSettings] = None  # Level-of-detail downsampling of large traces (off unless LODSettings are given)
+    share_arrays: bool = False  # If True, identical arrays are stored once in the shared '_arrays' table of the file
+    share_layouts: bool = False  # If True, each distinct layout is stored once in the '_layouts' table of the file
+    columnar_designs: bool = False  # If True, store_interactive_points keeps the designs in a DesignStore (see designs)
 
     """
     These methods create the "default" layout for the various plots that Kodak supports using a plotly layout.
     Note: These methods are the "backend" of Kodak because they enable an Academic-style default layout using Plotly
+    Note: The layouts are memoized by their arguments (see layout_templates.layout_dict), and every call returns a new
+          go.Layout created from the memoized layout, so the layout returned can be edited freely.
     """
     def create_2d_layout(self, linecolor: str = 'rgba(0, 0, 0, 1)', tick_font_size: int = 16, title_font_size: int = 18,
                          linewidth: float = 2., mirror_line: bool = True, showgrid: bool = False, gridcolor: str = 'black',
                          zeroline: bool = False, plot_bgcolor='rgba(0, 0, 0, 0)', paper_bgcolor='rgba(255,255,255, 1)'):
-
-        return go.Layout(
+        import plotly.graph_objs as go
+        key = ('2d', self.font_style, self.default_font_color, linecolor, tick_font_size, title_font_size, linewidth,
+               mirror_line, showgrid, gridcolor, zeroline, plot_bgcolor, paper_bgcolor)
+        return go.Layout(layout_dict(key, lambda: go.Layout(
             height=318,
             width=521,
             xaxis=dict(
@@ -55,14 +169,17 @@ class KodakPlots(object):
             plot_bgcolor=plot_bgcolor,
             paper_bgcolor=paper_bgcolor,
             autosize=False
-        )
+        )))
 
 
     def create_3d_layout(self, display_background: bool = False, tick_font_size: int = 16, axis_font_size: int = 18,
                          backgroundcolor: str = 'rgba(0, 0, 0, 0)', plot_bgcolor: str = 'rgba(0, 0, 0, 0)',
                          paper_bgcolor: str = 'rgba(0, 0, 0, 0)', showticklabels: bool = False, showgrid: bool = False,
                          gridcolor: str = 'black', zerolinewidth: float = 0.):
-        return go.Layout(
+        import plotly.graph_objs as go
+        key = ('3d', self.font_style, self.default_font_color, display_background, tick_font_size, axis_font_size,
+               backgroundcolor, plot_bgcolor, paper_bgcolor, showticklabels, showgrid, gridcolor, zerolinewidth)
+        return go.Layout(layout_dict(key, lambda: go.Layout(
             scene=dict(
                 xaxis_visible=display_background,
                 yaxis_visible=display_background,
@@ -105,19 +222,85 @@ class KodakPlots(object):
             plot_bgcolor=plot_bgcolor,
             paper_bgcolor=paper_bgcolor,
             margin=dict(l=0, r=0, b=0, t=0)
-        )
+        )))
 
 
     def __post_init__(self) -> None:
-        self.all_plots = {}  # Dictionary that gets written out
+        self._unsaved, self._removed = {}, {}  # See _set_saved_state
+        self.all_plots = {}  # Dictionary that gets written out (as a TrackedPlots, see the all_plots setter)
         self.id_count = -1  # Initialize interactive design chart count to -1 since get_id_count will bring to 0
+        self._writer = None  # Set while stream_json_output is active so that plots are written out immediately
+        self._exporter = None  # Set while a BackgroundExporter is running (see start_background_export)
+        self.lod_reports = {}  # Stores how many points were kept for each downsampled trace (keyed by window title)
+        self.array_table = ArrayTable()  # Shared arrays referenced by the plots (see plots_format.ArrayTable)
+        self.layout_table = {}  # Shared layouts referenced by the plots (only used if share_layouts is True)
+        self.designs = DesignStore()  # Columnar design maps (only used if columnar_designs is True, or read in)
+        self._set_saved_state(None)  # Tracks what append_json_output still has to write out
+
+        # Here is a running list of supported plotly plot types in kodak. These are the plot.type value:
+        self.currently_supported = ['scatter', 'scatter3d', 'histogram', 'histogram2d', 'heatmap', 'histogram2dcontour']
+
+        ## The standard default layouts for all plot styles are created on first use (see standard_2D_layout):
+        self._standard_2D_layout = None
+        self._standard_3D_layout = None
+
 
-        self.currently_supported = ['scatter', 'scatter3d']  # Here is a running list of supported plotly plot types in
-                                                             # kodak. These are the plot.type value.
+    @property
+    def all_plots(self) -> Union[TrackedPlots, LazyPlots]:
+        return self._all_plots
 
-        ## Creating standard default layouts for all plot styles:
-        self.standard_2D_layout = self.create_2d_layout()
-        self.standard_3D_layout = self.create_3d_layout()
+
+    @all_plots.setter
+    def all_plots(self, plots: Union[dict, LazyPlots]) -> None:
+        # Plots set / removed directly on all_plots (rather than through add_new_plot, remove_plot, ...) are tracked as
+        # well, so that append_json_output also writes them out:
+        if not isinstance(plots, (TrackedPlots, LazyPlots)):
+            plots = TrackedPlots(plots)
+        old = getattr(self, '_all_plots', None)
+        if old is not None:
+            old.listener = None
+            for key in old:
+                if key not in plots:
+                    self._plot_changed(key, True)
+        for key in plots:
+            self._plot_changed(key, False)
+        plots.listener = self._plot_changed
+        self._all_plots = plots
+
+
+    def _plot_changed(self, key: str, removed: bool) -> None:
+        # Listener of all_plots, which records what append_json_output still has to write out:
+        if removed:
+            self._unsaved.pop(key, None)
+            self._removed[key] = None
+        else:
+            self._unsaved[key] = None
+            self._removed.pop(key, None)
+
+
+    @property
+    def standard_2D_layout(self) -> go.Layout:
+        # Each KodakPlots gets its own copy (built from the memoized plotly JSON), so editing it in place is fine:
+        if self._standard_2D_layout is None:
+            self._standard_2D_layout = self.create_2d_layout()
+        return self._standard_2D_layout
+
+
+    @standard_2D_layout.setter
+    def standard_2D_layout(self, layout: go.Layout) -> None:
+        self._standard_2D_layout = layout
+
+
+    @property
+    def standard_3D_layout(self) -> go.Layout:
+        if self._standard_3D_layout is None:
+            self._standard_3D_layout = self.create_3d_layout()
+        return self._standard_3D_layout
+
+
+    @standard_3D_layout.setter
+    def standard_3D_layout(self, layout: go.Layout) -> None:
+        self._standard_3D_layout = layout
 
 
     def get_id_count(self) -> str:
@@ -133,43 +316,12 @@ class KodakPlots(object):
     def get_color_and_symbol(self, color_idx: int, symbol_idx: int, symbol_or_dash: str) -> tuple:
         """
         Based on the trace #, a different color and symbol may be used. The user can more clearly "fix" this in the UI
-        if a different combo is desired.
-        """
-        if color_idx > 8:
-            warnings.warn('Note: You have many traces in one figure so re-using colors. Reminder that this is an '
-                          'academic-minded package, do you want more than 8 traces on one plot?')
-            color_idx = color_idx % 8  # We repeat colors
-        tol_colors = {  # Color-blind safe color map from: https://personal.sron.nl/~pault/
-            1: 'rgb(136, 204, 238)',  # Cyan
-            2: 'rgb(68, 170, 153)',  # Teal
-            3: 'rgb(17, 119, 51)',  # Green
-            4: 'rgb(153, 153, 51)',  # Olive
-            5: 'rgb(221, 204, 119)',  # Sand
-            6: 'rgb(204, 102, 119)',  # Rose
-            7: 'rgb(136, 34, 85)',  # Wine
-            8: 'rgb(170, 68, 153)',  # Purple
-        }
-        if symbol_or_dash == 'symbol':
-            if symbol_idx > 5:
-                symbol_idx = symbol_idx % 5  # We repeat colors
-            symbol_map = {
-                1: 'circle',
-                2: 'square',
-                3: 'diamond',
-                4: 'x',
-                5: 'cross'
-            }
-        else:
-            if symbol_idx > 4:
-                symbol_idx = symbol_idx % 4 # We repeat colors
-            symbol_map = {
-                1: 'solid',
-                2: 'dash',
-                3: 'dot',
-                4: 'dashdot',
-            }
-
-        return tol_colors[color_idx], symbol_map[symbol_idx]
+        if a different combo is desired. The indices start at 1, and the colors / symbols are repeated once exhausted.
+        """
+        if color_idx > len(TOL_COLORS):
+            warnings.warn(_MANY_TRACES_WARNING)
+        symbol_map = MARKER_SYMBOLS if symbol_or_dash == 'symbol' else LINE_DASHES
+        return TOL_COLORS[(color_idx - 1) % len(TOL_COLORS)], symbol_map[(symbol_idx - 1) % len(symbol_map)]
 
 
     def scatter_plot(self, x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.ndarray]],
@@ -177,8 +329,9 @@ class KodakPlots(object):
         # First we create a scatter trace based on X and Y:
         if lines_markers_both not in ['lines', 'markers', 'both']:
             raise Exception("Invalid value for lines_markers_both, only options are: 'lines', 'markers', or 'both'")
-        marker = go.scatter.Marker()
-        line = go.scatter.Line()
+        import plotly.graph_objs as go
+        marker = {} if self.fast_traces else go.scatter.Marker()
+        line = {} if self.fast_traces else go.scatter.Line()
 
         if 'marker' in kwargs.keys():
             marker = kwargs['marker']
@@ -196,17 +349,53 @@ class KodakPlots(object):
             #line = dict(width=2, color='blue', dash='solid')
             pass
 
+        fast = self.fast_traces
         if lines_markers_both == 'lines':
-            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, line=line, **kwargs)
+            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, fast=fast, line=line, **kwargs)
         elif lines_markers_both == 'markers':
-            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, marker=marker, **kwargs)
+            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, fast=fast, marker=marker, **kwargs)
         else:
-            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, marker=marker, line=line, **kwargs)
+            return scatter(x=x, y=y, lines_markers_both=lines_markers_both, fast=fast, marker=marker, line=line,
+                           **kwargs)
 
 
     def scatter3d_plot(self, x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.ndarray]],
                        **kwargs) -> PlotTrace:
-        return scatter3d(x=x, y=y, **kwargs)
+        return scatter3d(x=x, y=y, fast=self.fast_traces, **kwargs)
+
+
+    def histogram_plot(self, x, bins: Union[int, list, np.ndarray] = 10, bin_range: Optional[tuple] = None,
+                       weights=None, histnorm: str = '', **kwargs) -> PlotTrace:
+        """
+        Bins the raw samples x (an array, np.memmap, or an iterable of chunks) into a histogram, only the bin counts are
+        stored in the .plots file. See trace_types.histogram for the arguments.
+        """
+        return histogram(x=x, bins=bins, bin_range=bin_range, weights=weights, histnorm=histnorm,
+                         fast=self.fast_traces, **kwargs)
+
+
+    def histogram2d_plot(self, x, y, bins: Union[int, list, np.ndarray, tuple] = 10, bin_range: Optional[tuple] = None,
+                         weights=None, histnorm: str = '', **kwargs) -> PlotTrace:
+        """
+        Bins the raw samples x / y into a 2D histogram shown as a heatmap, see trace_types.histogram2d.
+        """
+        return histogram2d(x=x, y=y, bins=bins, bin_range=bin_range, weights=weights, histnorm=histnorm,
+                           fast=self.fast_traces, **kwargs)
+
+
+    def heatmap_plot(self, z: Union[list, np.ndarray], x: Optional[Union[list, np.ndarray]] = None,
+                     y: Optional[Union[list, np.ndarray]] = None, **kwargs) -> PlotTrace:
+        return heatmap(z=z, x=x, y=y, fast=self.fast_traces, **kwargs)
+
+
+    def density_contour_plot(self, x, y, bins: Union[int, list, np.ndarray, tuple] = 25,
+                             bin_range: Optional[tuple] = None, weights=None, histnorm: str = '',
+                             **kwargs) -> PlotTrace:
+        """
+        Bins the raw samples x / y into a 2D histogram shown as contours, see trace_types.density_contour.
+        """
+        return density_contour(x=x, y=y, bins=bins, bin_range=bin_range, weights=weights, histnorm=histnorm,
+                               fast=self.fast_traces, **kwargs)
 
 
     """
@@ -246,47 +435,25 @@ class KodakPlots(object):
         :param traces: List of PlotTraces from trace_types
         :return: List of extracted plotly traces for this figure, the default layout to use, and the plot_type
         """
+        # The style of every trace is worked out first (it only depends on the position of the trace and its colors):
+        styles = [_default_style(trace.type, *_trace_style(trace.plotly_trace)) for trace in traces]
+        if any(prop not in (None, 'colorscale') and i >= len(TOL_COLORS) for i, prop in enumerate(styles)):
+            warnings.warn(_MANY_TRACES_WARNING)  # Only once per figure
+
         extracted_traces = []
-        plot_type = None
-        color_count, symbol_count = 1, 1
-        for trace in traces:
-            # First update plot_type:
-            if plot_type is None:
-                plot_type = trace.type
-            elif trace.type not in plot_type:
-                plot_type += f'+{trace.type}'
-
-            plt = trace.plotly_trace  # Extract this as we need to update the color n symbol n things:
-            cur_mode = plt.mode
-            # If either of these is not None, then we know that we want to update their marker or line style:
-            if plt.marker.color is None and plt.line.color is None:
-                if cur_mode in ['markers', 'markers+lines', 'lines+markers']:
-                    color, symb = self.get_color_and_symbol(color_idx=color_count, symbol_idx=symbol_count,
-                                                            symbol_or_dash='symbol')
-                    new_marker = dict(size=8, color=color, symbol=symb, line=dict(width=2, color='DarkSlateGrey'))
-                    trace.plotly_trace.marker = new_marker
-                elif cur_mode in ['lines', 'markers+lines', 'lines+markers']:
-                    color, symb = self.get_color_and_symbol(color_idx=color_count, symbol_idx=symbol_count,
-                                                            symbol_or_dash='dash')
-                    new_line = dict(width=2, color=color, dash=symb)
-                    trace.plotly_trace.line = new_line
-
-            elif plt.marker.color is None:
-                color, symb = self.get_color_and_symbol(color_idx=color_count, symbol_idx=symbol_count,
-                                                        symbol_or_dash='symbol')
-                new_marker = dict(size=8, color=color, symbol=symb, line=dict(width=2, color='DarkSlateGrey'))
-                trace.plotly_trace.marker = new_marker
-
-            elif plt.line.color is None:
-                color, symb = self.get_color_and_symbol(color_idx=color_count, symbol_idx=symbol_count,
-                                                        symbol_or_dash='dash')
-                new_line = dict(width=2, color=color, dash=symb)
-                trace.plotly_trace.line = new_line
-
-            # Next extract the traces and update the counts
+        for i, (trace, prop) in enumerate(zip(traces, styles)):
+            if prop == 'marker':
+                set_trace_property(trace.plotly_trace, 'marker', _marker_style(i))
+            elif prop == 'line':
+                set_trace_property(trace.plotly_trace, 'line', _line_style(i))
+            elif prop == 'bar':
+                set_trace_property(trace.plotly_trace, 'marker', _bar_style(i))
+            elif prop == 'colorscale':
+                set_trace_property(trace.plotly_trace, 'colorscale', COLORSCALE)
             extracted_traces.append(trace.plotly_trace)
-            color_count += 1
-            symbol_count += 1
+
+        # The plot_type lists each distinct trace type (in order), e.g. 'scatter' or 'scatter+bar':
+        plot_type = '+'.join(dict.fromkeys(trace.type for trace in traces))
 
         # Now determine the default layout. Add logic here for when adding compatibility for "mix and match" plots such
         # as scatter with bar chart:
@@ -299,7 +466,7 @@ class KodakPlots(object):
 
 
     def add_new_plot(self, traces: list, window_title: str, description: str = None, closeable: bool = False,
-                           custom_layout: go.Layout = None) -> None:
+                           custom_layout: go.Layout = None, lod: Optional[LODSettings] = None) -> None:
         """
         This function specifically iterates over the plots_list and calls the proper functions to "add" this data
         to the all_plots dictionary.
@@ -309,30 +476,204 @@ class KodakPlots(object):
         :param description: The description of the plot
         :param closeable: If the plot should be "closeable"
         :param custom_layout: If the user has a custom layout they may want to use, then pass it in here.
+        :param lod: Level-of-detail settings for this plot (overrides KodakPlots.lod, but not the lod of a PlotTrace)
         :return: Nothing, this will just add the plot to the all_plots dictionary:
         """
         # First validate traces can be added to one plot:
         valid, message = self.validate_traces(traces=traces)
 
         if valid:
+            if self._in_background(self.add_new_plot, traces, window_title, description, closeable, custom_layout, lod):
+                return
             extracted_traces, layout, plot_type = self.read_traces(traces=traces)
+            extracted_traces, lod_fields = self._apply_lod(traces, extracted_traces, lod, window_title)
             # If user specified a specific layout to use, then we just use that instead:
             if custom_layout:
                 layout = custom_layout
 
             # Finally, we add the new plot to all_plots for export:
-            fig = go.Figure(data=extracted_traces, layout=layout)
-            self.all_plots[window_title] = {
-                '_title': window_title,
-                '_closeable': closeable,
-                '_description': description if description is not None else 'No plot description provided.',
-                '_showGraphSettingsBar': plot_type,
-                '_data': fig.to_json()  # Convert to JSON so that I can read it in
-            }
+            self._store_plot(window_title, self._plot_entry(window_title, description, closeable, plot_type,
+                                                            self._build_figure(extracted_traces, layout), **lod_fields))
         else:
             raise Exception(f'Invalid list of traces passed into function. Error: {message}')
 
 
+    def add_new_plots(self, plots: list, max_workers: Optional[int] = None, executor: Optional[Executor] = None,
+                      chunksize: int = 1) -> None:
+        """
+        Batch version of add_new_plot for when many plots are created at once (e.g. the output of a sweep). Every plot is
+        validated and styled up-front (exactly as add_new_plot would), and the go.Figure creation / serialization is then
+        farmed out to a pool of processes. The plots are added to all_plots in the same order they are passed in.
+
+        :param plots: List of dictionaries holding the add_new_plot arguments for each plot, e.g.
+                      [{'traces': [trace1, trace2], 'window_title': 'My plot', 'description': 'Some description'}, ...]
+        :param max_workers: Number of processes to use (defaults to the number of CPUs). A value of 1 runs serially.
+        :param executor: An existing executor to use (e.g. to re-use one ProcessPoolExecutor across many calls)
+        :param chunksize: Number of plots sent to a worker process at a time
+        :return: Nothing, this will just add the plots to the all_plots dictionary:
+        """
+        # First validate all plots in one pass so that we do not do any work if one of them is invalid:
+        errors = []
+        for i, spec in enumerate(plots):
+            if 'traces' not in spec or 'window_title' not in spec:
+                errors.append(f'Plot {i} is missing the required "traces" and / or "window_title" argument.')
+                continue
+            valid, message = self.validate_traces(traces=spec['traces'])
+            if not valid:
+                errors.append(f'Plot {i} ({spec["window_title"]}): {message}')
+        if errors:
+            raise Exception('Invalid list of traces passed into function. Errors: ' + ' | '.join(errors))
+        if self._in_background(self.add_new_plots, plots, max_workers, executor, chunksize):
+            return
+
+        # Styles are assigned here (in the main process) so that the result is identical to calling add_new_plot:
+        jobs, entries = [], []
+        for spec in plots:
+            extracted_traces, layout, plot_type = self.read_traces(traces=spec['traces'])
+            extracted_traces, lod_fields = self._apply_lod(spec['traces'], extracted_traces, spec.get('lod'),
+                                                           spec['window_title'])
+            if spec.get('custom_layout'):
+                layout = spec['custom_layout']
+            if self.plots_version >= 2:
+                layout_field, layout = self._layout_field(layout), None  # Only serialized once (see _layout_field)
+            else:
+                layout_field, layout = None, layout.to_plotly_json() if hasattr(layout, 'to_plotly_json') else layout
+            # Note: Fast traces are sent as-is so that they are validated in the worker process
+            jobs.append(([t if isinstance(t, TraceRecord) else t.to_plotly_json() for t in extracted_traces], layout,
+                         self.plots_version, self._shared_arrays() is not None))
+            entries.append((spec['window_title'], spec.get('description'), spec.get('closeable', False), plot_type,
+                            layout_field, lod_fields))
+
+        if executor is not None:
+            serialized = executor.map(_serialize_figure_job, jobs, chunksize=chunksize)
+        elif max_workers == 1 or len(jobs) < 2:
+            serialized = map(_serialize_figure_job, jobs)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                serialized = list(pool.map(_serialize_figure_job, jobs, chunksize=chunksize))
+
+        # map returns the results in order, so the plots are added in the same (deterministic) order as passed in:
+        for (window_title, description, closeable, plot_type, layout_field, lod_fields), (data, arrays) in \
+                zip(entries, serialized):
+            if arrays is not None:
+                self.array_table.merge(arrays)
+            if layout_field is not None:
+                data['layout'] = layout_field
+            self._store_plot(window_title, self._plot_entry(window_title, description, closeable, plot_type, data,
+                                                            **lod_fields))
+
+
+    @staticmethod
+    def _plot_entry(window_title: str, description: Optional[str], closeable: bool, plot_type: str,
+                    data: Union[str, dict], **extra_fields) -> dict:
+        return {
+            '_title': window_title,
+            '_closeable': closeable,
+            '_description': description if description is not None else 'No plot description provided.',
+            '_showGraphSettingsBar': plot_type,
+            '_data': data,
+            **extra_fields
+        }
+
+
+    def _apply_lod(self, traces: list, extracted_traces: list, lod: Optional[LODSettings], window_title: str) -> tuple:
+        """
+        Runs the level-of-detail stage (see kodak.lod) over the extracted traces of a plot. The settings of a PlotTrace
+        take priority over those of the plot, which take priority over KodakPlots.lod.
+
+        :return: The (possibly downsampled) extracted traces and the extra fields to store in the plot: '_lod' reports
+                 how many points were kept, and '_fullResolution' holds the original arrays if they are to be kept.
+        """
+        reports, full_resolution = [], {}
+        for i, (trace, plotly_trace) in enumerate(zip(traces, extracted_traces)):
+            settings = trace.lod or lod or self.lod
+            if settings is None or not settings.enabled or trace.type in _BINNED_TYPES:
+                continue
+            # Check the size before converting anything, as to_plotly_json copies the whole trace:
+            points = plotly_trace['y'] if plotly_trace['y'] is not None else plotly_trace['x']
+            if points is None or len(points) <= settings.max_points:
+                continue
+
+            trace_dict = dict(plotly_trace) if isinstance(plotly_trace, TraceRecord) else plotly_trace.to_plotly_json()
+            reduced, full, report = downsample_trace(trace_dict, settings)
+            extracted_traces[i] = TraceRecord(reduced)
+            reports.append({'trace': i, **report})
+            if settings.keep_full_resolution:
+                if self.plots_version < 2:
+                    warnings.warn('Full-resolution arrays can only be stored in .plots version 2 (or newer) files.')
+                else:
+                    full_resolution[str(i)] = encode_value(full, arrays=self._shared_arrays())
+
+        if not reports:
+            return extracted_traces, {}
+        self.lod_reports[window_title] = reports
+        lod_fields = {'_lod': reports}
+        if full_resolution:
+            lod_fields['_fullResolution'] = full_resolution
+        return extracted_traces, lod_fields
+
+
+    def _shared_arrays(self) -> Optional[ArrayTable]:
+        # The shared arrays table is only used for version 2 (or newer) files:
+        return self.array_table if self.share_arrays and self.plots_version >= 2 else None
+
+
+    def array_report(self) -> dict:
+        """
+        Returns how many distinct arrays are stored in the shared arrays table, how many times arrays were added to it,
+        and how many bytes were saved by only storing each distinct array once.
+        """
+        return self.array_table.report()
+
+
+    def _serialize_figure(self, fig: go.Figure) -> Union[str, dict]:
+        return serialize_figure(fig, self.plots_version, self._shared_arrays())
+
+
+    def _build_figure(self, traces: list, layout: Union[go.Layout, dict]) -> Union[str, dict]:
+        """
+        Creates the serialized figure for a list of (extracted) traces. This is where fast traces get validated by plotly
+        (once), unless validate_fast_traces is False in which case they are encoded as-is without ever copying the data.
+        For version 2 files the traces and the layout are serialized separately, as the layout is cached.
+        """
+        if self.plots_version < 2:
+            import plotly.graph_objs as go
+            return self._serialize_figure(go.Figure(data=traces, layout=layout))
+        if not self.validate_fast_traces and all(isinstance(t, TraceRecord) for t in traces):
+            # Note: Plotly drops empty properties (e.g. the blank line of a markers trace), so we do the same here
+            data = [{k: v for k, v in t.items() if not (isinstance(v, dict) and not v)} for t in traces]
+        else:
+            data = [_trace_json(t) for t in traces]
+        figure = encode_value({'data': data}, arrays=self._shared_arrays())
+        figure['layout'] = self._layout_field(layout)
+        return figure
+
+
+    def _layout_field(self, layout: Union[go.Layout, dict]) -> dict:
+        # Returns what is stored under 'layout' in the figure: either the (cached) serialized layout, or a reference to it
+        # in the shared layouts table:
+        template_id, layout_json = serialized_layout(layout)
+        if not self.share_layouts:
+            return layout_json
+        self.layout_table[template_id] = layout_json
+        if self._writer is not None:
+            self._writer.write_layout(template_id, layout_json)
+        return {LAYOUT_REF: template_id}
+
+
+    def get_figure(self, window_title: str) -> go.Figure:
+        """
+        Returns the plotly figure stored under window_title, regardless of which .plots version it was read in from.
+        """
+        if isinstance(self.all_plots, LazyPlots):
+            # Use the figure cache of the lazy reader:
+            return self.all_plots.get_figure(window_title, arrays=self.array_table, layouts=self.layout_table)
+        import plotly.graph_objs as go  # Only needed once a figure is actually built
+        return go.Figure(figure_dict(self.all_plots.peek(window_title), arrays=self.array_table,
+                                     layouts=self.layout_table))
+
+
     """
     Below are some custom-made functions that I use Kodak for when creating visualizations from my mango project. 
     
@@ -356,40 +697,424 @@ class KodakPlots(object):
                 problem_definition[f1] = extra_constraint.name
                 problem_definition[f2] = extra_constraint.extra_params
 
-        self.all_plots['problem_definition'] = {
+        self._store_plot('problem_definition', {
             '_title': "Problem specified to mango framework",
             '_closeable': False,
             '_description': 'This figure shows an the various parameters used in the optimization process. A more '
                             'comprehensive list can be seen using the advanced output creation.',
             '_showGraphSettingsBar': 'None',
             '_data': problem_definition
-        }
+        })
 
 
     def store_interactive_points(self, design_map: dict) -> None:
         # This function simply stores mapped data to an interactive_design:
-        self.all_plots[f'INTERACTIVE_DESIGN_{self.get_id_count()}'] = design_map
+        key = design_key(self.get_id_count())
+        if self.columnar_designs:
+            self._store_design(key, design_map)
+        else:
+            self._store_plot(key, design_map)
+
+
+    def _store_design(self, key: str, design_map: dict) -> None:
+        # The design is written out with the rest of designs, so this is the same when streaming the output:
+        if self._in_background(self._store_design, key, design_map):
+            return
+        self.designs.add(design_id(key), design_map)
+
+
+    def _store_plot(self, key: str, value: dict) -> None:
+        if self._in_background(self._store_plot, key, value):
+            return
+        # If we are streaming the output then the plot goes straight to disk, otherwise it is held until written out:
+        if self._writer is not None:
+            self._writer.write(key, value)
+        else:
+            self.all_plots[key] = value  # Recorded as unsaved by the listener of all_plots
+
+
+    def remove_plot(self, key: str) -> None:
+        """
+        Removes a plot (or INTERACTIVE_DESIGN entry) from all_plots, such that append_json_output also removes it from
+        the file.
+        """
+        if self._in_background(self.remove_plot, key):
+            return
+        if key not in self.all_plots and design_id(key) in self.designs:
+            self.designs.remove(design_id(key))
+            self._removed_designs.append(design_id(key))
+            return
+        del self.all_plots[key]  # Recorded as removed by the listener of all_plots
+
+
+    def _in_background(self, function, *args) -> bool:
+        # While a BackgroundExporter is running, calls made from the main thread are handed over to its worker thread:
+        if self._exporter is None or self._exporter.is_worker_thread():
+            return False
+        self._exporter.submit(function, *args)
+        return True
+
+
+    def start_background_export(self, write_directory: str, savename_no_extension: str, max_queued: int = 32,
+                                compact_threshold: Optional[float] = 1.) -> BackgroundExporter:
+        """
+        Starts a worker thread that takes over the work of add_new_plot, add_new_plots, store_interactive_points,
+        add_problem_definition, and remove_plot: these calls only hand their arguments over to a bounded queue and
+        return, and the worker does the styling, serialization, and (on every exporter.checkpoint()) the write out to
+        the .plots file through append_json_output. This keeps the plotting out of the way of e.g. an optimization loop.
+        If the file exists but was not read in (or written) by this object, the first checkpoint writes it over.
+
+            with kodak_plots.start_background_export('outputs', 'my_run') as exporter:
+                for i in range(n_iterations):
+                    kodak_plots.add_new_plot(traces=[trace], window_title=f'Iteration {i}')
+                    if i % 10 == 0:
+                        exporter.checkpoint()
+
+        Note: Call exporter.flush() before reading all_plots (or writing the plots out some other way) while the
+              exporter is running. Errors raised on the worker are raised by the next call handed over (or by flush /
+              close).
+
+        :param max_queued: Number of calls that can wait in the queue before handing over a new one blocks
+        :param compact_threshold: Passed on to append_json_output on every checkpoint
+        :return: The BackgroundExporter, which is closed (with a final checkpoint) on exit of a with block
+        """
+        if self._writer is not None or self._exporter is not None:
+            raise Exception('This KodakPlots object is already writing its output to a file.')
+        self._exporter = BackgroundExporter(self, write_directory, savename_no_extension, max_queued=max_queued,
+                                            compact_threshold=compact_threshold)
+        return self._exporter
+
+
+    def _set_saved_state(self, filepath: Optional[str], arrays: Union[set, list] = (),
+                         layouts: Union[set, list] = ()) -> None:
+        # Records that all_plots matches the .plots file filepath (plus its log), which holds the given shared arrays and
+        # layouts. Plots stored / removed from here on are what append_json_output writes out:
+        self._saved_path = None if filepath is None else os.path.abspath(filepath)
+        self._unsaved = {}  # Insertion ordered set of the keys added / replaced since
+        self._removed = {}  # Insertion ordered set of the keys removed since
+        self._saved_arrays = set(arrays)
+        self._saved_layouts = set(layouts)
+        self._saved_design_rows = self.designs.n_rows  # Rows of the DesignStore from here on were added since
+        self._removed_designs = []
+        self._pruned_arrays = len(self.array_table)  # See _prune_arrays
+
+
+    def _unsaved_tables(self, plots: dict) -> tuple:
+        # Returns the shared layouts and arrays referenced by plots which are not yet in the file (or its log):
+        lazy = self.all_plots if isinstance(self.all_plots, LazyPlots) else None
+        layouts = {k: self.layout_table[k] for k in referenced_layouts(plots)
+                   if k not in self._saved_layouts and not (lazy is not None and k in lazy.layouts)}
+        arrays = {k: self.array_table.block(k) for k in sorted(referenced_arrays(plots))
+                  if k not in self._saved_arrays and not (lazy is not None and k in lazy.arrays)}
+        return layouts, arrays
+
+
+    def _unsaved_designs(self) -> Optional[dict]:
+        # Returns the '_designs' block of the designs added / removed since the file was written (None if none were):
+        if self.designs.n_rows == self._saved_design_rows and not self._removed_designs:
+            return None
+        return {'chunks': [self.designs.encode_chunk(self._saved_design_rows)], 'removed': list(self._removed_designs)}
+
+
+    def _encoded_designs(self) -> Optional[dict]:
+        return self.designs.encode() if len(self.designs) else None
 
     """
     I/O Functionalities
     """
-    def write_json_output(self, write_directory: str, savename_no_extension: str) -> None:
+    def write_json_output(self, write_directory: str, savename_no_extension: str, indent: Optional[int] = None) -> None:
+        """
+        Writes all_plots out to a .plots file.
+
+        :param write_directory: Directory to write the file to
+        :param savename_no_extension: Name of the file (the .plots extension is added automatically)
+        :param indent: Indentation of the JSON output. By default, version 1 files are indented by 4 and version 2 files
+                       are written compactly since the figures are nested objects rather than single strings.
+        """
         sname = savename_no_extension + '.plots'
         full_save_path = os.path.join(write_directory, sname)
-        with open(full_save_path, 'w') as f:
-            json.dump(self.all_plots, f, indent=4)
+        if isinstance(self.all_plots, LazyPlots):
+            # Plots read in lazily are copied over from the original file without ever being parsed. If that is the
+            # file we write to, all_plots has to let go of it before it is replaced (and is then re-opened on the new
+            # file, from the sidecar index written out along with it):
+            lazy = self._mapped_plots(full_save_path)
+            writer = PlotsStreamWriter(full_save_path, version=self.plots_version, write_index=lazy is not None,
+                                       replace_on_close=False)
+            with writer:
+                self._write_all_plots(writer)
+            layouts, used = writer.layout_keys, writer.array_keys
+            try:
+                if lazy is not None:
+                    lazy.close()
+                writer.replace()
+            finally:
+                if lazy is not None:
+                    self._reopen_lazy_plots(lazy)
+        else:
+            # The file is written to a temporary file first so that an existing file is never left half-written:
+            if self.plots_version < 2:
+                layouts, used = {}, []
+                with open(full_save_path + '.tmp', 'w') as f:
+                    # Version 1 files have no '_designs' block, so columnar designs are written out as design maps:
+                    f.write(dumps({**self.all_plots, **self.designs.maps}, indent=4 if indent is None else indent))
+                    sync_file(f)
+            else:
+                output = {VERSION_KEY: self.plots_version, **self.all_plots}
+                if len(self.designs):
+                    output[DESIGNS_KEY] = self.designs.encode()
+                # Only the shared layouts / arrays that are still referenced (e.g. plots may have been removed) are
+                # written out:
+                layouts = self._used_layouts()
+                if layouts:
+                    output[LAYOUTS_KEY] = layouts
+                used = self._used_arrays()
+                if used:
+                    output[ARRAYS_KEY] = {k: self.array_table.block(k) for k in used}
+                # Note: dumps (json.dumps) is used over json.dump as only the "one-shot" encoder runs through the C accelerator
+                with open(full_save_path + '.tmp', 'w') as f:
+                    f.write(dumps(output, indent=indent, separators=(',', ':') if indent is None else None))
+                    sync_file(f)
+            os.replace(full_save_path + '.tmp', full_save_path)
+            sync_directory(full_save_path)  # The rename has to be on disk before the (now stale) log is removed
+        self._saved_to(full_save_path, used, layouts)
+        self._prune_arrays()
+
+
+    def _saved_to(self, filepath: str, arrays: Union[set, list], layouts: Union[set, dict]) -> None:
+        # The whole file was just (re-)written, so any log of a previous version of it is stale:
+        if os.path.exists(log_path(filepath)):
+            os.remove(log_path(filepath))
+        self._set_saved_state(filepath, arrays, layouts)
+
+
+    def append_json_output(self, write_directory: str, savename_no_extension: str,
+                           compact_threshold: Optional[float] = 1.) -> None:
+        """
+        Incremental alternative to write_json_output for a file that is written out over and over (e.g. every few
+        minutes of an optimization campaign). Only the plots added / replaced / removed since the file was last written
+        or read in (whether through add_new_plot, remove_plot, ... or directly on all_plots) are appended to a log next
+        to the file (see plots_format.append_segment), so the cost of a call does not grow with the size of the file.
+        Files with a log are read in as usual through read_json_input.
+
+            kodak_plots.read_json_input('outputs/my_run.plots', lazy=True)  # Only needed when continuing a run
+            kodak_plots.store_interactive_points(design_map)
+            kodak_plots.append_json_output(write_directory='outputs', savename_no_extension='my_run')
+
+        :param compact_threshold: Once the log is larger than compact_threshold times the file, it is merged back into
+                                  the file (see compact_json_output). None turns off the automatic compaction.
+        """
+        full_save_path = os.path.join(write_directory, savename_no_extension + '.plots')
+        if self._writer is not None:
+            raise Exception('This KodakPlots object is streaming its output to a file, can not append to a file.')
+        if not os.path.exists(full_save_path):
+            self.write_json_output(write_directory, savename_no_extension)
+            return
+        if self._saved_path != os.path.abspath(full_save_path):
+            # Otherwise the INTERACTIVE_DESIGN ids of this object could collide with (and replace) those of the file:
+            raise Exception(f'Can not append to {full_save_path} as it was not read in (or written) by this KodakPlots '
+                            f'object, please read it in first with read_json_input.')
+
+        designs = self._unsaved_designs()
+        if self._unsaved or self._removed or designs:
+            plots = {key: self.all_plots.peek(key) for key in self._unsaved}
+            layouts, arrays = self._unsaved_tables(plots)
+            append_segment(full_save_path, plots, list(self._removed), layouts, arrays, self.plots_version, designs)
+            self._saved_arrays.update(arrays)
+            self._saved_layouts.update(layouts)
+            self._unsaved.clear()
+            self._removed.clear()
+            self._saved_design_rows = self.designs.n_rows
+            self._removed_designs = []
+            # Walking all_plots for the arrays still in use is only worth it once the table has doubled in size:
+            if len(self.array_table) > 2 * max(self._pruned_arrays, 16):
+                self._prune_arrays()
+
+        log_size = os.path.getsize(log_path(full_save_path)) if os.path.exists(log_path(full_save_path)) else 0
+        if compact_threshold is not None and log_size > compact_threshold * os.path.getsize(full_save_path):
+            self.compact_json_output(write_directory, savename_no_extension)
+
+
+    def compact_json_output(self, write_directory: str, savename_no_extension: str) -> None:
+        """
+        Merges the log written by append_json_output back into the .plots file. Unchanged plots are copied over without
+        being parsed, and the file is replaced atomically (a crash part way through leaves the file and log as they were).
+        """
+        full_save_path = os.path.join(write_directory, savename_no_extension + '.plots')
+        lazy = self._mapped_plots(full_save_path)
+        try:
+            compact_plots_file(full_save_path, release=None if lazy is None else lazy.close)
+        finally:
+            if lazy is not None and lazy.closed:
+                self._reopen_lazy_plots(lazy)
+
+
+    def _mapped_plots(self, filepath: str) -> Optional[LazyPlots]:
+        # Returns all_plots if it is a LazyPlots memory-mapping filepath, which has to be closed before filepath is
+        # replaced (Windows refuses to replace a mapped file, and elsewhere it would keep reading the old file):
+        plots = self.all_plots
+        if isinstance(plots, LazyPlots) and os.path.abspath(plots.filepath) == os.path.abspath(filepath):
+            return plots
+        return None
+
+
+    def _reopen_lazy_plots(self, closed: LazyPlots) -> None:
+        # Re-opens all_plots on the file which replaced the one it had mapped. The plots held in memory are carried over
+        # (edits made to them in place still have to be written out), as are the keys removed but not yet written out.
+        # This happens behind the back of the listener, as it does not change the contents of all_plots:
+        plots = LazyPlots(closed.filepath, cache_size=closed.cache_size)
+        for key, value in closed.held.items():
+            plots[key] = value
+        for key in [k for k in plots if k not in closed]:
+            del plots[key]
+        if self.array_table.base is closed.arrays:
+            self.array_table.base = plots.arrays
+        plots.listener = self._plot_changed
+        self._all_plots = plots
+
+
+    @contextmanager
+    def stream_json_output(self, write_directory: str, savename_no_extension: str,
+                           write_index: bool = False) -> Iterator[PlotsStreamWriter]:
+        """
+        Incremental alternative to write_json_output. While inside of this context manager, every plot created through
+        add_new_plot, store_interactive_points, or add_problem_definition is appended to the file right away instead of
+        being kept in all_plots. The closing structure of the file is written out on exit.
+
+            with kodak_plots.stream_json_output(write_directory='outputs', savename_no_extension='my_run'):
+                kodak_plots.add_new_plot(traces=[trace], window_title='My plot')
+
+        Note: Anything already held in all_plots is written out first (and is left in all_plots). If write_index is True,
+              a sidecar index is written next to the file so that read_json_input(..., lazy=True) can skip its scan.
+        """
+        if self._writer is not None or self._exporter is not None:
+            raise Exception('This KodakPlots object is already writing its output to a file.')
+        full_save_path = os.path.join(write_directory, savename_no_extension + '.plots')
+        with PlotsStreamWriter(full_save_path, version=self.plots_version, write_index=write_index) as writer:
+            self._write_all_plots(writer)
+            self._writer = writer
+            self.array_table.stream_to(writer.write_array)  # New shared arrays also go straight to the file
+            try:
+                yield writer
+            finally:
+                self._writer = None
+                self.array_table.stop_streaming()
+                writer.write_designs(self._encoded_designs())
+        self._saved_to(full_save_path, writer.array_keys, writer.layout_keys)
+
+
+    def _write_all_plots(self, writer: PlotsStreamWriter) -> None:
+        if isinstance(self.all_plots, LazyPlots):
+            self.all_plots.write_to(writer)  # This also copies over the shared arrays of the lazily read file
+            keys = list(self.array_table)
+        else:
+            for key, value in self.all_plots.items():
+                writer.write(key, value)
+            keys = self._used_arrays()
+        writer.write_designs(self._encoded_designs())
+        for key, layout in self._used_layouts().items():
+            writer.write_layout(key, layout)
+        for key in keys:
+            writer.write_array(key, self.array_table.block(key))
+
+
+    def _used_layouts(self) -> dict:
+        # Returns the shared layouts referenced by all_plots (all of them for a lazily read file, to avoid parsing it):
+        if not self.layout_table:
+            return {}
+        if isinstance(self.all_plots, LazyPlots):
+            return dict(self.layout_table)
+        used = referenced_layouts(self.all_plots)
+        return {k: v for k, v in self.layout_table.items() if k in used}
+
+
+    def _prune_arrays(self) -> None:
+        # Drops the shared arrays no plot refers to anymore (e.g. those of plots which were replaced or removed) from
+        # array_table, so that they are not held in memory for good. Arrays of a lazily read file stay on disk (in the
+        # base of the table), so only the plots held in memory can refer to the arrays held in the table itself:
+        used = referenced_arrays(self.all_plots.held if isinstance(self.all_plots, LazyPlots) else self.all_plots)
+        for key in [k for k in self.array_table if k not in used]:
+            del self.array_table[key]
+        self._pruned_arrays = len(self.array_table)
+
+
+    def _used_arrays(self) -> list:
+        # Returns the (ordered) keys of the shared arrays referenced by all_plots:
+        if not self.array_table and self.array_table.base is None:
+            return []
+        used = referenced_arrays(self.all_plots)
+        return [k for k in self.array_table if k in used] + sorted(k for k in used if k not in self.array_table)
+
+
+    def write_container_output(self, write_directory: str, savename_no_extension: str,
+                               compression: Optional[str] = None) -> str:
+        """
+        Writes all_plots out to a binary container (see kodak.container) rather than a .plots file. The arrays are stored
+        as raw blocks which are memory-mapped when the container is read back in through read_container_input.
+
+        :param compression: None (".kplots", can be memory-mapped), 'gzip' (".kplots.gz"), or 'zstd' (".kplots.zst")
+        :return: The full path of the file that was written
+        """
+        extension = {None: '.kplots', 'gzip': '.kplots.gz', 'zstd': '.kplots.zst'}.get(compression, '.kplots')
+        full_save_path = os.path.join(write_directory, savename_no_extension + extension)
+        write_container(full_save_path, self.all_plots, self.array_table, max(self.plots_version, 2), compression,
+                        self.layout_table, self._encoded_designs())
+        return full_save_path
+
+
+    def read_container_input(self, filepath: str) -> None:
+        """
+        Reads in a container written by write_container_output. The arrays of an uncompressed container are memory-mapped
+        and are only read from disk when a figure using them is built.
+        """
+        version, self.all_plots, arrays, self.layout_table, designs = read_container(filepath)
+        self.array_table = ArrayTable(base=arrays)
+        self.designs = DesignStore.decode(designs or {}, arrays)
+        self.plots_version = max(self.plots_version, version)
+        self._restore_id_count()
+        self._set_saved_state(None)
+
+
+    def read_json_input(self, filepath: str, lazy: bool = False, cache_size: int = 8) -> None:
+        """
+        Reads in a .plots file. Both version 1 (figure stored as a JSON string) and version 2 (figure stored as a nested
+        object) files can be read in.
+
+        :param filepath: Full path to the file we are reading-in
+        :param lazy: If True, all_plots becomes a LazyPlots object which indexes the file and only parses a plot when it
+                     is accessed. This is much faster (and lighter on memory) when only a few plots are needed.
+        :param cache_size: Number of decoded plotly figures the lazy reader keeps cached for get_figure
+
+        Note: Anything appended to the file through append_json_output is read in as well.
+        """
+        if lazy:
+            self.all_plots = LazyPlots(filepath, cache_size=cache_size)
+            self.array_table = ArrayTable(base=self.all_plots.arrays)
+            self.layout_table = dict(self.all_plots.layouts)
+            self.designs = DesignStore.decode(self.all_plots.designs or {}, self.all_plots.arrays)
+            version = self.all_plots.version
+            self._set_saved_state(filepath)  # The arrays / layouts of the file are looked up in all_plots
+        else:
+            with open(filepath, 'r') as f:
+                contents = apply_segments(json.load(f), read_segments(filepath))
+            self.all_plots = {k: contents[k] for k in plot_keys(contents)}
+            self.array_table = ArrayTable(contents.get(ARRAYS_KEY))
+            self.layout_table = contents.get(LAYOUTS_KEY) or {}
+            self.designs = DesignStore.decode(contents.get(DESIGNS_KEY) or {}, self.array_table)
+            version = file_version(contents)
+            self._set_saved_state(filepath, self.array_table, self.layout_table)
+        # We keep writing out the newest version, plots read in from older files are still valid inside of it:
+        self.plots_version = max(self.plots_version, version)
 
+        self._restore_id_count()
 
-    def read_json_input(self, filepath: str) -> None:
-        # Note: Filepath should be the full path to the file we are reading-in
-        with open(filepath, 'r') as f:
-            self.all_plots = json.load(f)
 
+    def _restore_id_count(self) -> None:
         # After reading-in, we need to almost do the "inverse" of __post_init__ to set values properly:
-        fin = -1  # Default value
+        fin = self.designs.max_id  # Default value of -1 if there are no (columnar) designs
         for plot in self.all_plots.keys():
-            if 'INTERACTIVE_DESIGN' in plot:
-                fin = plot.split('_')[2]
+            design = design_id(plot)
+            if design is not None:
+                fin = max(fin, design)
 
         self.id_count = fin
 
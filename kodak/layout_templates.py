@@ -0,0 +1,71 @@
+"""
+This script holds the caches used to avoid rebuilding (and re-serializing) the same plotly layout for every plot:
+    - layout_dict returns the (validated) plotly JSON of a layout per set of arguments (e.g. the academic 2D / 3D
+      styles), so that a new go.Layout can be created from it without building the layout up from scratch again
+    - serialized_layout returns the (cached) JSON of a layout as plotly writes it out (including the default template)
+      along with a content hash that is used as its template id in the '_layouts' table of a .plots file
+Plotly is only imported once a layout is built or serialized.
+"""
+from __future__ import annotations
+import copy
+import json
+import hashlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Union
+from kodak.plots_format import encode_value, json_default
+
+SERIALIZED_CACHE_SIZE = 64  # Number of serialized layouts kept around
+
+_LAYOUT_DICTS = {}  # Plotly JSON of the layouts keyed by the arguments that created them
+_SERIALIZED = OrderedDict()  # id(layout) -> (properties, default template, template id, serialized layout)
+
+if TYPE_CHECKING:
+    import plotly.graph_objs as go
+
+
+def layout_dict(key: tuple, build: Callable[[], go.Layout]) -> dict:
+    """
+    Returns the plotly JSON of the layout stored under key, calling build to create it the first time. The dictionary is
+    shared by every caller, so it should only be read from (go.Layout(layout_dict(...)) creates a layout to edit).
+    """
+    layout = _LAYOUT_DICTS.get(key)
+    if layout is None:
+        layout = _LAYOUT_DICTS[key] = build().to_plotly_json()
+    return layout
+
+
+def layout_id(layout_json: dict) -> str:
+    # Content hash of a serialized layout, so the same layout gets the same id in every file / process:
+    raw = json.dumps(layout_json, sort_keys=True, separators=(',', ':'), default=json_default).encode()
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+
+def _unchanged(cached: dict, properties: dict) -> bool:
+    try:
+        return bool(cached == properties)
+    except ValueError:  # Comparing numpy arrays held by the layout (e.g. tickvals) is ambiguous, so we serialize again
+        return False
+
+
+def serialized_layout(layout: Union[go.Layout, dict, None]) -> tuple:
+    """
+    Returns the template id and the serialized layout (what go.Figure(layout=layout).to_plotly_json() holds under
+    'layout', with large arrays packed into typed-array blocks). The result is cached by object, and the properties of
+    the layout are compared on every call so that a layout which was edited in-place is serialized again.
+
+    Note: The returned dictionary is shared between every plot using the layout, so it should not be edited in-place.
+    """
+    import plotly.io as pio
+    import plotly.graph_objs as go
+    properties = layout.to_plotly_json() if isinstance(layout, go.Layout) else copy.deepcopy(layout)
+    cached = _SERIALIZED.get(id(layout))
+    if cached is not None and _unchanged(cached[0], properties) and cached[1] == pio.templates.default:
+        _SERIALIZED.move_to_end(id(layout))
+        return cached[2], cached[3]
+
+    layout_json = encode_value(go.Figure(layout=layout).to_plotly_json()['layout'])
+    template_id = layout_id(layout_json)
+    _SERIALIZED[id(layout)] = (properties, pio.templates.default, template_id, layout_json)
+    if len(_SERIALIZED) > SERIALIZED_CACHE_SIZE:
+        _SERIALIZED.popitem(last=False)
+    return template_id, layout_json
@@ -0,0 +1,224 @@
+"""
+This script holds the level-of-detail (LOD) stage used to downsample very large traces before they are written out. The
+kodak viewer struggles with traces holding millions of points, so (if enabled) traces above a point budget are reduced:
+    - Line traces use LTTB (Largest-Triangle-Three-Buckets) or min/max bucketing which preserve the "shape" of the line
+    - Marker clouds use grid (2D) or voxel (3D) binning which keeps one point per occupied cell (refining the grid
+      until about max_points cells are occupied)
+All methods only select indices (no new points are created) and are vectorized with NumPy.
+"""
+from dataclasses import dataclass
+from typing import Optional, Union
+import numpy as np
+
+LINE_METHODS = ('lttb', 'minmax', 'stride')
+MARKER_METHODS = ('grid', 'stride')
+GRID_REFINEMENTS = 8  # Maximum number of times the grid is refined to keep about max_points points
+GRID_FILL = 0.9  # The grid is refined until at least this fraction of max_points is kept
+
+
+@dataclass
+class LODSettings(object):
+    """
+    Settings for the level-of-detail stage. These can be set for a whole KodakPlots object (KodakPlots.lod), for a single
+    plot (add_new_plot(..., lod=...)), or for a single trace (PlotTrace.lod), with the most specific one being used.
+
+    :param max_points: Point budget of a trace, traces with more points than this are downsampled
+    :param line_method: Method used for traces drawn with lines, one of 'lttb', 'minmax', or 'stride'
+    :param marker_method: Method used for marker-only traces, one of 'grid' or 'stride'
+    :param keep_full_resolution: If True, the full-resolution arrays are also stored in the plot under '_fullResolution'
+                                 so that the viewer can show the coarse version first (only for .plots version >= 2)
+    :param enabled: Set to False to turn the LOD stage off (e.g. for one trace while it is on for the rest)
+    """
+    max_points: int = 100000
+    line_method: str = 'lttb'
+    marker_method: str = 'grid'
+    keep_full_resolution: bool = False
+    enabled: bool = True
+
+    def __post_init__(self) -> None:
+        if self.line_method not in LINE_METHODS:
+            raise Exception(f'Invalid line_method {self.line_method}, only options are: {LINE_METHODS}')
+        if self.marker_method not in MARKER_METHODS:
+            raise Exception(f'Invalid marker_method {self.marker_method}, only options are: {MARKER_METHODS}')
+        if self.max_points < 3:
+            raise Exception('The max_points of a LODSettings must be at least 3.')
+
+
+def _first_index_per_bucket(values: np.ndarray, targets: np.ndarray, bucket: np.ndarray) -> np.ndarray:
+    # Returns the index of the first element in every bucket where values equals the target of that bucket:
+    hits = np.flatnonzero(values == targets[bucket])
+    _, first = np.unique(bucket[hits], return_index=True)
+    return hits[first]
+
+
+def _as_coordinate(values: Optional[Union[list, np.ndarray]], n: int) -> np.ndarray:
+    # Non-numeric (e.g. categorical or missing) coordinates are replaced by the point index:
+    if values is None:
+        return np.arange(n, dtype=np.float64)
+    arr = np.asarray(values)
+    if arr.dtype.kind not in 'iuf':
+        return np.arange(n, dtype=np.float64)
+    return arr.astype(np.float64, copy=False)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Vectorized Largest-Triangle-Three-Buckets. Each bucket keeps the point forming the largest triangle with the average
+    point of the previous and next buckets (the classic algorithm uses the previously selected point, which makes it
+    sequential). The first and last points are always kept.
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)  # n_out - 2 buckets over the interior points
+    starts, counts = edges[:-1] - 1, np.diff(edges)
+    bucket = np.repeat(np.arange(n_out - 2), counts)
+    xi, yi = x[1:n - 1], y[1:n - 1]
+    avg_x, avg_y = np.add.reduceat(xi, starts) / counts, np.add.reduceat(yi, starts) / counts
+    ax, ay = np.concatenate(([x[0]], avg_x[:-1]))[bucket], np.concatenate(([y[0]], avg_y[:-1]))[bucket]
+    cx, cy = np.concatenate((avg_x[1:], [x[-1]]))[bucket], np.concatenate((avg_y[1:], [y[-1]]))[bucket]
+    area = np.nan_to_num(np.abs((ax - cx) * (yi - ay) - (ax - xi) * (cy - ay)), nan=-1.)
+    selected = _first_index_per_bucket(area, np.maximum.reduceat(area, starts), bucket) + 1
+    return np.concatenate(([0], selected, [n - 1]))
+
+
+def minmax(y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Splits the trace into n_out / 2 buckets and keeps the minimum and maximum point of every bucket.
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    edges = np.linspace(0, n, max(n_out // 2, 1) + 1).astype(np.int64)
+    starts = edges[:-1]
+    bucket = np.repeat(np.arange(len(starts)), np.diff(edges))
+    low, high = np.where(np.isnan(y), np.inf, y), np.where(np.isnan(y), -np.inf, y)
+    mins = _first_index_per_bucket(low, np.minimum.reduceat(low, starts), bucket)
+    maxs = _first_index_per_bucket(high, np.maximum.reduceat(high, starts), bucket)
+    return np.union1d(mins, maxs)
+
+
+def stride(n: int, n_out: int) -> np.ndarray:
+    """
+    Keeps n_out evenly spaced points (including the first and last).
+    """
+    if n_out >= n:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, n_out).astype(np.int64))
+
+
+def _cells(normalized: list, side: int) -> np.ndarray:
+    # Returns the cell of every point on a grid with side cells per axis (the coordinates are normalized to [0, 1]):
+    cell = np.zeros(len(normalized[0]), dtype=np.int64)
+    for values in normalized:
+        cell = cell * side + np.minimum((values * side).astype(np.int64), side - 1)
+    return cell
+
+
+def _occupied(cell: np.ndarray, n_cells: int) -> int:
+    # Counts the occupied cells, using a mask over all cells while that is cheaper than sorting the cell ids:
+    if n_cells <= 8 * len(cell):
+        mask = np.zeros(n_cells, dtype=bool)
+        mask[cell] = True
+        return int(np.count_nonzero(mask))
+    return len(np.unique(cell))
+
+
+def grid(coordinates: list, n_out: int) -> np.ndarray:
+    """
+    Bins a 2D (or 3D) point cloud onto a regular grid (or voxel grid) and keeps the first point of every occupied cell.
+    Points with non-finite coordinates are dropped.
+
+    A grid of n_out cells is only filled by clouds covering the whole bounding box (points along a curve occupy about
+    n_out ** (1 / 2) of them), so the grid is refined based on the number of occupied cells until about n_out points
+    are kept. If the last refinement overshoots, the kept points are strided down to n_out.
+    """
+    n = len(coordinates[0])
+    if n_out >= n:
+        return np.arange(n)
+    dim = len(coordinates)
+    finite = np.ones(n, dtype=bool)
+    for values in coordinates:
+        finite &= np.isfinite(values)
+    points = np.flatnonzero(finite)
+    if not len(points):
+        return points
+    normalized = []
+    for values in coordinates:
+        values = values[points]
+        lo, hi = values.min(), values.max()
+        normalized.append((values - lo) / (hi - lo) if hi > lo else np.zeros(len(points)))
+
+    side = max(int(n_out ** (1. / dim) + 1e-9), 1)
+    max_side = int(2 ** (62. / dim))  # Keeps the cell ids within int64
+    cell = _cells(normalized, side)
+    occupied, previous = _occupied(cell, side ** dim), None
+    for _ in range(GRID_REFINEMENTS):
+        if occupied >= GRID_FILL * n_out or side >= max_side:
+            break
+        # The occupied cells grow as side ** d, where d is the dimension of what the points trace out (1 for a curve,
+        # 2 for a surface or a filled 2D cloud), which we estimate from the last refinement:
+        d = dim
+        if previous is not None:
+            if occupied <= previous[1]:
+                break  # Refining does not separate the points any further (e.g. many duplicated points)
+            d = min(max(np.log(occupied / previous[1]) / np.log(side / previous[0]), 1.), dim)
+        previous = (side, occupied)
+        side = min(max(int(side * (n_out / occupied) ** (1. / d)), side + 1), max_side)
+        cell = _cells(normalized, side)
+        occupied = _occupied(cell, side ** dim)
+
+    kept = np.sort(np.unique(cell, return_index=True)[1])  # First point of every occupied cell
+    if len(kept) > n_out:
+        kept = kept[stride(len(kept), n_out)]
+    return points[kept]
+
+
+def _subset(value, idx: np.ndarray, n: int, path: str, full: dict, depth: int = 0):
+    # Recursively indexes every per-point array (length n) of a trace, e.g. x, y, text, marker.line.color, error_y.array
+    if isinstance(value, dict):
+        return {k: _subset(v, idx, n, f'{path}.{k}' if path else k, full, depth + 1) for k, v in value.items()}
+    elif isinstance(value, (np.ndarray, list, tuple)) and len(value) == n and depth > 0:
+        full[path] = value
+        arr = np.asarray(value)
+        return arr[idx] if isinstance(value, np.ndarray) or arr.dtype.kind in 'iuf' else [value[i] for i in idx]
+    return value
+
+
+def downsample_trace(trace: dict, settings: LODSettings) -> tuple:
+    """
+    Applies the LOD stage to a single (plotly json) trace dictionary.
+
+    :param trace: The trace dictionary (e.g. the output of go.Scatter.to_plotly_json())
+    :param settings: LODSettings to use
+    :return: The (new) downsampled trace dictionary, a dictionary of the full-resolution arrays that were reduced keyed
+             by their property path, and a report of the reduction (None if the trace was not downsampled)
+    """
+    points = trace.get('y') if trace.get('y') is not None else trace.get('x')
+    n = 0 if points is None else len(points)
+    if not settings.enabled or n <= settings.max_points:
+        return trace, {}, None
+
+    # Note: LTTB and min/max bucketing are only defined for 2D lines so 3D lines are strided. A 3D trace without a mode
+    #       (the default of scatter3d_plot) is treated as a point cloud.
+    is_3d = trace.get('type', '').endswith('3d')
+    mode = trace.get('mode') or 'markers'
+    if 'lines' in mode:
+        method = 'stride' if is_3d else settings.line_method
+    else:
+        method = settings.marker_method
+
+    if method == 'lttb':
+        idx = lttb(_as_coordinate(trace.get('x'), n), _as_coordinate(trace.get('y'), n), settings.max_points)
+    elif method == 'minmax':
+        idx = minmax(_as_coordinate(trace.get('y'), n), settings.max_points)
+    elif method == 'grid':
+        axes = ('x', 'y', 'z') if is_3d else ('x', 'y')
+        idx = grid([_as_coordinate(trace.get(a), n) for a in axes], settings.max_points)
+    else:
+        idx = stride(n, settings.max_points)
+
+    full = {}
+    reduced = _subset(trace, idx, n, '', full)
+    report = {'method': method, 'points': n, 'kept': int(len(idx))}
+    return reduced, full, report
@@ -0,0 +1,207 @@
+"""
+This script merges many .plots files (e.g. the file written by every node of a distributed run) into one:
+
+    merge_plots_files(['node_0.plots', 'node_1.plots', ...], 'combined.plots', on_collision='rename')
+
+or from the command line (see setup.cfg) via:
+
+    kodak-merge combined.plots node_*.plots --on-collision rename --workers 8
+
+Indexing a file (finding the byte range of every plot, see plots_reader.scan_index) is what takes the time, so the
+inputs are first scanned in parallel by a pool of processes, which hand the index of every input back (an existing
+sidecar index is used, but none are written into the input directories). The plots are then streamed into the output
+one at a time (copied over byte for byte unless they have to be renamed), so no input is ever fully loaded into memory.
+
+INTERACTIVE_DESIGN ids are renumbered so that they do not clash: the ids of every input are shifted past the largest id
+of the inputs before it (the same goes for the ids in a columnar '_designs' block). Plots sharing a title are resolved
+by on_collision:
+    - 'rename': Later plots get a " (2)", " (3)", ... suffix added to their title
+    - 'first': The plot of the first input holding the title is kept
+    - 'last': The plot of the last input holding the title is kept
+    - 'error': An Exception listing the clashing titles is raised (before anything is written)
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import Executor
+from typing import Optional
+from kodak.plots_format import merge_designs, raw_references, referenced_arrays
+from kodak.plots_reader import LazyPlots
+from kodak.plots_writer import PlotsStreamWriter
+from kodak.design_store import design_id, design_ids, design_key, offset_design_ids
+
+ON_COLLISION = ('rename', 'first', 'last', 'error')
+
+
+def scan_plots_file(filepath: str) -> dict:
+    """
+    Indexes a .plots file and returns its plot keys (in order), its version, its index (see LazyPlots.file_index), and
+    the largest INTERACTIVE_DESIGN id it holds (-1 if it holds none). This is what runs inside of the worker processes.
+    """
+    with LazyPlots(filepath, cache_size=0, use_index=True, write_index=False) as plots:
+        keys = list(plots)
+        ids = [design_id(key) for key in keys]
+        max_id = max((i for i in ids if i is not None), default=-1)
+        if plots.designs:
+            max_id = max(max_id, int(design_ids(plots.designs, plots.arrays).max(initial=-1)))
+        return {'keys': keys, 'version': plots.version, 'index': plots.file_index, 'max_design_id': max_id}
+
+
+def _scan_all(filepaths: list, max_workers: Optional[int], executor: Optional[Executor]) -> list:
+    if executor is not None:
+        return list(executor.map(scan_plots_file, filepaths))
+    elif max_workers == 1 or len(filepaths) < 2:
+        return [scan_plots_file(filepath) for filepath in filepaths]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count() or 1, len(filepaths))) as pool:
+        return list(pool.map(scan_plots_file, filepaths))
+
+
+def _renamed(title: str, taken: set) -> str:
+    n = 2
+    while f'{title} ({n})' in taken:
+        n += 1
+    return f'{title} ({n})'
+
+
+def _retitled(plot: dict, key: str, new: str) -> dict:
+    # A plot titled after its key takes on the new key, otherwise its own title gets the same suffix as the key (e.g.
+    # "Problem specified to mango framework (2)" for a renamed 'problem_definition'):
+    if not isinstance(plot, dict) or not isinstance(plot.get('_title'), str):
+        return plot
+    title = new if plot['_title'] == key else plot['_title'] + new[len(key):]
+    return dict(plot, _title=title)
+
+
+def plan_merge(scans: list, on_collision: str = 'rename') -> tuple:
+    """
+    Works out where every plot of the scanned inputs ends up in the merged file.
+
+    :param scans: The output of scan_plots_file for every input (in order)
+    :param on_collision: How plots sharing a title are resolved, see ON_COLLISION
+    :return: The (old key, new key) pairs to copy over for every input, and the design id offset of every input
+    """
+    if on_collision not in ON_COLLISION:
+        raise Exception(f'Invalid value for on_collision, only options are: {ON_COLLISION}')
+    offsets, offset = [], 0
+    for scan in scans:
+        offsets.append(offset)
+        offset += scan['max_design_id'] + 1
+
+    taken = {key for scan in scans for key in scan['keys'] if design_id(key) is None}
+    owners, plans, collisions = {}, [], []
+    for i, scan in enumerate(scans):
+        plan = []
+        for key in scan['keys']:
+            design = design_id(key)
+            if design is not None:
+                plan.append((key, design_key(design + offsets[i])))
+            elif key not in owners:
+                owners[key] = (i, len(plan))
+                plan.append((key, key))
+            elif on_collision == 'rename':
+                new = _renamed(key, taken)
+                taken.add(new)
+                plan.append((key, new))
+            elif on_collision == 'last':
+                j, position = owners[key]
+                (plans[j] if j < len(plans) else plan)[position] = None  # Dropped in favor of this one
+                owners[key] = (i, len(plan))
+                plan.append((key, key))
+            else:
+                collisions.append(key)
+        plans.append(plan)
+    if collisions and on_collision == 'error':
+        raise Exception(f'The following plot titles are held by more than one input: {sorted(set(collisions))}')
+    return [[pair for pair in plan if pair is not None] for plan in plans], offsets
+
+
+def merge_plots_files(filepaths: list, output_filepath: str, on_collision: str = 'rename',
+                      max_workers: Optional[int] = None, executor: Optional[Executor] = None,
+                      write_index: bool = False) -> dict:
+    """
+    Merges the .plots files filepaths (along with their logs) into a single file output_filepath, see the top of this
+    script for how design ids and title collisions are handled. The output is written as the newest version of its
+    inputs, and is replaced atomically once it is complete.
+
+    :param filepaths: The .plots files to merge, in order
+    :param output_filepath: Where to write the merged file to (may not be one of the inputs)
+    :param on_collision: How plots sharing a title are resolved: 'rename', 'first', 'last', or 'error'
+    :param max_workers: Number of processes scanning the inputs (defaults to the number of CPUs). 1 runs serially.
+    :param executor: An existing executor to scan the inputs with (e.g. to re-use one ProcessPoolExecutor)
+    :param write_index: If True, a sidecar index is written for the output (see LazyPlots)
+    :return: A report holding the number of plots and designs written, the renamed plots as {input: {old: new}}, the
+             plots dropped by 'first' / 'last' as {input: [titles]}, and the design id offset of every input
+    """
+    if not filepaths:
+        raise Exception('No .plots files were passed in to merge.')
+    if os.path.abspath(output_filepath) in {os.path.abspath(f) for f in filepaths}:
+        raise Exception(f'The output {output_filepath} can not also be one of the inputs being merged.')
+    scans = _scan_all(list(filepaths), max_workers, executor)
+    plans, offsets = plan_merge(scans, on_collision)
+
+    report = {'plots': 0, 'designs': 0, 'renamed': {}, 'dropped': {}, 'design_offsets': dict(zip(filepaths, offsets))}
+    designs = None
+    with PlotsStreamWriter(output_filepath, version=max(scan['version'] for scan in scans),
+                           write_index=write_index) as writer:
+        for filepath, scan, plan, offset in zip(filepaths, scans, plans, offsets):
+            # The index handed back by scan_plots_file means the input is not scanned a second time here:
+            with LazyPlots(filepath, cache_size=0, index=scan['index']) as plots:
+                arrays, layouts = set(), set()  # The shared arrays / layouts referenced by the plots that are kept
+                for key, new in plan:
+                    raw = plots.raw(key)
+                    found_arrays, found_layouts = raw_references(raw)
+                    arrays.update(found_arrays)
+                    layouts.update(found_layouts)
+                    if key == new or design_id(key) is not None:
+                        writer.write_raw(new, raw)  # Copied over as-is
+                    else:
+                        writer.write(new, _retitled(json.loads(raw), key, new))
+                        report['renamed'].setdefault(filepath, {})[key] = new
+                    report['designs' if design_id(key) is not None else 'plots'] += 1
+                dropped = set(scan['keys']) - {key for key, _ in plan}
+                if dropped:
+                    report['dropped'][filepath] = [key for key in scan['keys'] if key in dropped]
+
+                if plots.designs:
+                    shifted = offset_design_ids(plots.designs, offset, plots.arrays)
+                    designs = merge_designs(designs or {'chunks': [], 'removed': []}, shifted)
+                    report['designs'] += len(set(design_ids(shifted).tolist()) - set(shifted['removed']))
+                    referenced_arrays(shifted, arrays)
+                # Only the layouts / arrays still referenced are copied over (not those of plots dropped by 'first' /
+                # 'last'). They are keyed by a hash of their content, so a key holds the same value in every file:
+                for key, layout in plots.layouts.items():
+                    if key in layouts:
+                        writer.write_layout(key, layout)
+                for key in plots.arrays:
+                    if key in arrays:
+                        writer.write_array_raw(key, plots.arrays.raw(key))
+        writer.write_designs(designs)
+    return report
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog='kodak-merge', description='Merges many .plots files into a single file.')
+    parser.add_argument('output', help='Path of the merged .plots file to write')
+    parser.add_argument('inputs', nargs='+', help='The .plots files to merge (in order)')
+    parser.add_argument('--on-collision', choices=ON_COLLISION, default='rename',
+                        help='How plots sharing a title are resolved (default: rename)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes scanning the inputs (defaults to the number of CPUs)')
+    parser.add_argument('--index', action='store_true', help='Also write a sidecar index for the output')
+    args = parser.parse_args(argv)
+    try:
+        report = merge_plots_files(args.inputs, args.output, on_collision=args.on_collision,
+                                   max_workers=args.workers, write_index=args.index)
+    except Exception as e:
+        print(f'kodak-merge: {e}', file=sys.stderr)
+        sys.exit(1)
+    renamed = sum(len(r) for r in report['renamed'].values())
+    dropped = sum(len(d) for d in report['dropped'].values())
+    print(f'Merged {len(args.inputs)} files into {args.output}: {report["plots"]} plots, {report["designs"]} designs '
+          f'({renamed} renamed, {dropped} dropped)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,601 @@
+"""
+This script holds the helpers used to encode / decode the contents of a ".plots" file.
+
+Version 1 files store every figure as a JSON string inside of the '_data' field (i.e. the output of fig.to_json()),
+which means the figure gets escaped twice when the file is written and every float is written out as decimal text.
+Version 2 files embed the figure as a real nested object, and large numeric arrays are written as base64 typed-array
+blocks following the same layout Plotly uses ({'dtype': 'f8', 'bdata': '...', 'shape': '1000'}).
+
+Version 2 files may also hold a shared '_arrays' table of typed-array blocks keyed by their content hash. Arrays that are
+re-used across traces / plots (e.g. a common x-axis) are then stored once and referenced as {'_array': '<hash>'}.
+Likewise, an optional '_layouts' table stores each distinct figure layout once, with the figures pointing to it through
+{'_layout': '<template id>'} in place of their layout, and an optional '_designs' block holds the interactive design
+maps in columnar form (see kodak.design_store) rather than as one INTERACTIVE_DESIGN_n entry per design.
+"""
+import base64
+import hashlib
+import json
+import math
+import os
+import re
+from collections.abc import Mapping
+from typing import Any, Optional
+import numpy as np
+
+PLOTS_FORMAT_VERSION = 2  # The version written by KodakPlots unless told otherwise
+VERSION_KEY = '_kodak_version'  # Top-level key storing the format version (absent in version 1 files)
+ARRAYS_KEY = '_arrays'  # Top-level key storing the shared table of typed-array blocks
+ARRAY_REF = '_array'  # Key of a reference to an entry in the shared table of typed-array blocks
+LAYOUTS_KEY = '_layouts'  # Top-level key storing the shared table of figure layouts
+LAYOUT_REF = '_layout'  # Key of a reference to an entry in the shared table of figure layouts
+DESIGNS_KEY = '_designs'  # Top-level key storing the columnar interactive design maps (see kodak.design_store)
+RESERVED_KEYS = (VERSION_KEY, ARRAYS_KEY, LAYOUTS_KEY, DESIGNS_KEY)  # Top-level keys which are NOT plots
+ARRAY_THRESHOLD = 64  # Arrays with fewer elements than this are just written out as plain lists
+
+# These are the typed arrays the Plotly.js bdata specification supports:
+_SUPPORTED_DTYPES = {'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2', 'int32': 'i4', 'uint32': 'u4',
+                     'float32': 'f4', 'float64': 'f8'}
+
+
+def _typed_array(arr: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Returns the array cast to a dtype that can be stored as a typed-array block, or None if it can not be stored
+    without losing information (e.g. strings, objects, or 64-bit integers that do not fit in 32 bits).
+    """
+    kind = arr.dtype.kind
+    if kind == 'f':
+        return arr if arr.dtype.name in _SUPPORTED_DTYPES else arr.astype(np.float64)
+    elif kind in 'iu':
+        if arr.dtype.name in _SUPPORTED_DTYPES:
+            return arr
+        # 64-bit integers are not supported by the typed array spec, so we downcast if the values allow it:
+        if arr.size == 0:
+            return arr.astype(np.int32)
+        lo, hi = arr.min(), arr.max()
+        if lo >= 0 and hi <= np.iinfo(np.uint32).max:
+            return arr.astype(np.uint32) if hi > np.iinfo(np.int32).max else arr.astype(np.int32)
+        elif lo >= np.iinfo(np.int32).min and hi <= np.iinfo(np.int32).max:
+            return arr.astype(np.int32)
+    return None
+
+
+def is_array_block(obj: Any) -> bool:
+    return isinstance(obj, dict) and 'bdata' in obj and 'dtype' in obj
+
+
+def is_array_ref(obj: Any) -> bool:
+    return isinstance(obj, dict) and len(obj) == 1 and ARRAY_REF in obj
+
+
+def is_layout_ref(obj: Any) -> bool:
+    return isinstance(obj, dict) and len(obj) == 1 and LAYOUT_REF in obj
+
+
+def _pack_array(arr: np.ndarray) -> tuple:
+    # Returns the dtype code, shape string, and the little-endian bytes of an array:
+    typed = _typed_array(np.asarray(arr))
+    if typed is None:
+        raise Exception(f'Can not encode an array of dtype {arr.dtype} as a typed-array block.')
+    code = _SUPPORTED_DTYPES[typed.dtype.name]
+    raw = np.ascontiguousarray(typed, dtype=np.dtype(code).newbyteorder('<')).tobytes()
+    return code, ', '.join(str(s) for s in typed.shape), raw
+
+
+def _block(code: str, shape: str, raw: bytes) -> dict:
+    return {'dtype': code, 'bdata': base64.b64encode(raw).decode('ascii'), 'shape': shape}
+
+
+def encode_array(arr: np.ndarray, arrays: Optional['ArrayTable'] = None) -> dict:
+    """
+    Encodes a numeric numpy array as a typed-array block. The bytes are always stored little-endian. If an ArrayTable is
+    passed in, the block is stored in the table and a reference to it is returned instead.
+    """
+    code, shape, raw = _pack_array(arr)
+    if arrays is not None:
+        return {ARRAY_REF: arrays.add(code, shape, raw)}
+    return _block(code, shape, raw)
+
+
+class ArrayTable(dict):
+    """
+    Shared table of typed-array blocks keyed by a hash of their content (dtype, shape, and bytes). This is written out
+    under the '_arrays' key of a .plots file so that every distinct array is only stored once.
+
+    :param blocks: Blocks to start the table with (e.g. the '_arrays' table of a file that was read in)
+    :param base: Optional read-only mapping of blocks to fall back on (e.g. the '_arrays' of a lazily read file)
+    """
+    def __init__(self, blocks: Optional[dict] = None, base: Optional[Mapping] = None) -> None:
+        super().__init__(blocks or {})
+        self.base = base
+        self.sink = None  # If set, new blocks are handed to sink(key, block) instead of being held (streaming output)
+        self._streamed = set()
+        self.references = 0  # Number of times an array was added to the table
+        self.bytes_saved = 0  # Number of (base64) bytes that did not have to be written thanks to de-duplication
+
+    def __missing__(self, key: str) -> dict:
+        if self.base is not None:
+            return self.base[key]
+        raise KeyError(key)
+
+    def block(self, key: str) -> dict:
+        """
+        Returns the typed-array block of key. The base mapping may hold plain numpy arrays (e.g. the memory-mapped arrays
+        of a container file, see kodak.container), which get encoded here.
+        """
+        value = self[key]
+        if isinstance(value, np.ndarray):
+            return _block(*_pack_array(value))
+        return value
+
+    def known(self, key: str) -> bool:
+        return key in self or key in self._streamed or (self.base is not None and key in self.base)
+
+    def add(self, code: str, shape: str, raw: bytes) -> str:
+        key = hashlib.blake2b(f'{code}|{shape}|'.encode() + raw, digest_size=16).hexdigest()
+        self.references += 1
+        if self.known(key):
+            self.bytes_saved += 4 * ((len(raw) + 2) // 3)
+        else:
+            self._insert(key, _block(code, shape, raw))
+        return key
+
+    def _insert(self, key: str, block: dict) -> None:
+        if self.sink is not None:
+            self.sink(key, block)
+            self._streamed.add(key)
+        else:
+            self[key] = block
+
+    def stream_to(self, sink) -> None:
+        """
+        New blocks are handed to sink(key, block) (e.g. PlotsStreamWriter.write_array) rather than held in the table.
+        """
+        self.sink = sink
+
+    def stop_streaming(self) -> None:
+        # Blocks that were streamed out are forgotten so that they get stored again if they are re-used afterwards:
+        self.sink = None
+        self._streamed.clear()
+
+    def merge(self, other: 'ArrayTable') -> None:
+        """
+        Merges a table built elsewhere (e.g. inside of a worker process) into this one.
+        """
+        self.references += other.references
+        self.bytes_saved += other.bytes_saved
+        for key, block in other.items():
+            if self.known(key):
+                self.bytes_saved += len(block['bdata'])
+            else:
+                self._insert(key, block)
+
+    def report(self) -> dict:
+        return {'unique_arrays': len(self) + len(self._streamed), 'references': self.references,
+                'bytes_saved': self.bytes_saved}
+
+
+def referenced_arrays(obj: Any, found: Optional[set] = None) -> set:
+    """
+    Returns the set of shared array keys referenced anywhere inside of obj.
+    """
+    found = set() if found is None else found
+    if isinstance(obj, dict):
+        if is_array_ref(obj):
+            found.add(obj[ARRAY_REF])
+        else:
+            for v in obj.values():
+                referenced_arrays(v, found)
+    elif isinstance(obj, list):
+        for v in obj:
+            referenced_arrays(v, found)
+    return found
+
+
+def referenced_layouts(plots: Mapping) -> set:
+    """
+    Returns the set of shared layout ids referenced by the figures of plots.
+    """
+    found = set()
+    for plot in plots.values():
+        data = plot.get('_data') if isinstance(plot, dict) else None
+        if isinstance(data, dict) and is_layout_ref(data.get('layout')):
+            found.add(data['layout'][LAYOUT_REF])
+    return found
+
+
+_RAW_REF = re.compile(rb'"(_array|_layout)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def raw_references(raw: bytes) -> tuple:
+    """
+    Returns the sets of shared array keys and shared layout ids referenced by the serialized JSON of a plot, without
+    parsing it. Text inside of a JSON string can not match, since every quote inside of a string is escaped.
+    """
+    arrays, layouts = set(), set()
+    for m in _RAW_REF.finditer(raw):
+        (arrays if m.group(1) == b'_array' else layouts).add(json.loads(b'"' + m.group(2) + b'"'))
+    return arrays, layouts
+
+
+class TrackedPlots(dict):
+    """
+    Dictionary of plots (i.e. KodakPlots.all_plots) which reports every key that is set or removed to
+    listener(key, removed), so that append_json_output also picks up plots edited directly through the dictionary.
+    Looking a plot up through plots[key] / plots.get(key) reports it as set as well, since it may be edited in place;
+    use peek(key) for a plain read. Plots reached through values() / items() are not tracked, so store them again
+    (plots[key] = plot) after editing them in place.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.listener = None
+
+    def _set(self, key: str) -> None:
+        if self.listener is not None:
+            self.listener(key, False)
+
+    def _removed(self, key: str) -> None:
+        if self.listener is not None:
+            self.listener(key, True)
+
+    def peek(self, key: str) -> Any:
+        return super().__getitem__(key)
+
+    def __getitem__(self, key: str) -> Any:
+        value = super().__getitem__(key)
+        self._set(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            return default
+        return self[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        self._set(key)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._removed(key)
+
+    def pop(self, key: str, *default: Any) -> Any:
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self._removed(key)
+        return value
+
+    def popitem(self) -> tuple:
+        key, value = super().popitem()
+        self._removed(key)
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other: Mapping) -> 'TrackedPlots':
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        for key in list(self):
+            del self[key]
+
+
+def decode_array(block: dict) -> np.ndarray:
+    raw = base64.b64decode(block['bdata'])
+    arr = np.frombuffer(raw, dtype=np.dtype(block['dtype']).newbyteorder('<'))
+    shape = block.get('shape')
+    if shape is not None and ',' in str(shape):
+        arr = arr.reshape([int(s) for s in str(shape).split(',')])
+    return arr
+
+
+def _iso(value: Any) -> Any:
+    # datetime64[us].tolist() gives (nested lists of) datetimes, which are written out the way plotly writes them:
+    if isinstance(value, list):
+        return [_iso(v) for v in value]
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _finite(value: Any) -> Any:
+    # NaN / inf are written as null (as plotly does), the NaN / Infinity tokens are not valid JSON (e.g. JSON.parse):
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    elif isinstance(value, list):
+        return [_finite(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    return value
+
+
+def array_list(arr: np.ndarray) -> list:
+    """
+    Converts an array that is not stored as a typed-array block to a JSON-ready list: dates become ISO strings (NaT
+    becomes null), durations become seconds, and NaN / inf become null. A plain tolist() would turn datetime64[ns] into
+    integers.
+    """
+    kind = arr.dtype.kind
+    if kind == 'M':
+        return _iso(arr.astype('datetime64[us]').tolist())
+    elif kind == 'm':
+        return _finite((arr / np.timedelta64(1, 's')).tolist())
+    elif kind in 'fO':
+        return _finite(arr.tolist())
+    return arr.tolist()
+
+
+def scalar_value(obj: np.generic) -> Any:
+    # The datetime64 / timedelta64 scalars go through array_list so they are written like the arrays are:
+    if obj.dtype.kind in 'Mm':
+        return array_list(np.asarray(obj))
+    return _finite(obj.item())
+
+
+def encode_value(obj: Any, threshold: int = ARRAY_THRESHOLD, arrays: Optional[ArrayTable] = None) -> Any:
+    """
+    Recursively walks a (plotly json) object and replaces every large numeric array with a typed-array block (or a
+    reference into arrays, if given). Small or non-numeric numpy arrays are converted to lists (see array_list), and
+    NaN / inf to None, so that the output can be passed straight to json.dump
+    """
+    if isinstance(obj, dict):
+        return {k: encode_value(v, threshold, arrays) for k, v in obj.items()}
+    elif isinstance(obj, np.ndarray):
+        if obj.size >= threshold and _typed_array(obj) is not None:
+            return encode_array(obj, arrays)
+        return array_list(obj)
+    elif isinstance(obj, (list, tuple)):
+        # Users commonly pass in plain lists, so we also try to pack the large numeric ones:
+        if len(obj) >= threshold and isinstance(obj[0], (int, float, np.number)) and not isinstance(obj[0], bool):
+            arr = np.asarray(obj)
+            if arr.ndim == 1 and _typed_array(arr) is not None:
+                return encode_array(arr, arrays)
+        return [encode_value(v, threshold, arrays) for v in obj]
+    elif isinstance(obj, np.generic):
+        return scalar_value(obj)
+    elif isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    return obj
+
+
+def decode_value(obj: Any, as_lists: bool = False, arrays: Optional[Mapping] = None) -> Any:
+    """
+    The inverse of encode_value, every typed-array block (or reference to a block in arrays) is replaced with a numpy
+    array (or a list if as_lists).
+    """
+    if is_array_block(obj) or is_array_ref(obj):
+        if is_array_ref(obj):
+            if arrays is None:
+                raise Exception(f'Can not resolve the shared array {obj[ARRAY_REF]} without its "_arrays" table.')
+            obj = arrays[obj[ARRAY_REF]]
+        arr = obj if isinstance(obj, np.ndarray) else decode_array(obj)
+        return arr.tolist() if as_lists else arr
+    elif isinstance(obj, dict):
+        return {k: decode_value(v, as_lists, arrays) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [decode_value(v, as_lists, arrays) for v in obj]
+    return obj
+
+
+def json_default(obj: Any) -> Any:
+    """
+    Fallback passed to json.dump for the odd objects that may still be hiding in a plot (numpy scalars, dates, ...)
+    """
+    if isinstance(obj, np.ndarray):
+        return array_list(obj)
+    elif isinstance(obj, np.generic):
+        return scalar_value(obj)
+    elif hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj: Any, **kwargs) -> str:
+    """
+    json.dumps for everything written to a .plots file: NaN / inf are written as null rather than as the NaN / Infinity
+    tokens which strict JSON parsers (e.g. the JSON.parse of the viewer) reject. Values which went through encode_value
+    are already free of them, anything else (e.g. a plot set directly on all_plots) is cleaned up on the way out.
+    """
+    kwargs.setdefault('default', json_default)
+    try:
+        return json.dumps(obj, allow_nan=False, **kwargs)
+    except ValueError:
+        return json.dumps(_finite(obj), allow_nan=False, **kwargs)
+
+
+def file_version(contents: dict) -> int:
+    return int(contents.get(VERSION_KEY, 1))
+
+
+def plot_keys(contents: dict) -> list:
+    return [k for k in contents.keys() if k not in RESERVED_KEYS]
+
+
+def figure_dict(plot: dict, as_lists: bool = False, arrays: Optional[Mapping] = None,
+                layouts: Optional[Mapping] = None) -> dict:
+    """
+    Returns the decoded plotly figure dictionary for a plot read in from either a version 1 or version 2 file. The
+    arrays and layouts are the shared '_arrays' and '_layouts' tables of the file the plot came from (if it has them).
+    """
+    data = plot.get('_data')
+    if isinstance(data, str):
+        return json.loads(data)  # Version 1: The figure is stored as a JSON string
+    if isinstance(data, dict) and is_layout_ref(data.get('layout')):
+        if layouts is None:
+            raise Exception(f'Can not resolve the shared layout {data["layout"][LAYOUT_REF]} without its "_layouts" '
+                            f'table.')
+        data = dict(data, layout=layouts[data['layout'][LAYOUT_REF]])
+    return decode_value(data, as_lists=as_lists, arrays=arrays)
+
+
+"""
+Sidecar index files: A ".plots.idx" file next to a .plots file stores the byte range of every entry so that the file can
+be opened lazily without scanning it. The size and modification time of the .plots file are stored alongside so that
+a stale index is never used.
+"""
+INDEX_EXTENSION = '.idx'
+
+
+def index_path(filepath: str) -> str:
+    return filepath + INDEX_EXTENSION
+
+
+def save_index(filepath: str, index: dict, version: int) -> None:
+    stat = os.stat(filepath)
+    sidecar = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': version,
+               'index': {k: list(v) for k, v in index.items()}}
+    with open(index_path(filepath), 'w') as f:
+        f.write(json.dumps(sidecar, separators=(',', ':')))
+
+
+def load_index(filepath: str) -> Optional[tuple]:
+    """
+    Returns the (index, version) stored in the sidecar of filepath, or None if there is no (valid) sidecar.
+    """
+    try:
+        with open(index_path(filepath), 'r') as f:
+            sidecar = json.load(f)
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return None
+    if sidecar.get('size') != stat.st_size or sidecar.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return {k: tuple(v) for k, v in sidecar['index'].items()}, int(sidecar['version'])
+
+
+"""
+Append-only log: Plots added / replaced (or removed) after a .plots file was written can be appended to a ".plots.log"
+file next to it instead of re-writing the whole file. Each line of the log is one segment:
+    {"base": [size, mtime_ns], "version": 2, "plots": {...}, "deleted": [...], "layouts": {...}, "arrays": {...},
+     "designs": {"chunks": [...], "removed": [...]}}
+Segments are applied in order on top of the .plots file when it is read in. The base of a segment is the size and
+modification time of the .plots file it was appended to, so once the file is re-written (e.g. compacted, which merges the
+log into the file) any leftover segments no longer apply. A segment cut short by a crash is ignored (and cut off before
+the next segment is appended).
+"""
+LOG_EXTENSION = '.log'
+
+
+def log_path(filepath: str) -> str:
+    return filepath + LOG_EXTENSION
+
+
+def sync_file(f) -> None:
+    """
+    Flushes the open file f all the way to disk, e.g. before it is renamed over a file (otherwise a crash right after
+    the rename can leave an empty / partial file behind on some file systems).
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def sync_directory(filepath: str) -> None:
+    """
+    Flushes the directory holding filepath to disk, so that a rename into it is durable before e.g. the log of the file
+    is removed. Platforms which can not open a directory (Windows) are skipped.
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filepath)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _file_base(filepath: str) -> list:
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _drop_torn_tail(f) -> None:
+    # Cuts off a partially written last line (the log always ends with a newline otherwise):
+    end = f.seek(0, os.SEEK_END)
+    pos = end
+    while pos > 0:
+        start = max(pos - 65536, 0)
+        f.seek(start)
+        newline = f.read(pos - start).rfind(b'\n')
+        if newline != -1:
+            if start + newline + 1 != end:
+                f.truncate(start + newline + 1)
+            return
+        pos = start
+    f.truncate(0)
+
+
+def append_segment(filepath: str, plots: dict, deleted: Optional[list] = None, layouts: Optional[dict] = None,
+                   arrays: Optional[dict] = None, version: int = PLOTS_FORMAT_VERSION,
+                   designs: Optional[dict] = None) -> None:
+    """
+    Appends a segment to the log of filepath (which must exist). The segment is flushed to disk before returning.
+    """
+    segment = {'base': _file_base(filepath), 'version': version, 'plots': plots, 'deleted': deleted or [],
+               'layouts': layouts or {}, 'arrays': arrays or {}}
+    if designs:
+        segment['designs'] = designs
+    raw = dumps(segment, separators=(',', ':')).encode() + b'\n'
+    with open(log_path(filepath), 'ab+') as f:
+        _drop_torn_tail(f)
+        f.write(raw)
+        sync_file(f)
+
+
+def read_segments(filepath: str) -> list:
+    """
+    Returns the (complete) segments of the log of filepath which apply to the current .plots file, in order.
+    """
+    try:
+        f = open(log_path(filepath), 'rb')
+    except FileNotFoundError:
+        return []
+    base = _file_base(filepath)
+    segments = []
+    with f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # Torn write
+            try:
+                segment = json.loads(line)
+            except ValueError:
+                break
+            if segment.get('base') == base:
+                segments.append(segment)
+    return segments
+
+
+def apply_segments(contents: dict, segments: list) -> dict:
+    """
+    Applies log segments to the contents of a .plots file (as read in by json.load), in place.
+    """
+    for segment in segments:
+        for key in segment['deleted']:
+            contents.pop(key, None)
+        contents.update(segment['plots'])
+        for table_key, segment_key in ((LAYOUTS_KEY, 'layouts'), (ARRAYS_KEY, 'arrays')):
+            if segment[segment_key]:
+                # The tables are moved to the end so that they stay after the plots:
+                contents[table_key] = {**contents.pop(table_key, {}), **segment[segment_key]}
+        if segment.get('designs'):
+            merge_designs(contents.setdefault(DESIGNS_KEY, {'chunks': [], 'removed': []}), segment['designs'])
+        if segment['version'] > file_version(contents):
+            contents[VERSION_KEY] = segment['version']
+    return contents
+
+
+def merge_designs(designs: dict, other: dict) -> dict:
+    """
+    Merges the '_designs' block of a log segment into designs (in place): Its chunks are added after those of designs.
+    """
+    designs['chunks'] = designs.get('chunks', []) + other.get('chunks', [])
+    designs['removed'] = designs.get('removed', []) + other.get('removed', [])
+    return designs
@@ -0,0 +1,310 @@
+"""
+This script holds a lazy reader for ".plots" files. Rather than running json.load over the whole file, the file is
+memory-mapped and a single scan records the byte range of every top-level entry (or the ranges are loaded from a sidecar
+index file). A plot is only parsed when it is accessed, which makes opening a very large file to edit one figure cheap.
+The segments of the append-only log of the file (see plots_format.append_segment) are applied on top when it is opened.
+"""
+import re
+import json
+import mmap
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Iterator, Optional, Union
+from kodak.plots_format import (ARRAYS_KEY, DESIGNS_KEY, LAYOUTS_KEY, RESERVED_KEYS, VERSION_KEY, figure_dict,
+                                dumps, load_index, merge_designs, read_segments, save_index)
+
+_STRUCTURE = re.compile(rb'[{}\[\]"]')
+_WHITESPACE = re.compile(rb'[ \t\r\n]*')
+_SCALAR = re.compile(rb'[^,}\] \t\r\n]*')
+
+
+def _skip_whitespace(buffer: Union[bytes, mmap.mmap], pos: int) -> int:
+    return _WHITESPACE.match(buffer, pos).end()
+
+
+def _string_end(buffer: Union[bytes, mmap.mmap], pos: int) -> int:
+    # pos is the index of the opening quote, we return the index just past the closing quote. Note: bytes.find is used
+    # over a regular expression since it is far faster on the (very long) strings holding typed-array blocks.
+    start = pos
+    while True:
+        end = buffer.find(b'"', pos + 1)
+        if end == -1:
+            raise Exception(f'Invalid .plots file, unterminated string starting at byte {start}.')
+        # An odd number of backslashes directly before the quote means that the quote is escaped:
+        slashes = 0
+        while buffer[end - 1 - slashes] == 92:
+            slashes += 1
+        if slashes % 2 == 0:
+            return end + 1
+        pos = end
+
+
+def _value_end(buffer: Union[bytes, mmap.mmap], pos: int) -> int:
+    first = buffer[pos:pos + 1]
+    if first == b'"':
+        return _string_end(buffer, pos)
+    elif first not in (b'{', b'['):
+        return _SCALAR.match(buffer, pos).end()  # number, true, false, or null
+
+    # Otherwise we jump from bracket to bracket (skipping over strings) until we are back at the starting depth:
+    depth = 0
+    while True:
+        m = _STRUCTURE.search(buffer, pos)
+        if m is None:
+            raise Exception('Invalid .plots file, reached the end of the file inside of an object.')
+        char = buffer[m.start():m.end()]
+        if char == b'"':
+            pos = _string_end(buffer, m.start())
+            continue
+        depth += 1 if char in (b'{', b'[') else -1
+        pos = m.end()
+        if depth == 0:
+            return pos
+
+
+def scan_index(buffer: Union[bytes, mmap.mmap], start: int = 0) -> dict:
+    """
+    Returns a dictionary of {key: (start, end)} byte ranges for every top-level entry of a .plots file (or of the JSON
+    object beginning at byte start, e.g. the shared '_arrays' table).
+    """
+    index = {}
+    pos = _skip_whitespace(buffer, start)
+    if buffer[pos:pos + 1] != b'{':
+        raise Exception('Invalid .plots file, expected the file to start with a JSON object.')
+    pos += 1
+    while True:
+        pos = _skip_whitespace(buffer, pos)
+        char = buffer[pos:pos + 1]
+        if char == b'}':
+            return index
+        elif char == b',':
+            pos = _skip_whitespace(buffer, pos + 1)
+        if buffer[pos:pos + 1] != b'"':
+            raise Exception(f'Invalid .plots file, unexpected character at byte {pos}.')
+        key_end = _string_end(buffer, pos)
+        key = json.loads(buffer[pos:key_end])
+        pos = _skip_whitespace(buffer, key_end)
+        if buffer[pos:pos + 1] != b':':
+            raise Exception(f'Invalid .plots file, expected ":" at byte {pos}.')
+        pos = _skip_whitespace(buffer, pos + 1)
+        end = _value_end(buffer, pos)
+        index[key] = (pos, end)
+        pos = end
+
+
+class LazyArrays(Mapping):
+    """
+    Read-only mapping over the shared '_arrays' table of a lazily read .plots file. The table is only indexed the first
+    time an array is needed, and each block is only parsed when it is accessed. The blocks in extra (e.g. those of the
+    append-only log of the file) are held in memory.
+    """
+    def __init__(self, buffer: Union[bytes, mmap.mmap], byte_range: Optional[tuple],
+                 extra: Optional[dict] = None) -> None:
+        self._buffer = buffer
+        self._range = byte_range
+        self._index = None
+        self.extra = {} if extra is None else extra
+
+    def _ensure_index(self) -> dict:
+        if self._index is None:
+            self._index = scan_index(self._buffer, self._range[0]) if self._range is not None else {}
+        return self._index
+
+    def raw(self, key: str) -> bytes:
+        if key in self.extra:
+            return json.dumps(self.extra[key], separators=(',', ':')).encode()
+        start, end = self._ensure_index()[key]
+        return self._buffer[start:end]
+
+    def __getitem__(self, key: str) -> dict:
+        if key in self.extra:
+            return self.extra[key]
+        return json.loads(self.raw(key))
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.extra or key in self._ensure_index()
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._ensure_index()
+        yield from (k for k in self.extra if k not in self._index)
+
+    def __len__(self) -> int:
+        return len(self._ensure_index()) + sum(k not in self._index for k in self.extra)
+
+
+class LazyPlots(MutableMapping):
+    """
+    Dictionary-like view of a .plots file where each plot is only read in (and parsed) when it is accessed:
+
+        plots = LazyPlots('my_run.plots')
+        fig = plots.get_figure('My scatter trace')
+
+    Plots which are added / replaced are held in memory, everything else stays on disk until the file is written out
+    (see write_to). A plot accessed through plots[key] is also held on to once it is parsed, so that edits made to it in
+    place are written out (parsed_items walks over the file without holding on to the plots). Decoded plotly figures are
+    kept in a small LRU cache of size cache_size (0 disables the cache).
+    If use_index is True the sidecar index file is used when it is valid, and written out after a scan otherwise (unless
+    write_index is False, or the sidecar can not be written, e.g. in a read-only directory). An (index, version) pair
+    from the file_index of an earlier LazyPlots of the same (unchanged) file may be passed in as index to skip the scan.
+    As for plots_format.TrackedPlots, every key set / removed (or looked up through plots[key]) after opening the file
+    is reported to listener(key, removed) if a listener is set; peek(key) parses a plot without holding on to it.
+    """
+    def __init__(self, filepath: str, cache_size: int = 8, use_index: bool = True, write_index: bool = True,
+                 index: Optional[tuple] = None) -> None:
+        self.filepath = filepath
+        self.cache_size = cache_size
+        self._file = open(filepath, 'rb')
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._buffer = b''  # mmap refuses empty files
+
+        sidecar = index if index is not None else load_index(filepath) if use_index else None
+        if sidecar is not None:
+            index, self.version = sidecar
+        else:
+            index = scan_index(self._buffer)
+            self.version = int(json.loads(self._raw(index[VERSION_KEY]))) if VERSION_KEY in index else 1
+            if use_index and write_index:
+                try:
+                    save_index(filepath, index, self.version)
+                except OSError:
+                    pass  # The sidecar only saves a scan the next time, so the file is still read in without it
+        self.file_index = (index, self.version)
+
+        self._index = {k: v for k, v in index.items() if k not in RESERVED_KEYS}
+        self.arrays = LazyArrays(self._buffer, index.get(ARRAYS_KEY))  # The shared arrays of the file (if any)
+        # The shared layouts are small (one per distinct layout), so they are read in right away:
+        self.layouts = json.loads(self._raw(index[LAYOUTS_KEY])) if LAYOUTS_KEY in index else {}
+        # As is the '_designs' block (see design_store.DesignStore.decode):
+        self.designs = json.loads(self._raw(index[DESIGNS_KEY])) if DESIGNS_KEY in index else None
+        self._order = dict.fromkeys(self._index)  # Insertion ordered set of all keys
+        self._changed = {}  # Plots added / replaced since the file was opened
+        self._figures = OrderedDict()
+        self.listener = None
+
+        # Plots appended to the log of the file are held in memory just like plots added after opening it:
+        for segment in read_segments(filepath):
+            for key in segment['deleted']:
+                if key in self._order:
+                    del self[key]
+            for key, value in segment['plots'].items():
+                self[key] = value
+            self.layouts.update(segment['layouts'])
+            self.arrays.extra.update(segment['arrays'])
+            if segment.get('designs'):
+                self.designs = merge_designs(self.designs or {'chunks': [], 'removed': []}, segment['designs'])
+            self.version = max(self.version, segment['version'])
+
+    def _raw(self, byte_range: tuple) -> bytes:
+        return self._buffer[byte_range[0]:byte_range[1]]
+
+    def raw(self, key: str) -> bytes:
+        """
+        Returns the serialized JSON of a plot, without parsing it.
+        """
+        if key in self._changed:
+            return dumps(self._changed[key], separators=(',', ':')).encode()
+        return self._raw(self._index[key])
+
+    def peek(self, key: str) -> Any:
+        if key in self._changed:
+            return self._changed[key]
+        return json.loads(self._raw(self._index[key]))
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._changed:
+            # Edits to the parsed plot (e.g. plots[key]['_description'] = ...) have to end up in the output:
+            self._changed[key] = json.loads(self._raw(self._index[key]))
+            self._figures.pop(key, None)
+        if self.listener is not None:
+            self.listener(key, False)
+        return self._changed[key]
+
+    @property
+    def held(self) -> dict:
+        # The plots held in memory (added / replaced / accessed through plots[key] since the file was opened):
+        return self._changed
+
+    def parsed_items(self) -> Iterator[tuple]:
+        """
+        Yields every (key, plot) of the file for a read-only pass over it: unlike plots[key], the parsed plots are not
+        held on to.
+        """
+        for key in self._order:
+            yield key, self.peek(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._changed[key] = value
+        self._order[key] = None
+        self._figures.pop(key, None)
+        if self.listener is not None:
+            self.listener(key, False)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._order:
+            raise KeyError(key)
+        del self._order[key]
+        self._changed.pop(key, None)
+        self._index.pop(key, None)
+        self._figures.pop(key, None)
+        if self.listener is not None:
+            self.listener(key, True)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._order)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._order
+
+    def get_figure(self, key: str, arrays: Optional[Mapping] = None, layouts: Optional[Mapping] = None):
+        """
+        Returns the plotly figure stored under key. Note that the cached figure itself is returned, so any edits made
+        to it are seen by later calls until it is evicted from the cache. Shared arrays (and layouts) are resolved from
+        arrays (and layouts), which default to the '_arrays' (and '_layouts') table of this file.
+        """
+        if key in self._figures:
+            self._figures.move_to_end(key)
+            return self._figures[key]
+        import plotly.graph_objs as go  # Only needed once a figure is actually built
+        fig = go.Figure(figure_dict(self.peek(key), arrays=self.arrays if arrays is None else arrays,
+                                    layouts=self.layouts if layouts is None else layouts))
+        if self.cache_size > 0:
+            self._figures[key] = fig
+            if len(self._figures) > self.cache_size:
+                self._figures.popitem(last=False)
+        return fig
+
+    def write_to(self, writer) -> None:
+        """
+        Writes every plot (and shared array / layout, and the designs) to a plots_writer.PlotsStreamWriter. Unchanged
+        plots are copied over byte for byte.
+        """
+        for key in self._order:
+            if key in self._changed:
+                writer.write(key, self._changed[key])
+            else:
+                writer.write_raw(key, self._raw(self._index[key]))
+        writer.write_designs(self.designs)
+        for key, layout in self.layouts.items():
+            writer.write_layout(key, layout)
+        for key in self.arrays:
+            writer.write_array_raw(key, self.arrays.raw(key))
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self) -> 'LazyPlots':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -0,0 +1,209 @@
+"""
+This script holds the incremental writer for ".plots" files. Rather than holding every figure in KodakPlots.all_plots
+until write_json_output is called, each entry is serialized and appended to disk as soon as it is created. This keeps
+memory flat regardless of how many plots end up in the file.
+"""
+import os
+import json
+import shutil
+import warnings
+from typing import Any, Callable, Optional
+from kodak.plots_format import (ARRAYS_KEY, DESIGNS_KEY, LAYOUTS_KEY, PLOTS_FORMAT_VERSION, RESERVED_KEYS, VERSION_KEY,
+                                dumps, log_path, save_index, sync_directory, sync_file)
+from kodak.plots_reader import LazyPlots
+from kodak.design_store import DesignStore
+
+
+class PlotsStreamWriter(object):
+    """
+    Context manager which writes a valid .plots file one entry at a time:
+
+        with PlotsStreamWriter('output.plots') as writer:
+            writer.write('My plot', plot_dict)
+
+    The opening brace (and version key) is written on enter, and the closing brace is always written on exit so that
+    whatever was added before an error is still readable. The output goes to a temporary file which is renamed over
+    filepath on exit, so an existing file is never left half-written (and may be read from while writing). The temporary
+    file is flushed to disk before the rename. With replace_on_close=False the temporary file is only renamed over
+    filepath by an explicit call to replace() (e.g. once filepath is no longer open for reading, or only on success).
+
+    If write_index is True, a sidecar index (see plots_format.save_index) is written so that the file can be opened
+    lazily by plots_reader.LazyPlots without scanning it.
+
+    Shared arrays (see plots_format.ArrayTable) passed to write_array are appended to a second temporary file as they
+    come in, and are copied into the '_arrays' table of the output on exit, so they are not held in memory either.
+    Shared layouts passed to write_layout are small, and are held until they are written to the '_layouts' table on exit.
+    The same goes for the '_designs' block passed to write_designs.
+    """
+    def __init__(self, filepath: str, version: int = PLOTS_FORMAT_VERSION, write_index: bool = False,
+                 replace_on_close: bool = True) -> None:
+        self.filepath = filepath
+        self.version = version
+        self.write_index = write_index
+        self.replace_on_close = replace_on_close
+        self._file = None
+        self._offset = 0
+        self._index = {}  # Only the byte range of each entry is kept around (also used to warn on overwritten titles)
+        self._arrays_file = None
+        self._array_keys = set()
+        self._layouts = {}
+        self._designs = None
+
+    def __enter__(self) -> 'PlotsStreamWriter':
+        self._file = open(self.filepath + '.tmp', 'wb')
+        self._write(b'{')
+        if self.version >= 2:
+            self._write(f'{json.dumps(VERSION_KEY)}:{self.version}'.encode())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file is None
+
+    def _write(self, raw: bytes) -> None:
+        self._file.write(raw)
+        self._offset += len(raw)
+
+    def write(self, key: str, value: Any) -> None:
+        self.write_raw(key, dumps(value, separators=(',', ':')).encode())
+
+    def write_raw(self, key: str, raw: bytes) -> None:
+        """
+        Writes out an entry whose value has already been serialized to JSON (e.g. copied from another .plots file).
+        """
+        if self._file is None:
+            raise Exception('This PlotsStreamWriter is not open, please use it as a context manager.')
+        if key in self._index:
+            # Both entries end up in the file, but only the last one is kept when the file is read back in:
+            warnings.warn(f'The plot {key} was already written to {self.filepath} and will be overwritten on read.')
+        # Need a comma before every entry except for the very first one in a version 1 file:
+        if self._index or self.version >= 2:
+            self._write(b',')
+        self._write(json.dumps(key).encode())
+        self._write(b':')
+        start = self._offset
+        self._write(raw)
+        self._index[key] = (start, self._offset)
+
+    def write_array(self, key: str, block: dict) -> None:
+        self.write_array_raw(key, json.dumps(block, separators=(',', ':')).encode())
+
+    def write_array_raw(self, key: str, raw: bytes) -> None:
+        """
+        Adds a typed-array block to the shared '_arrays' table of the file (duplicate keys are skipped).
+        """
+        if self._file is None:
+            raise Exception('This PlotsStreamWriter is not open, please use it as a context manager.')
+        if key in self._array_keys:
+            return
+        if self._arrays_file is None:
+            self._arrays_file = open(self.filepath + '.arrays.tmp', 'wb+')
+        else:
+            self._arrays_file.write(b',')
+        self._arrays_file.write(json.dumps(key).encode() + b':' + raw)
+        self._array_keys.add(key)
+
+    def write_layout(self, key: str, layout: dict) -> None:
+        """
+        Adds a serialized layout to the shared '_layouts' table of the file.
+        """
+        if self._file is None:
+            raise Exception('This PlotsStreamWriter is not open, please use it as a context manager.')
+        self._layouts[key] = layout
+
+    def write_designs(self, designs: Optional[dict]) -> None:
+        """
+        Sets the '_designs' block of the file (see design_store.DesignStore.encode), replacing any block set before.
+        """
+        if self._file is None:
+            raise Exception('This PlotsStreamWriter is not open, please use it as a context manager.')
+        self._designs = designs
+
+    def _write_table(self, key: str, table: Optional[dict]) -> None:
+        if not table:
+            return
+        self._write(b',' if self._index or self.version >= 2 else b'')
+        self._write(json.dumps(key).encode() + b':')
+        start = self._offset
+        self._write(dumps(table, separators=(',', ':')).encode())
+        self._index[key] = (start, self._offset)
+
+    def _write_arrays(self) -> None:
+        # Copies the shared arrays over from their temporary file as the last entry of the output:
+        if self._arrays_file is None:
+            return
+        self._write(b',' if self._index or self.version >= 2 else b'')
+        self._write(json.dumps(ARRAYS_KEY).encode() + b':')
+        start = self._offset
+        self._write(b'{')
+        self._arrays_file.seek(0)
+        shutil.copyfileobj(self._arrays_file, self._file)
+        self._offset += self._arrays_file.tell()
+        self._write(b'}')
+        self._index[ARRAYS_KEY] = (start, self._offset)
+        self._arrays_file.close()
+        os.remove(self.filepath + '.arrays.tmp')
+        self._arrays_file = None
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._write_table(DESIGNS_KEY, self._designs)
+            self._write_table(LAYOUTS_KEY, self._layouts)
+            self._write_arrays()
+            self._write(b'}')
+            sync_file(self._file)
+            self._file.close()
+            self._file = None
+            if self.replace_on_close:
+                self.replace()
+
+    def replace(self) -> None:
+        """
+        Renames the (closed) temporary file over filepath, see replace_on_close.
+        """
+        os.replace(self.filepath + '.tmp', self.filepath)
+        sync_directory(self.filepath)
+        if self.write_index:
+            save_index(self.filepath, self._index, self.version)
+
+    @property
+    def array_keys(self) -> set:
+        return set(self._array_keys)
+
+    @property
+    def layout_keys(self) -> set:
+        return set(self._layouts)
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def keys(self) -> set:
+        return set(self._index) - set(RESERVED_KEYS)
+
+
+def compact_plots_file(filepath: str, release: Optional[Callable[[], None]] = None) -> None:
+    """
+    Merges the append-only log of a .plots file (see plots_format.append_segment) back into the file. Plots which were
+    not changed in the log are copied over byte for byte, and the file is replaced atomically before the log is removed.
+
+    :param release: Called right before the file is replaced, e.g. to close another LazyPlots of the file
+    """
+    if not os.path.exists(log_path(filepath)):
+        return
+    with LazyPlots(filepath, cache_size=0, use_index=False) as plots:
+        if plots.designs and (len(plots.designs['chunks']) > 1 or plots.designs['removed']):
+            # The designs appended to the log are merged into one chunk:
+            plots.designs = DesignStore.decode(plots.designs, plots.arrays).encode()
+        writer = PlotsStreamWriter(filepath, version=plots.version, replace_on_close=False)
+        with writer:
+            plots.write_to(writer)
+    # The file is only replaced once it is no longer memory-mapped (Windows refuses to replace a mapped file), and only
+    # if it was written out in full:
+    if release is not None:
+        release()
+    writer.replace()
+    # Note: Should we crash before the log is removed, it no longer applies to the re-written file (see read_segments)
+    os.remove(log_path(filepath))
@@ -1,22 +1,138 @@
 """
 This script is specifically used to "hold" the variety of functions used to create a trace for the kodak_creator script
+
+Note: Plotly is only imported once a trace is built (see trace_class), so importing this script stays cheap.
 """
-from typing import Optional, Union
-import plotly.graph_objs as go
+from __future__ import annotations
+import json
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional, Union
 from dataclasses import dataclass
 import numpy as np
+from kodak.lod import LODSettings
+from kodak.binning import DEFAULT_CHUNK_SIZE, histogram_counts, histogram2d_counts, normalize
+
+if TYPE_CHECKING:
+    import plotly.graph_objs as go
+
+_TRACE_CLASSES = {'scatter': 'Scatter', 'scatter3d': 'Scatter3d', 'bar': 'Bar', 'heatmap': 'Heatmap',
+                  'contour': 'Contour'}  # Names of the plotly.graph_objs class of each plotly trace type
+_VALIDATED_PROPERTIES = set()  # (trace class, key, value) of the values set_trace_property already validated
+
+
+@lru_cache(maxsize=None)
+def trace_class(trace_type: str) -> type:
+    """
+    Returns the plotly.graph_objs class of a plotly trace type (e.g. go.Scatter for 'scatter'), importing plotly.
+    """
+    import plotly.graph_objs as go
+    return getattr(go, _TRACE_CLASSES[trace_type])
+
+
+class TraceRecord(dict):
+    """
+    Lightweight, dictionary-backed stand-in for a plotly trace used by the "fast" trace builders. The values (e.g. numpy
+    arrays) are kept by reference and are not validated by plotly until the figure is built (or validate is called).
+    Attribute access is supported so that a TraceRecord can be used like the plotly trace it stands in for.
+    """
+    def __getattr__(self, key: str):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key: str, value) -> None:
+        self[key] = value
+
+    def to_plotly_json(self) -> dict:
+        return dict(self)
+
+    def validate(self) -> Union[go.Scatter, go.Scatter3d, go.Bar, go.Heatmap, go.Contour]:
+        # Runs the full plotly validation and returns the validated trace:
+        trace = dict(self)
+        return trace_class(trace.pop('type'))(trace)
+
+
+@lru_cache(maxsize=None)
+def allowed_properties(trace_type: str) -> frozenset:
+    """
+    Returns the (cached) set of property names that plotly accepts for a given trace type.
+    """
+    return frozenset(trace_class(trace_type)._valid_props)
+
+
+def set_trace_property(plotly_trace: Union[go.Scatter, go.Scatter3d, TraceRecord], key: str, value: dict) -> None:
+    """
+    Sets a property of a trace, where plotly only validates a given value the first time it is set on a trace type. This
+    is meant for the small set of values used over and over (e.g. the default styles of KodakPlots.read_traces).
+    """
+    if isinstance(plotly_trace, TraceRecord):
+        plotly_trace[key] = value  # Validated once the figure is built
+        return
+    signature = (type(plotly_trace), key, json.dumps(value, sort_keys=True))
+    if signature not in _VALIDATED_PROPERTIES:
+        type(plotly_trace)(**{key: value})  # Raises if the value is not valid for this trace type
+        _VALIDATED_PROPERTIES.add(signature)
+    validate = plotly_trace._validate
+    plotly_trace._validate = False
+    try:
+        plotly_trace[key] = value
+    finally:
+        plotly_trace._validate = validate
+
+
+def _trace_record(trace_type: str, kwargs: dict, **data) -> TraceRecord:
+    allowed = allowed_properties(trace_type)
+    record = TraceRecord(type=trace_type, **data)
+    for key, value in kwargs.items():
+        if key not in allowed:
+            raise Exception(f'Invalid argument for {key} passed in, the {trace_class(trace_type).__name__} object '
+                            f'does not support this keyword argument')
+        # Plotly objects (e.g. go.scatter.Marker) are stored as their dictionary:
+        record[key] = value.to_plotly_json() if hasattr(value, 'to_plotly_json') else value
+    return record
+
+
+def _plotly_trace(trace_type: str, fast: bool, kwargs: dict,
+                  **data) -> Union[go.Bar, go.Heatmap, go.Contour, TraceRecord]:
+    # Creates the plotly trace (or TraceRecord if fast) of one of the binned trace types below:
+    if fast:
+        return _trace_record(trace_type, kwargs, **data)
+    trace = trace_class(trace_type)(**data)
+    for key, value in kwargs.items():
+        if hasattr(trace, key):
+            trace[key] = value
+        else:
+            raise Exception(f'Invalid argument for {key} passed in, the go.{type(trace).__name__} object does not '
+                            f'support this keyword argument')
+    return trace
+
+
+def _centers(edges: np.ndarray) -> np.ndarray:
+    return (edges[:-1] + edges[1:]) / 2
+
 
 @dataclass
 class PlotTrace(object):
-    plotly_trace: Optional[Union[go.Scatter, go.Scatter3d]]  # Note: We update this as we add in new supported data type
+    # Note: We update this as we add in new supported data types
+    plotly_trace: Optional[Union[go.Scatter, go.Scatter3d, go.Bar, go.Heatmap, go.Contour, TraceRecord]]
     type: str
+    lod: Optional[LODSettings] = None  # Level-of-detail settings for only this trace (see kodak.lod)
 
 
 def scatter(x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.ndarray]],
-            lines_markers_both: str, **kwargs) -> PlotTrace:
+            lines_markers_both: str, fast: bool = False, lod: Optional[LODSettings] = None, **kwargs) -> PlotTrace:
+    """
+    Creates a scatter PlotTrace. If fast is True, a TraceRecord is created instead of a go.Scatter meaning that x / y
+    are kept by reference and the kwargs are only checked against the allowed property names (not validated). The lod
+    settings (see kodak.lod) only apply to this trace.
+    """
     if lines_markers_both == 'both':
         lines_markers_both = 'markers+lines'
-    trace = go.Scatter(x=x, y=y, mode=lines_markers_both)
+    if fast:
+        return PlotTrace(plotly_trace=_trace_record('scatter', kwargs, x=x, y=y, mode=lines_markers_both),
+                         type='scatter', lod=lod)
+    trace = trace_class('scatter')(x=x, y=y, mode=lines_markers_both)
     for key, value in kwargs.items():
         if hasattr(trace, key):
             trace[key] = value
@@ -25,13 +141,18 @@ def scatter(x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.nda
                             f'keyword argument')
 
     # Now create a PlotTrace to return:
-    return PlotTrace(plotly_trace=trace, type='scatter')
+    return PlotTrace(plotly_trace=trace, type='scatter', lod=lod)
 
 
 def scatter3d(x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.ndarray]],
-              z: Optional[Union[list, np.ndarray]], **kwargs) -> PlotTrace:
-
-    trace = go.Scatter3d(x=x, y=y, z=z)
+              z: Optional[Union[list, np.ndarray]], fast: bool = False, lod: Optional[LODSettings] = None,
+              **kwargs) -> PlotTrace:
+    """
+    Creates a scatter3d PlotTrace, see scatter for what fast does.
+    """
+    if fast:
+        return PlotTrace(plotly_trace=_trace_record('scatter3d', kwargs, x=x, y=y, z=z), type='scatter3d', lod=lod)
+    trace = trace_class('scatter3d')(x=x, y=y, z=z)
     for key, value in kwargs.items():
         if hasattr(trace, key):
             trace[key] = value
@@ -40,4 +161,61 @@ def scatter3d(x: Optional[Union[list, np.ndarray]], y: Optional[Union[list, np.n
                             f'keyword argument')
 
     # Now create a PlotTrace to return:
-    return PlotTrace(plotly_trace=trace, type='scatter3d')
\ No newline at end of file
+    return PlotTrace(plotly_trace=trace, type='scatter3d', lod=lod)
+
+
+def histogram(x, bins: Union[int, list, np.ndarray] = 10, bin_range: Optional[tuple] = None, weights=None,
+              histnorm: str = '', fast: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs) -> PlotTrace:
+    """
+    Creates a histogram PlotTrace from the raw samples x (an array, np.memmap, or an iterable of chunks, see
+    kodak.binning). Rather than a go.Histogram, which holds every sample and leaves the binning to the browser, the
+    samples are binned here and a go.Bar with one bar per bin is created, so only the bin centers, widths, and counts
+    are stored.
+
+    :param bins: Number of equal-width bins, or the bin edges
+    :param bin_range: (min, max) of the bins, defaults to the range of the samples
+    :param weights: Optional weight of every sample (same shape as x)
+    :param histnorm: One of '', 'percent', 'probability', 'density', or 'probability density' (as in plotly)
+    """
+    counts, edges = histogram_counts(x, bins, bin_range, weights, chunk_size)
+    widths = np.diff(edges)
+    width = float(widths[0]) if np.allclose(widths, widths[0]) else widths  # One width if the bins are equal-width
+    trace = _plotly_trace('bar', fast, kwargs, x=_centers(edges), y=normalize(counts, widths, histnorm), width=width)
+    return PlotTrace(plotly_trace=trace, type='histogram')
+
+
+def histogram2d(x, y, bins: Union[int, list, np.ndarray, tuple] = 10, bin_range: Optional[tuple] = None,
+                weights=None, histnorm: str = '', fast: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                **kwargs) -> PlotTrace:
+    """
+    Creates a 2D histogram PlotTrace (a go.Heatmap of the bin counts) from the raw samples x / y, see histogram. The
+    heatmap holds the bin edges as x / y, so the cells span their bins.
+
+    :param bins: Number of bins / bin edges for both axes, or the (x bins, y bins) as a sequence of two (e.g. [20, 30])
+    :param bin_range: ((x min, x max), (y min, y max)), defaults to the range of the samples
+    """
+    counts, x_edges, y_edges = histogram2d_counts(x, y, bins, bin_range, weights, chunk_size)
+    z = normalize(counts, np.outer(np.diff(x_edges), np.diff(y_edges)), histnorm)
+    trace = _plotly_trace('heatmap', fast, kwargs, x=x_edges, y=y_edges, z=z.T)  # The rows of z are along y
+    return PlotTrace(plotly_trace=trace, type='histogram2d')
+
+
+def heatmap(z: Union[list, np.ndarray], x: Optional[Union[list, np.ndarray]] = None,
+            y: Optional[Union[list, np.ndarray]] = None, fast: bool = False, **kwargs) -> PlotTrace:
+    """
+    Creates a heatmap PlotTrace of already aggregated values z (where z[i][j] is the value at y[i], x[j]).
+    """
+    return PlotTrace(plotly_trace=_plotly_trace('heatmap', fast, kwargs, x=x, y=y, z=z), type='heatmap')
+
+
+def density_contour(x, y, bins: Union[int, list, np.ndarray, tuple] = 25, bin_range: Optional[tuple] = None,
+                    weights=None, histnorm: str = '', fast: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    **kwargs) -> PlotTrace:
+    """
+    Creates a density contour PlotTrace (a go.Contour of the bin counts at the bin centers, like a plotly
+    histogram2dcontour) from the raw samples x / y, see histogram2d.
+    """
+    counts, x_edges, y_edges = histogram2d_counts(x, y, bins, bin_range, weights, chunk_size)
+    z = normalize(counts, np.outer(np.diff(x_edges), np.diff(y_edges)), histnorm)
+    trace = _plotly_trace('contour', fast, kwargs, x=_centers(x_edges), y=_centers(y_edges), z=z.T)
+    return PlotTrace(plotly_trace=trace, type='histogram2dcontour')
@@ -0,0 +1,125 @@
+"""
+This script holds tests of the background exporter (kodak.background): checkpoints to a new or existing file, errors
+raised on the worker thread, and the backpressure of its bounded queue. Run with: python -m pytest tests
+"""
+import os
+import threading
+import pytest
+from kodak.kodak_creator import KodakPlots
+from kodak.plots_format import log_path
+
+
+def _read(filepath: str) -> KodakPlots:
+    kodak_plots = KodakPlots()
+    kodak_plots.read_json_input(filepath)
+    return kodak_plots
+
+
+def _add_plots(kodak_plots: KodakPlots, start: int, stop: int) -> None:
+    for i in range(start, stop):
+        trace = kodak_plots.scatter_plot([1, 2, 3], [i, i + 1, i + 2], 'markers')
+        kodak_plots.add_new_plot(traces=[trace], window_title=f'Plot {i}')
+
+
+"""
+Checkpoints
+"""
+def test_checkpoints_append(tmp_path):
+    kodak_plots = KodakPlots()
+    with kodak_plots.start_background_export(str(tmp_path), 'run', compact_threshold=None) as exporter:
+        _add_plots(kodak_plots, 0, 3)
+        exporter.checkpoint()
+        _add_plots(kodak_plots, 3, 5)
+    filepath = os.path.join(str(tmp_path), 'run.plots')
+    assert os.path.exists(log_path(filepath))
+    assert sorted(_read(filepath).all_plots) == [f'Plot {i}' for i in range(5)]
+
+
+def test_existing_file_written_over(tmp_path):
+    # A file left over from an earlier run is written over on the first checkpoint (instead of failing to append):
+    old = KodakPlots()
+    _add_plots(old, 100, 102)
+    old.write_json_output(str(tmp_path), 'run')
+
+    kodak_plots = KodakPlots()
+    with kodak_plots.start_background_export(str(tmp_path), 'run', compact_threshold=None) as exporter:
+        _add_plots(kodak_plots, 0, 2)
+        exporter.checkpoint()
+        _add_plots(kodak_plots, 2, 3)
+    filepath = os.path.join(str(tmp_path), 'run.plots')
+    assert sorted(_read(filepath).all_plots) == ['Plot 0', 'Plot 1', 'Plot 2']
+
+
+def test_existing_file_read_in_appended(tmp_path):
+    old = KodakPlots()
+    _add_plots(old, 0, 2)
+    old.write_json_output(str(tmp_path), 'run')
+    filepath = os.path.join(str(tmp_path), 'run.plots')
+
+    kodak_plots = _read(filepath)
+    with kodak_plots.start_background_export(str(tmp_path), 'run', compact_threshold=None):
+        _add_plots(kodak_plots, 2, 3)
+    assert os.path.exists(log_path(filepath))
+    assert sorted(_read(filepath).all_plots) == ['Plot 0', 'Plot 1', 'Plot 2']
+
+
+"""
+Errors
+"""
+def _fail():
+    raise ValueError('failed on the worker')
+
+
+def test_error_raised_on_next_call(tmp_path):
+    kodak_plots = KodakPlots()
+    exporter = kodak_plots.start_background_export(str(tmp_path), 'run')
+    exporter.submit(_fail)
+    with pytest.raises(ValueError):
+        exporter.flush()
+    # The calls handed over after the error are refused, and close raises it again without writing a checkpoint:
+    with pytest.raises(ValueError):
+        _add_plots(kodak_plots, 0, 1)
+    with pytest.raises(ValueError):
+        exporter.close()
+    assert exporter.closed and kodak_plots._exporter is None
+    assert not os.path.exists(os.path.join(str(tmp_path), 'run.plots'))
+
+
+def test_calls_after_error_skipped(tmp_path):
+    kodak_plots = KodakPlots()
+    exporter = kodak_plots.start_background_export(str(tmp_path), 'run')
+    ran = []
+    exporter.submit(_fail)
+    exporter.submit(ran.append, 1)
+    with pytest.raises(ValueError):
+        exporter.close()
+    assert ran == []
+
+
+"""
+Backpressure
+"""
+def test_submit_blocks_while_queue_full(tmp_path):
+    kodak_plots = KodakPlots()
+    exporter = kodak_plots.start_background_export(str(tmp_path), 'run', max_queued=2)
+    started, release = threading.Event(), threading.Event()
+
+    def _blocking():
+        started.set()
+        release.wait(5)
+
+    exporter.submit(_blocking)
+    assert started.wait(5)  # The worker is now busy, so the next calls wait in the queue
+    exporter.submit(lambda: None)
+    exporter.submit(lambda: None)
+    assert exporter.pending == 2
+
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (exporter.submit(lambda: None), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.2)  # Blocked on the full queue
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    exporter.close(checkpoint=False)
+    assert exporter.pending == 0
@@ -0,0 +1,85 @@
+"""
+This script holds tests of the chunked binning (kodak.binning) against np.histogram / np.histogram2d, for samples
+passed in as arrays and as iterables of chunks. Run with: python -m pytest tests
+"""
+import numpy as np
+import pytest
+from kodak.binning import histogram_counts, histogram2d_counts
+
+CHUNK_SIZE = 1000
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.default_rng(0)
+    x, y, w = rng.normal(size=5500), rng.normal(size=5500), rng.random(5500)
+    x[::97] = np.nan
+    return x, y, w
+
+
+def _in_chunks(values: np.ndarray, size: int = 700) -> list:
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+"""
+1D
+"""
+@pytest.mark.parametrize('bins', [10, 37, [-3., -1., 0., 0.5, 4.]])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_histogram_matches_numpy(samples, bins, weighted):
+    x, _, w = samples
+    w = w if weighted else None
+    counts, edges = histogram_counts(x, bins, bin_range=(-3, 3), weights=w, chunk_size=CHUNK_SIZE)
+    expected, expected_edges = np.histogram(x, bins, range=(-3, 3), weights=w)
+    np.testing.assert_allclose(edges, expected_edges)
+    np.testing.assert_allclose(counts, expected)
+
+
+def test_histogram_of_chunks(samples):
+    x, _, w = samples
+    counts, edges = histogram_counts(iter(_in_chunks(x)), 20, bin_range=(-3, 3), weights=iter(_in_chunks(w)))
+    expected, expected_edges = np.histogram(x, 20, range=(-3, 3), weights=w)
+    np.testing.assert_allclose(edges, expected_edges)
+    np.testing.assert_allclose(counts, expected)
+
+
+"""
+2D
+"""
+@pytest.mark.parametrize('bins', [15, [20, 30], (20, 30), [8, [-2., 0., 1., 2.]], [-2., -1., 0., 1., 2.]])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_histogram2d_matches_numpy(samples, bins, weighted):
+    x, y, w = samples
+    w = w if weighted else None
+    finite = np.isfinite(x)  # np.histogram2d can not find the range of non-finite samples
+    counts, x_edges, y_edges = histogram2d_counts(x[finite], y[finite], bins, weights=None if w is None else w[finite],
+                                                  chunk_size=CHUNK_SIZE)
+    expected, expected_x, expected_y = np.histogram2d(x[finite], y[finite], bins,
+                                                      weights=None if w is None else w[finite])
+    np.testing.assert_allclose(x_edges, expected_x)
+    np.testing.assert_allclose(y_edges, expected_y)
+    np.testing.assert_allclose(counts, expected)
+
+
+def test_histogram2d_per_axis_bin_counts(samples):
+    x, y, _ = samples
+    counts, x_edges, y_edges = histogram2d_counts(x, y, [20, 30], bin_range=((-3, 3), (-3, 3)))
+    assert counts.shape == (20, 30)
+    assert len(x_edges) == 21 and len(y_edges) == 31
+
+
+"""
+Lengths
+"""
+@pytest.mark.parametrize('n_weights', [69999, 70001, 65536, 65537])
+def test_mismatched_weights_raise(n_weights):
+    # The weights run out part way through the chunks (or have chunks left over), which used to be silently dropped:
+    x = np.linspace(0, 1, 70000)
+    with pytest.raises(Exception, match='same length'):
+        histogram_counts(x, 10, weights=np.ones(n_weights))
+
+
+def test_mismatched_chunks_raise():
+    x, y = np.linspace(0, 1, 3000), np.linspace(0, 1, 3000)
+    with pytest.raises(Exception, match='same length'):
+        histogram2d_counts(iter(_in_chunks(x)), iter(_in_chunks(y)[:-1]), 10, bin_range=((0, 1), (0, 1)))
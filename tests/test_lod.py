@@ -0,0 +1,98 @@
+"""
+This script holds tests of the level-of-detail stage (kodak.lod): the number of points kept by each method, and which
+per-point arrays of a trace are reduced. Run with: python -m pytest tests
+"""
+import numpy as np
+import pytest
+from kodak.lod import LODSettings, downsample_trace, grid, lttb, minmax, stride
+
+N = 200000
+MAX_POINTS = 10000
+
+
+def _kept(trace: dict, max_points: int = MAX_POINTS) -> int:
+    _, _, report = downsample_trace(trace, LODSettings(max_points=max_points))
+    return report['kept']
+
+
+"""
+Line methods
+"""
+def test_lttb_keeps_ends_and_budget():
+    x = np.linspace(0, 10, N)
+    idx = lttb(x, np.sin(x), MAX_POINTS)
+    assert len(idx) == MAX_POINTS
+    assert idx[0] == 0 and idx[-1] == N - 1
+    assert np.all(np.diff(idx) > 0)
+
+
+def test_minmax_keeps_extremes():
+    y = np.sin(np.linspace(0, 10, N))
+    idx = minmax(y, MAX_POINTS)
+    assert len(idx) <= MAX_POINTS
+    assert np.argmax(y) in idx and np.argmin(y) in idx
+
+
+def test_stride():
+    idx = stride(N, MAX_POINTS)
+    assert len(idx) == MAX_POINTS
+    assert idx[0] == 0 and idx[-1] == N - 1
+
+
+"""
+Grid
+"""
+def test_grid_keeps_budget_along_curve():
+    # Points along a curve only occupy about sqrt(budget) cells of a grid with budget cells, so it has to be refined:
+    x = np.linspace(0, 50, N)
+    assert 0.9 * MAX_POINTS <= _kept({'type': 'scatter', 'mode': 'markers', 'x': x, 'y': np.sin(x)}) <= MAX_POINTS
+
+
+def test_grid_keeps_budget_along_3d_curve():
+    # A scatter3d trace without a mode (the default of scatter3d_plot) is binned as a point cloud:
+    t = np.linspace(0, 50, N)
+    assert 0.9 * MAX_POINTS <= _kept({'type': 'scatter3d', 'x': np.cos(t), 'y': np.sin(t), 'z': t}) <= MAX_POINTS
+
+
+@pytest.mark.parametrize('sample', ['random', 'normal'])
+def test_grid_keeps_budget_for_clouds(sample):
+    rng = np.random.default_rng(0)
+    x, y = getattr(rng, sample)(size=N), getattr(rng, sample)(size=N)
+    assert 0.9 * MAX_POINTS <= _kept({'type': 'scatter', 'mode': 'markers', 'x': x, 'y': y}) <= MAX_POINTS
+
+
+def test_grid_duplicated_points():
+    rng = np.random.default_rng(0)
+    x, y = rng.integers(0, 20, N).astype(float), rng.integers(0, 20, N).astype(float)
+    idx = grid([x, y], MAX_POINTS)
+    assert len(idx) == 400
+    assert len(set(zip(x[idx], y[idx]))) == 400
+
+
+def test_grid_drops_non_finite():
+    x = np.linspace(0, 1, N)
+    y = x.copy()
+    y[::2] = np.nan
+    idx = grid([x, y], MAX_POINTS)
+    assert 0 < len(idx) <= MAX_POINTS
+    assert np.isfinite(y[idx]).all()
+
+
+"""
+Traces
+"""
+def test_nested_per_point_arrays():
+    n = 1000
+    trace = {'type': 'scatter', 'mode': 'markers', 'x': np.arange(n), 'y': np.arange(n) * 1.,
+             'marker': {'color': np.arange(n), 'line': {'color': ['red'] * n, 'width': 2}}}
+    reduced, full, report = downsample_trace(trace, LODSettings(max_points=10))
+    assert report['kept'] == 10
+    assert len(reduced['marker']['color']) == 10
+    assert reduced['marker']['line'] == {'color': ['red'] * 10, 'width': 2}
+    assert sorted(full) == ['marker.color', 'marker.line.color', 'x', 'y']
+
+
+def test_small_or_disabled_traces_untouched():
+    trace = {'type': 'scatter', 'x': np.arange(10), 'y': np.arange(10)}
+    assert downsample_trace(trace, LODSettings(max_points=100)) == (trace, {}, None)
+    assert downsample_trace(trace, LODSettings(max_points=3, enabled=False)) == (trace, {}, None)
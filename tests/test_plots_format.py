@@ -0,0 +1,324 @@
+"""
+This script holds round-trip tests of the .plots file format: the lazy scanner, the append-only log, the sidecar index,
+the columnar design store, and kodak.merge. Run with: python -m pytest tests
+"""
+import json
+import os
+import numpy as np
+import pytest
+from kodak.kodak_creator import KodakPlots
+from kodak.design_store import DesignStore
+from kodak.merge import merge_plots_files, plan_merge
+from kodak.plots_format import append_segment, load_index, log_path, raw_references, read_segments, save_index
+from kodak.plots_reader import LazyPlots, _string_end, scan_index
+
+
+def _plot(title: str, description: str = 'No plot description provided.', x: list = (1, 2, 3)) -> dict:
+    return {'_title': title, '_description': description, '_data': {'data': [{'type': 'scatter', 'x': list(x)}]}}
+
+
+def _write(directory, name: str, plots: dict) -> str:
+    kodak_plots = KodakPlots()
+    kodak_plots.all_plots = plots
+    kodak_plots.write_json_output(str(directory), name)
+    return os.path.join(str(directory), name + '.plots')
+
+
+def _read(filepath: str, lazy: bool = False) -> KodakPlots:
+    kodak_plots = KodakPlots()
+    kodak_plots.read_json_input(filepath, lazy=lazy)
+    return kodak_plots
+
+
+"""
+Scanner
+"""
+@pytest.mark.parametrize('text', ['"plain"', '"esc\\"aped"', '"back\\\\"', '"back\\\\\\"quote"', '"\\\\\\\\"', '""'])
+def test_string_end(text):
+    raw = (text + ' , "next"').encode()
+    assert _string_end(raw, 0) == len(text)
+    assert json.loads(raw[:len(text)]) == json.loads(text)
+
+
+def test_scan_index_matches_json():
+    contents = {'_kodak_version': 2, 'quo"te': _plot('a"b\\'), 'back\\slash': [1, {'x': '}]'}, 2.5e-3],
+                'unicode é': None, 'nested': {'a': {'b': [[], {}]}}, 'flag': True}
+    for indent in (None, 4):
+        raw = json.dumps(contents, indent=indent).encode()
+        index = scan_index(raw)
+        assert list(index) == list(contents)
+        for key, (start, end) in index.items():
+            assert json.loads(raw[start:end]) == contents[key]
+
+
+def test_scan_index_unterminated():
+    with pytest.raises(Exception):
+        scan_index(b'{"a": "never closed}')
+
+
+"""
+Encoding
+"""
+@pytest.mark.parametrize('version', [1, 2])
+def test_dates_round_trip(tmp_path, version):
+    x = np.arange('2024-01-01', '2024-04-10', dtype='datetime64[D]').astype('datetime64[ns]')
+    kodak_plots = KodakPlots(plots_version=version)
+    kodak_plots.add_new_plot([kodak_plots.scatter_plot(x, np.arange(len(x)), 'markers')], 'Dates')
+    kodak_plots.add_new_plot([kodak_plots.scatter_plot(x[:3], [1, 2, 3], 'markers')], 'Few dates')
+    kodak_plots.write_json_output(str(tmp_path), 'run')
+    kodak_plots = _read(os.path.join(str(tmp_path), 'run.plots'))
+    assert kodak_plots.get_figure('Dates').data[0].x[0] == '2024-01-01T00:00:00'
+    assert kodak_plots.get_figure('Few dates').data[0].x[-1] == '2024-01-03T00:00:00'
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_non_finite_values_are_strict_json(tmp_path, version):
+    kodak_plots = KodakPlots(plots_version=version)
+    kodak_plots.add_new_plot([kodak_plots.scatter_plot([1, 2, 3, 4, 5], np.array([1, np.nan, 3, np.inf, 5]), 'lines')],
+                             'Gaps')
+    kodak_plots.all_plots['Raw'] = _plot('Raw', x=[1., float('-inf')])
+    kodak_plots.write_json_output(str(tmp_path), 'run')
+    kodak_plots.all_plots['Logged'] = _plot('Logged', x=[float('nan')])
+    kodak_plots.append_json_output(str(tmp_path), 'run', compact_threshold=None)
+
+    def reject(constant):
+        raise ValueError(f'{constant} is not valid JSON')
+    filepath = os.path.join(str(tmp_path), 'run.plots')
+    for path in (filepath, log_path(filepath)):
+        with open(path) as f:
+            for line in (f.read(),) if path == filepath else f:
+                json.loads(line, parse_constant=reject)
+    kodak_plots = _read(filepath)
+    assert kodak_plots.get_figure('Gaps').data[0].y == (1, None, 3, None, 5)
+    assert kodak_plots.all_plots.peek('Logged')['_data']['data'][0]['x'] == [None]
+
+
+@pytest.mark.parametrize('share_arrays', [False, True])
+def test_shared_arrays_are_opt_in(tmp_path, share_arrays):
+    x = np.linspace(0, 1, 100)
+    kodak_plots = KodakPlots(share_arrays=share_arrays)
+    for i in range(2):
+        kodak_plots.add_new_plot([kodak_plots.scatter_plot(x, x * i, 'markers')], f'Plot {i}')
+    kodak_plots.write_json_output(str(tmp_path), 'run')
+    with open(os.path.join(str(tmp_path), 'run.plots')) as f:
+        assert ('"_array"' in f.read()) == share_arrays
+    kodak_plots = _read(os.path.join(str(tmp_path), 'run.plots'))
+    np.testing.assert_allclose(kodak_plots.get_figure('Plot 1').data[0].x, x)
+
+
+"""
+Append-only log
+"""
+@pytest.mark.parametrize('lazy', [False, True])
+def test_log_round_trip(tmp_path, lazy):
+    filepath = _write(tmp_path, 'run', {'A': _plot('A'), 'B': _plot('B')})
+    kodak_plots = _read(filepath, lazy=lazy)
+    kodak_plots.all_plots['C'] = _plot('C')
+    kodak_plots.remove_plot('A')
+    kodak_plots.all_plots['B']['_description'] = 'Edited in place'
+    kodak_plots.append_json_output(str(tmp_path), 'run', compact_threshold=None)
+    assert os.path.exists(log_path(filepath))
+
+    for lazy_read in (False, True):
+        plots = _read(filepath, lazy=lazy_read).all_plots
+        assert list(plots) == ['B', 'C']
+        assert plots.peek('B')['_description'] == 'Edited in place'
+
+    kodak_plots.compact_json_output(str(tmp_path), 'run')
+    assert not os.path.exists(log_path(filepath))
+    assert list(_read(filepath).all_plots) == ['B', 'C']
+
+
+@pytest.mark.parametrize('rewrite', ['write', 'compact', 'append'])
+def test_lazy_file_released_before_replace(tmp_path, monkeypatch, rewrite):
+    # As on Windows, the file read in lazily can not be replaced while all_plots still memory-maps it:
+    filepath = _write(tmp_path, 'run', {'A': _plot('A'), 'B': _plot('B'), 'C': _plot('C')})
+    kodak_plots = _read(filepath, lazy=True)
+    replace = os.replace
+
+    def checked_replace(source, target):
+        if os.path.abspath(target) == os.path.abspath(filepath):
+            assert kodak_plots.all_plots.closed, 'The file is still memory-mapped'
+        replace(source, target)
+    monkeypatch.setattr(os, 'replace', checked_replace)
+
+    kodak_plots.all_plots['B']['_description'] = 'Edited in place'
+    kodak_plots.all_plots['D'] = _plot('D')
+    if rewrite == 'write':
+        kodak_plots.write_json_output(str(tmp_path), 'run')
+    else:
+        kodak_plots.append_json_output(str(tmp_path), 'run', compact_threshold=None)
+        kodak_plots.remove_plot('A')  # Not written out yet, so the plot has to stay removed after compaction
+        if rewrite == 'compact':
+            kodak_plots.compact_json_output(str(tmp_path), 'run')
+        else:
+            kodak_plots.append_json_output(str(tmp_path), 'run', compact_threshold=0.)
+        assert not os.path.exists(log_path(filepath))
+
+    expected = ['A', 'B', 'C', 'D'] if rewrite == 'write' else ['B', 'C', 'D']
+    plots = kodak_plots.all_plots
+    assert isinstance(plots, LazyPlots) and not plots.closed
+    assert list(plots) == expected
+    plots['B']['_description'] = 'Edited again'
+    kodak_plots.append_json_output(str(tmp_path), 'run', compact_threshold=None)
+    plots = _read(filepath).all_plots
+    assert list(plots) == expected
+    assert plots.peek('B')['_description'] == 'Edited again'
+    assert plots.peek('D') == _plot('D')
+
+
+def test_log_torn_tail(tmp_path):
+    filepath = _write(tmp_path, 'run', {'A': _plot('A')})
+    append_segment(filepath, {'B': _plot('B')})
+    with open(log_path(filepath), 'ab') as f:
+        f.write(b'{"base": [1, 2], "version": 2, "plots": {"C"')  # A crash part way through the next segment
+    assert [list(s['plots']) for s in read_segments(filepath)] == [['B']]
+    assert list(_read(filepath).all_plots) == ['A', 'B']
+
+    # The torn tail is cut off before the next segment is appended:
+    append_segment(filepath, {'D': _plot('D')})
+    assert [list(s['plots']) for s in read_segments(filepath)] == [['B'], ['D']]
+    assert list(_read(filepath, lazy=True).all_plots) == ['A', 'B', 'D']
+
+
+def test_stale_log_is_ignored(tmp_path):
+    filepath = _write(tmp_path, 'run', {'A': _plot('A')})
+    append_segment(filepath, {'B': _plot('B')})
+    log = open(log_path(filepath), 'rb').read()
+    _write(tmp_path, 'run', {'A': _plot('A', x=range(10))})  # Removes the log of the previous file
+    with open(log_path(filepath), 'wb') as f:
+        f.write(log)  # A log left behind by e.g. a crash before it could be removed
+    assert read_segments(filepath) == []
+    assert list(_read(filepath).all_plots) == ['A']
+
+
+"""
+Sidecar index
+"""
+def test_stale_index_is_ignored(tmp_path):
+    filepath = _write(tmp_path, 'run', {'A': _plot('A'), 'B': _plot('B')})
+    with LazyPlots(filepath) as plots:
+        assert list(plots) == ['A', 'B']
+    assert load_index(filepath) is not None
+
+    _write(tmp_path, 'run', {'Longer title': _plot('Longer title', x=range(5))})
+    assert load_index(filepath) is None
+    with LazyPlots(filepath) as plots:
+        assert list(plots) == ['Longer title']
+        assert plots['Longer title']['_data']['data'][0]['x'] == list(range(5))
+
+
+def test_index_with_same_size(tmp_path):
+    # A sidecar whose size matches but whose mtime does not is stale as well:
+    filepath = _write(tmp_path, 'run', {'A': _plot('A')})
+    with LazyPlots(filepath, use_index=False) as plots:
+        save_index(filepath, {'A': (0, 1)}, 2)
+        assert list(plots) == ['A']
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert load_index(filepath) is None
+
+
+def test_unwritable_index(tmp_path):
+    filepath = _write(tmp_path, 'run', {'A': _plot('A')})
+    os.mkdir(filepath + '.idx')
+    with LazyPlots(filepath) as plots:
+        assert list(plots) == ['A']
+
+
+"""
+Design store
+"""
+def test_design_store_round_trip():
+    store = DesignStore()
+    store.add(0, {'vertices': [[0., 0., 0.], [1., 0., 0.]], 'edges': [[0, 1]], 'score': 0.5, 'name': 'first'})
+    store.add(3, {'vertices': [[0., 1., 0.]], 'edges': [], 'score': 1.5, 'extra': {'a': 1}})
+    store.add(5, {'vertices': [[2., 2., 2.]], 'score': 2.5, 'name': 'third'})
+    store.remove(5)
+
+    decoded = DesignStore.decode(json.loads(json.dumps(store.encode())))
+    assert list(decoded) == [0, 3]
+    for design in (0, 3):
+        assert decoded.design(design, as_lists=True) == store.design(design, as_lists=True)
+    assert decoded.design(3, as_lists=True)['extra'] == {'a': 1}
+    np.testing.assert_array_equal(decoded[0]['vertices'], [[0., 0., 0.], [1., 0., 0.]])
+
+
+def test_design_store_keeps_integers():
+    # Integers stay integers once a later design promotes the field to floats, also across chunks (i.e. appends):
+    store = DesignStore()
+    store.add(0, {'score': 5, 'point': [1, 2]})
+    first = store.encode_chunk()
+    store.add(1, {'score': 2.5, 'point': [1.5, 2.]})
+    second = store.encode_chunk(1)
+    for decoded in (store, DesignStore.decode(json.loads(json.dumps({'chunks': [first, second]})))):
+        assert decoded.maps['INTERACTIVE_DESIGN_0'] == {'score': 5, 'point': [1, 2]}
+        assert type(decoded.maps['INTERACTIVE_DESIGN_0']['score']) is int
+        assert decoded.maps['INTERACTIVE_DESIGN_1'] == {'score': 2.5, 'point': [1.5, 2.]}
+
+
+"""
+Merge planning
+"""
+def _scans(*keys: list) -> list:
+    return [{'keys': list(k), 'version': 2, 'index': None,
+             'max_design_id': max([int(key.rsplit('_', 1)[1]) for key in k if key.startswith('INTERACTIVE_DESIGN_')],
+                                  default=-1)} for k in keys]
+
+
+def test_plan_merge():
+    scans = _scans(['A', 'INTERACTIVE_DESIGN_0', 'INTERACTIVE_DESIGN_1'], ['A', 'B', 'INTERACTIVE_DESIGN_0'], ['A'])
+    plans, offsets = plan_merge(scans, 'rename')
+    assert offsets == [0, 2, 3]
+    assert plans[1] == [('A', 'A (2)'), ('B', 'B'), ('INTERACTIVE_DESIGN_0', 'INTERACTIVE_DESIGN_2')]
+    assert plans[2] == [('A', 'A (3)')]
+
+    plans, _ = plan_merge(scans, 'first')
+    assert [[new for _, new in plan] for plan in plans] == [
+        ['A', 'INTERACTIVE_DESIGN_0', 'INTERACTIVE_DESIGN_1'], ['B', 'INTERACTIVE_DESIGN_2'], []]
+    plans, _ = plan_merge(scans, 'last')
+    assert [[new for _, new in plan] for plan in plans] == [
+        ['INTERACTIVE_DESIGN_0', 'INTERACTIVE_DESIGN_1'], ['B', 'INTERACTIVE_DESIGN_2'], ['A']]
+    with pytest.raises(Exception):
+        plan_merge(scans, 'error')
+
+
+def test_merge_files(tmp_path):
+    first = _write(tmp_path, 'first', {'A': _plot('A'), 'INTERACTIVE_DESIGN_0': {'score': 1}})
+    second = _write(tmp_path, 'second', {'A': _plot('A', x=range(4)), 'INTERACTIVE_DESIGN_0': {'score': 2}})
+    output = os.path.join(str(tmp_path), 'merged.plots')
+    report = merge_plots_files([first, second], output, max_workers=1)
+    assert report['renamed'] == {second: {'A': 'A (2)'}}
+    plots = _read(output).all_plots
+    assert list(plots) == ['A', 'INTERACTIVE_DESIGN_0', 'A (2)', 'INTERACTIVE_DESIGN_1']
+    assert plots.peek('INTERACTIVE_DESIGN_1') == {'score': 2}
+    assert not os.path.exists(second + '.idx')  # Nothing is written next to the inputs
+
+
+def test_merge_keeps_custom_titles_and_referenced_arrays(tmp_path):
+    filepaths = []
+    for i in range(2):
+        kodak_plots = KodakPlots()
+        kodak_plots.all_plots['problem_definition'] = {'_title': 'Problem specified to mango framework', '_data': {}}
+        kodak_plots.all_plots['A'] = {'_title': 'A', '_data': {'data': [{'x': {'_array': f'array {i}'}}]}}
+        kodak_plots.array_table[f'array {i}'] = {'dtype': 'f8', 'bdata': 'AAAAAAAA8D8=', 'shape': '1'}
+        kodak_plots.write_json_output(str(tmp_path), f'input_{i}')
+        filepaths.append(os.path.join(str(tmp_path), f'input_{i}.plots'))
+
+    output = os.path.join(str(tmp_path), 'merged.plots')
+    merge_plots_files(filepaths, output, max_workers=1)
+    with LazyPlots(output, use_index=False) as plots:
+        assert plots['problem_definition (2)']['_title'] == 'Problem specified to mango framework (2)'
+        assert plots['A (2)']['_title'] == 'A (2)'
+        assert sorted(plots.arrays) == ['array 0', 'array 1']
+
+    merge_plots_files(filepaths, output, on_collision='last', max_workers=1)
+    with LazyPlots(output, use_index=False) as plots:
+        assert sorted(plots.arrays) == ['array 1']  # The array of the dropped plot is not copied over
+
+
+def test_raw_references():
+    plot = {'_description': 'Text holding "_array": "not a reference"', '_data': {
+        'layout': {'_layout': 'academic'}, 'data': [{'x': {'_array': 'abc'}, 'y': {'_array': 'd\\"e'}}]}}
+    for indent in (None, 4):
+        assert raw_references(json.dumps(plot, indent=indent).encode()) == ({'abc', 'd\\"e'}, {'academic'})